@@ -11,13 +11,14 @@ from sqlalchemy import select
 from app.db.database import SessionLocal
 from app.db import models
 from app.db.schemas import ContactCreate
-from app.crud import crud_prospect, crud_user, crud_config, crud_contact
+from app.crud import crud_prospect, crud_user, crud_config, crud_contact, crud_media, crud_jid
 from app.services.whatsapp_service import get_whatsapp_service, MessageSendError, WhatsAppService
-from app.services.gemini_service import get_gemini_service
+from app.services.gemini_service import get_gemini_service, CONVERSATION_STATUSES
+from app.services.draft_service import pregenerate_initial_drafts, get_valid_draft
 from app.services.google_drive_service import get_drive_service
 from app.services.google_calendar_service import get_google_calendar_service
 from googleapiclient.errors import HttpError
-from app.api.prospecting import _synchronize_and_process_history
+from app.api.prospecting import _synchronize_and_process_history, _media_sha256
 
 # Configuração do logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -26,6 +27,97 @@ logger = logging.getLogger(__name__)
 # Dicionário para rastrear o último envio de cada campanha
 # last_message_sent_times = {} # Agora será por instância no banco
 
+class MessagePartSender:
+    """
+    Envia as partes (linhas) da resposta da IA em segundo plano, com a presença "Digitando..."
+    e o atraso de digitação de cada parte. Permite começar a enviar durante o streaming da resposta;
+    se a resposta final divergir das linhas já repassadas, o envio para onde está (ver finish).
+    """
+    def __init__(self, whatsapp_service: WhatsAppService, instance_name: str, number: str):
+        self.whatsapp_service = whatsapp_service
+        self.instance_name = instance_name
+        self.number = number
+        self.queued_parts = []
+        self.sent_entries = []
+        self.sent_keys = []
+        self.error = None
+        self.stopped = False
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    async def push(self, part: str):
+        self.queued_parts.append(part)
+        await self._queue.put(part)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            part = await self._queue.get()
+            if part is None:
+                return
+            if self.error or self.stopped:
+                continue
+            try:
+                # Simula tempo de digitação: 1.5s base + 0.05s por caractere (Max 7s)
+                typing_delay = min(2 + (len(part) * 0.1), 10.0)
+                
+                # Envia status "Digitando..." (composing)
+                await self.whatsapp_service.send_presence(self.instance_name, self.number, "composing", delay=int(typing_delay * 1000))
+                await asyncio.sleep(typing_delay)
+
+                response = await self.whatsapp_service.send_text_message(self.instance_name, self.number, part)
+                self.sent_keys.append((response or {}).get("key"))
+                logger.info(f"AGENTE WORKER: Parte da mensagem enviada para {self.number}.")
+                now_iso = datetime.now(timezone.utc).isoformat()
+                pending_id = f"sent_{now_iso}_{random.randint(1000, 9999)}"
+                self.sent_entries.append({"id": pending_id, "role": "assistant", "content": part, "timestamp": now_iso})
+            except MessageSendError as e:
+                # Interrompe o envio das partes seguintes
+                self.error = e
+
+    async def finish(self, final_parts: list):
+        """
+        Enfileira as partes da mensagem final ainda não enviadas e aguarda o término dos envios.
+        Se a mensagem final não começar pelas partes já repassadas em streaming (falha no meio do streaming ou
+        regeneração), nada mais é enviado, para o contato não receber o início de uma resposta e o fim de outra.
+        Apenas o que de fato saiu fica em sent_entries.
+        """
+        already_queued = len(self.queued_parts)
+        if final_parts[:already_queued] != self.queued_parts:
+            logger.warning(f"AGENTE WORKER: Mensagem final difere das partes já enviadas em streaming para {self.number}. Interrompendo o envio.")
+            self.stopped = True
+        else:
+            for part in final_parts[already_queued:]:
+                await self.push(part)
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+# Tarefas de pré-geração de mensagens iniciais em andamento, por campanha
+_draft_tasks = {}
+
+async def _record_sent_jids(whatsapp_service: WhatsAppService, contact: models.Contact, keys: list):
+    """Salva no mapeamento do contato os LIDs devolvidos nas respostas de envio da Evolution."""
+    phone_jid = f"{whatsapp_service._normalize_number(contact.whatsapp)}@s.whatsapp.net"
+    for key in keys:
+        try:
+            await crud_jid.record_message_key_jids(contact.id, key, phone_jid)
+        except Exception as e:
+            logger.warning(f"AGENTE WORKER: Falha ao salvar os JIDs do envio para {contact.whatsapp}: {e}")
+
+
+def _schedule_draft_pregeneration(campaign_id: int):
+    task = _draft_tasks.get(campaign_id)
+    if task is None or task.done():
+        _draft_tasks[campaign_id] = asyncio.create_task(pregenerate_initial_drafts(campaign_id))
+
+
 async def process_active_prospects():
     """
     Busca campanhas de prospecção ativas e processa o próximo contato de cada uma,
@@ -47,12 +139,20 @@ async def process_active_prospects():
             # Extrai IDs para evitar erros de "MissingGreenlet" em objetos expirados após rollback
             active_campaign_ids = [c.id for c in active_campaigns_list]
 
+            # Mantém as próximas mensagens iniciais pré-geradas, fora do caminho crítico de envio
+            for campaign_id in active_campaign_ids:
+                _schedule_draft_pregeneration(campaign_id)
+
             whatsapp_service = get_whatsapp_service()
             gemini_service = get_gemini_service()
             drive_service = get_drive_service()
 
             # 2. Itera sobre cada campanha ativa
             for campaign_id in active_campaign_ids:
+                # Zerados a cada campanha, para o tratamento de erro não usar os da iteração anterior
+                pc_id = None
+                part_sender = None
+                full_history = None
                 try:
                     # Recarrega a campanha para garantir que está válida na sessão atual
                     campaign = await db.get(models.Prospect, campaign_id)
@@ -71,6 +171,7 @@ async def process_active_prospects():
                         continue
                     
                     pc, contact = contact_to_process
+                    pc_id = pc.id
                     original_status = pc.situacao # Captura o status original antes de mudar para 'Processando'
                     mode = "reply" if pc.situacao == "Resposta Recebida" else ("initial" if pc.situacao == "Aguardando Início" else "followup")
                     
@@ -213,11 +314,10 @@ async def process_active_prospects():
                         ]
                         
                         if user_msg_ids:
-                            # Tenta obter o JID correto (priorizando o que está salvo no contato)
+                            # Tenta obter o JID correto (priorizando o mapeamento salvo do contato)
                             target_jid = None
-                            if pc.jid_options:
-                                jids = [j.strip() for j in pc.jid_options.split(',') if j.strip()]
-                                if jids: target_jid = jids[0]
+                            contact_jids = await crud_jid.get_contact_jids(db, contact.id)
+                            if contact_jids: target_jid = contact_jids[0].jid
                             
                             if not target_jid:
                                 target_jid = f"{whatsapp_service._normalize_number(contact.whatsapp)}@s.whatsapp.net"
@@ -231,13 +331,28 @@ async def process_active_prospects():
                         await crud_prospect.update_prospect_contact(db, pc_id=pc.id, situacao="Aguardando Resposta")
                         continue
                     
-                    ia_response = await gemini_service.generate_conversation_action(
-                        config=persona_config, contact=contact, conversation_history_db=full_history,
-                        mode=mode, db=db, user=user
-                    )
+                    # As primeiras partes da mensagem começam a ser enviadas enquanto a resposta ainda é gerada
+                    part_sender = MessagePartSender(whatsapp_service, selected_instance.instance_name, contact.whatsapp)
+                    draft_response = get_valid_draft(pc, persona_config, contact) if mode == 'initial' and not full_history else None
+                    if draft_response:
+                        # Mensagem inicial pré-gerada: os tokens já foram contabilizados na geração do rascunho
+                        logger.info(f"AGENTE WORKER: Usando mensagem inicial pré-gerada para {contact.nome}.")
+                        ia_response = {**draft_response, "token_usage": 0}
+                    else:
+                        ia_response = await gemini_service.generate_conversation_action(
+                            config=persona_config, contact=contact, conversation_history_db=full_history,
+                            mode=mode, db=db, user=user, prospect_contact=pc,
+                            on_message_line=part_sender.push
+                        )
+                    if pc.initial_draft:
+                        pc.initial_draft = None
+                        pc.initial_draft_at = None
 
                     message_to_send = ia_response.get("mensagem_para_enviar")
-                    new_status = ia_response.get("nova_situacao", "Aguardando Resposta")
+                    new_status = ia_response.get("nova_situacao")
+                    if not new_status:
+                        # Follow-up dispensado pela cascata: mantém a situação anterior (se for uma que a IA atribui)
+                        new_status = original_status if original_status in CONVERSATION_STATUSES else "Aguardando Resposta"
                     new_observation = ia_response.get("observacoes", "")
                     lead_score = ia_response.get("lead_score", 0)
                     files_to_send = ia_response.get("arquivos_anexos", [])
@@ -285,34 +400,23 @@ async def process_active_prospects():
                             except Exception as e:
                                 logger.error(f"AGENTE WORKER: Falha ao enviar notificação para {campaign.notification_number}: {e}")
 
+                    # Divide a mensagem por quebras de linha para enviar separadamente
+                    # CORREÇÃO: Garante que quebras de linha que a IA possa ter escapado (ex: "\\n")
+                    # sejam convertidas para quebras de linha reais (\n) antes de dividir.
+                    messages_parts = []
                     if message_to_send and str(message_to_send).strip():
-                        try:
-                            # Divide a mensagem por quebras de linha para enviar separadamente
-                            # CORREÇÃO: Garante que quebras de linha que a IA possa ter escapado (ex: "\\n")
-                            # sejam convertidas para quebras de linha reais (\n) antes de dividir.
-                            processed_message = str(message_to_send).replace('\\n', '\n')
-                            messages_parts = [p.strip() for p in processed_message.split('\n') if p.strip()]
-                            
-                            for part in messages_parts:
-                                # Simula tempo de digitação: 1.5s base + 0.05s por caractere (Max 7s)
-                                typing_delay = min(2 + (len(part) * 0.1), 10.0)
-                                
-                                # Envia status "Digitando..." (composing)
-                                await whatsapp_service.send_presence(selected_instance.instance_name, contact.whatsapp, "composing", delay=int(typing_delay * 1000))
-                                await asyncio.sleep(typing_delay)
-
-                                await whatsapp_service.send_text_message(selected_instance.instance_name, contact.whatsapp, part)
-                                logger.info(f"AGENTE WORKER: Parte da mensagem enviada para {contact.whatsapp}.")
-                                now_iso = datetime.now(timezone.utc).isoformat()
-                                pending_id = f"sent_{now_iso}_{random.randint(1000, 9999)}"
-                                history_after_response.append({"id": pending_id, "role": "assistant", "content": part, "timestamp": now_iso})
-
-                            sent_any_message = True
-
-                        except MessageSendError as e:
-                            logger.error(f"AGENTE WORKER: Falha ao enviar mensagem para {contact.whatsapp}. Erro: {e}")
-                            new_status = "Falha no Envio"
-                            new_observation = f"Falha no envio via WhatsApp: {e}"
+                        processed_message = str(message_to_send).replace('\\n', '\n')
+                        messages_parts = [p.strip() for p in processed_message.split('\n') if p.strip()]
+
+                    await part_sender.finish(messages_parts)
+                    history_after_response.extend(part_sender.sent_entries)
+                    await _record_sent_jids(whatsapp_service, contact, part_sender.sent_keys)
+                    if part_sender.sent_entries:
+                        sent_any_message = True
+                    if part_sender.error:
+                        logger.error(f"AGENTE WORKER: Falha ao enviar mensagem para {contact.whatsapp}. Erro: {part_sender.error}")
+                        new_status = "Falha no Envio"
+                        new_observation = f"Falha no envio via WhatsApp: {part_sender.error}"
                     
                     # Processamento de Arquivos
                     if files_to_send and isinstance(files_to_send, list):
@@ -326,7 +430,7 @@ async def process_active_prospects():
                                     elif 'video' in mime: media_type = 'video'
                                     else: media_type = 'document'
 
-                                    await whatsapp_service.send_media_message(
+                                    sent_media = await whatsapp_service.send_media_message(
                                         instance_name=selected_instance.instance_name,
                                         number=contact.whatsapp,
                                         media=file_data['base64'],
@@ -337,8 +441,19 @@ async def process_active_prospects():
                                     logger.info(f"AGENTE WORKER: Arquivo {file_data['file_name']} enviado com sucesso.")
                                     
                                     now_iso = datetime.now(timezone.utc).isoformat()
-                                    pending_id = f"sent_file_{now_iso}"
-                                    history_after_response.append({"id": pending_id, "role": "assistant", "content": f"[Arquivo enviado: {file_data['file_name']}]", "timestamp": now_iso})
+                                    file_placeholder = f"[Arquivo enviado: {file_data['file_name']}]"
+                                    sent_media_id = (sent_media or {}).get('key', {}).get('id')
+                                    await _record_sent_jids(whatsapp_service, contact, [(sent_media or {}).get('key')])
+                                    if sent_media_id:
+                                        # Registra o envio para que a sincronização do histórico use o marcador em vez de analisar o arquivo com a IA
+                                        try:
+                                            await crud_media.save_media_analysis(
+                                                user.id, sent_media_id, _media_sha256(file_data['base64']), mime, file_placeholder, outbound=True
+                                            )
+                                        except Exception as e:
+                                            logger.warning(f"AGENTE WORKER: Falha ao registrar o arquivo enviado {sent_media_id}: {e}")
+                                    pending_id = sent_media_id or f"sent_file_{now_iso}"
+                                    history_after_response.append({"id": pending_id, "role": "assistant", "content": file_placeholder, "timestamp": now_iso})
                                     sent_any_message = True
                             except Exception as e:
                                 logger.error(f"AGENTE WORKER: Falha ao enviar arquivo {file_id}: {e}")
@@ -548,6 +663,8 @@ async def process_active_prospects():
                 except Exception as e:
                     logger.error(f"AGENTE WORKER: Erro ao processar campanha ID {campaign_id}: {e}", exc_info=True)
                     await db.rollback()
+                    if part_sender is not None:
+                        part_sender.cancel()
 
                     # --- PAUSA A CAMPANHA EM CASO DE ERRO ---
                     try:
@@ -561,8 +678,12 @@ async def process_active_prospects():
                         logger.error(f"Erro ao tentar pausar campanha {campaign_id}: {pause_error}")
 
                     # Tenta marcar o contato específico com erro, se possível
-                    if 'pc' in locals():
-                        await crud_prospect.update_prospect_contact(db, pc_id=pc.id, situacao="Erro IA", observacoes=f"Erro no worker: {e}")
+                    if pc_id is not None:
+                        # Linhas já enviadas em streaming ficam registradas no histórico
+                        conversa = None
+                        if part_sender is not None and part_sender.sent_entries and full_history is not None:
+                            conversa = json.dumps(full_history + part_sender.sent_entries)
+                        await crud_prospect.update_prospect_contact(db, pc_id=pc_id, situacao="Erro IA", conversa=conversa, observacoes=f"Erro no worker: {e}")
                         await db.commit()
 
         except Exception as e:
@@ -574,10 +695,14 @@ async def main():
     logger.info("🚀 AGENTE WORKER INICIADO 🚀")
     check_interval = int(os.getenv("AGENT_WORKER_INTERVAL", "10"))
     
-    while True:
-        await process_active_prospects()
-        logger.info(f"AGENTE WORKER: Aguardando {check_interval} segundos para a próxima verificação...")
-        await asyncio.sleep(check_interval)
+    try:
+        while True:
+            await process_active_prospects()
+            logger.info(f"AGENTE WORKER: Aguardando {check_interval} segundos para a próxima verificação...")
+            await asyncio.sleep(check_interval)
+    finally:
+        # Fecha as conexões keep-alive com a Evolution API
+        await get_whatsapp_service().aclose()
 
 if __name__ == "__main__":
     # Garante que o loop de eventos asyncio seja executado
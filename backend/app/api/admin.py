@@ -2,12 +2,15 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from sqlalchemy.orm import selectinload
-from typing import List
+from typing import List, Optional
+from datetime import datetime
 
 from app.db.database import get_db
 from app.db import models, schemas
 from app.crud import crud_user
 from app.api.dependencies import get_current_active_superuser
+from app.core.metrics import metrics
+from app.services.whatsapp_service import get_whatsapp_service
 from app.services.security import get_password_hash
 
 router = APIRouter()
@@ -126,6 +129,19 @@ async def delete_user_by_admin(
     await db.commit()
     return
 
+@router.get("/users/{user_id}/token-usage", response_model=List[schemas.TokenUsageDaily])
+async def read_user_token_usage(
+    user_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_active_superuser)
+):
+    """
+    Daily token consumption of a user, aggregated from the usage ledger. Only for superusers.
+    """
+    return await crud_user.get_token_usage_by_day(db, user_id=user_id, start=start, end=end)
+
 @router.get("/configs", response_model=List[schemas.Config])
 async def read_all_configs(
     db: AsyncSession = Depends(get_db),
@@ -137,4 +153,13 @@ async def read_all_configs(
     Retrieve all configs from all users. Only for superusers.
     """
     result = await db.execute(select(models.Config).offset(skip).limit(limit))
-    return result.scalars().all()
\ No newline at end of file
+    return result.scalars().all()
+
+@router.get("/metrics")
+async def read_metrics(
+    current_user: models.User = Depends(get_current_active_superuser)
+):
+    """
+    In-process counters and latency histograms of the API process, plus the Evolution DB pool usage. Only for superusers.
+    """
+    return {**metrics.snapshot(), "evolution_db_pool": get_whatsapp_service().db_pool_stats()}
@@ -12,6 +12,7 @@ from app.api.dependencies import get_current_active_user
 from app.services.google_sheets_service import GoogleSheetsService
 from app.services.google_drive_service import get_drive_service
 from app.services.gemini_service import get_gemini_service
+from app.services.vector_index import get_vector_index_store
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -87,6 +88,29 @@ def flatten_drive_tree(node: Dict[str, Any], path: str = "") -> List[str]:
         
     return lines
 
+def _embedding_failure_report(contents: List[str], origins: List[str], embeddings: List[List[float]]) -> List[Dict[str, Any]]:
+    """Lista as linhas que ficaram sem embedding (não entram no índice do RAG), para retorno e log."""
+    failures = [
+        {"row": i, "origin": origin, "content": content[:200]}
+        for i, (content, origin, embedding) in enumerate(zip(contents, origins, embeddings))
+        if not embedding
+    ]
+    if failures:
+        logger.warning(f"Sincronização do RAG: {len(failures)} de {len(contents)} linhas ficaram sem embedding: {[f['row'] for f in failures[:50]]}")
+    return failures
+
+async def _rebuild_initial_rag_context(db: AsyncSession, db_config: models.Config):
+    """
+    Recalcula o contexto RAG das mensagens iniciais após a sincronização.
+    Uma falha aqui não invalida a sincronização: o worker volta a consultar o RAG normalmente.
+    """
+    try:
+        await get_gemini_service().build_initial_rag_context(db, db_config)
+    except Exception as e:
+        logger.warning(f"Falha ao pré-calcular o contexto inicial da config {db_config.id}: {e}")
+        await db.rollback()
+        await db.refresh(db_config)
+
 @router.post("/", response_model=Config, status_code=status.HTTP_201_CREATED)
 async def create_config(
     config: ConfigCreate,
@@ -184,6 +208,7 @@ async def sync_google_sheet(
         
         prompt_buffer = []
         contextos_buffer = []
+        embedding_failures = []
 
         # --- Lógica Separada por Tipo ---
         if sync_type == "system":
@@ -213,6 +238,7 @@ async def sync_google_sheet(
                 valid_embeddings = [e for e in embeddings if e]
                 if not valid_embeddings and len(lines_to_embed) > 0:
                     raise HTTPException(status_code=500, detail="Falha crítica na geração de embeddings. A sincronização foi abortada para evitar perda de dados.")
+                embedding_failures = _embedding_failure_report(lines_to_embed, [item["origin"] for item in rag_items], embeddings)
                 
                 for item, embedding in zip(rag_items, embeddings):
                     if embedding:
@@ -230,15 +256,23 @@ async def sync_google_sheet(
             ))
             if contextos_buffer:
                 db.add_all(contextos_buffer)
+            db_config.rag_version = (db_config.rag_version or 0) + 1
+            db_config.initial_rag_context = None
         
         await db.commit()
         await db.refresh(db_config)
 
+        if sync_type == "rag":
+            get_vector_index_store().invalidate(db_config.id, current_version=db_config.rag_version)
+            await _rebuild_initial_rag_context(db, db_config)
+
         return {
             "message": f"Sincronização ({sync_type.upper()}) Concluída", 
             "sheets_found": list(sheet_data_json.keys()),
             "prompt_size": len(db_config.prompt or "") if sync_type == "system" else 0,
-            "vectors_created": len(contextos_buffer) if sync_type == "rag" else 0
+            "vectors_created": len(contextos_buffer) if sync_type == "rag" else 0,
+            "failed_rows": len(embedding_failures),
+            "failed_rows_detail": embedding_failures[:100]
         }
     
     except Exception as e:
@@ -284,6 +318,7 @@ async def sync_google_drive(
         
         # 2. Prepara vetores para RAG
         contextos_buffer = []
+        embedding_failures = []
         if drive_lines:
             embeddings = await gemini_service.generate_embeddings_batch(drive_lines)
             
@@ -291,6 +326,7 @@ async def sync_google_drive(
             valid_embeddings = [e for e in embeddings if e]
             if not valid_embeddings and len(drive_lines) > 0:
                 raise HTTPException(status_code=500, detail="Falha crítica na geração de embeddings do Drive. A sincronização foi abortada.")
+            embedding_failures = _embedding_failure_report(drive_lines, ["drive"] * len(drive_lines), embeddings)
 
             for line, embedding in zip(drive_lines, embeddings):
                 if embedding:
@@ -308,14 +344,20 @@ async def sync_google_drive(
         ))
         if contextos_buffer:
             db.add_all(contextos_buffer)
+        db_config.rag_version = (db_config.rag_version or 0) + 1
+        db_config.initial_rag_context = None
 
         await db.commit()
         await db.refresh(db_config)
+        get_vector_index_store().invalidate(db_config.id, current_version=db_config.rag_version)
+        await _rebuild_initial_rag_context(db, db_config)
 
         return {
             "message": "Drive sincronizado com Knowledge Base", 
             "files_count": files_count,
-            "vectors_created": len(contextos_buffer)
+            "vectors_created": len(contextos_buffer),
+            "failed_rows": len(embedding_failures),
+            "failed_rows_detail": embedding_failures[:100]
         }
     
     except Exception as e:
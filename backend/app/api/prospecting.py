@@ -4,6 +4,7 @@ import logging
 import re
 import csv
 import base64
+import hashlib
 import io
 from typing import Dict, List, Any, Optional, Tuple
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, File, UploadFile, Form, Query, Body, Response
@@ -12,16 +13,52 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timezone
 from sqlalchemy import or_
 from app.api import dependencies
-from app.db.database import get_db
+from app.db.database import get_db, SessionLocal
 from app.db import models, schemas
 from app.db.schemas import Prospect, ProspectCreate, ProspectUpdate, ProspectContactUpdate
-from app.crud import crud_prospect, crud_config, crud_user
+from app.crud import crud_prospect, crud_config, crud_user, crud_media, crud_jid
+from app.core.config import settings
+from app.core.metrics import metrics
 from app.services.whatsapp_service import WhatsAppService, get_whatsapp_service, MessageSendError
 from app.services.gemini_service import GeminiService, get_gemini_service
+from app.services.draft_service import pregenerate_initial_drafts
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+MEDIA_MESSAGE_KEYS = ("audioMessage", "imageMessage", "documentMessage", "stickerMessage")
+
+# Margem (em segundos) antes da marca de sincronização: cobre mensagens gravadas fora de ordem na Evolution
+HISTORY_SYNC_OVERLAP_SECONDS = 120
+
+def _file_sha256_hex(file_sha256: Optional[str]) -> Optional[str]:
+    """Converte o 'fileSha256' (base64) dos metadados da mídia do WhatsApp para hex."""
+    if not file_sha256 or not isinstance(file_sha256, str):
+        return None
+    try:
+        return base64.b64decode(file_sha256).hex()
+    except (ValueError, base64.binascii.Error):
+        return None
+
+def _media_sha256(data: Any) -> Optional[str]:
+    """SHA-256 (hex) dos bytes da mídia recebida em base64 (aceita Data URL)."""
+    if isinstance(data, str):
+        try:
+            data = base64.b64decode(data.split("base64,")[-1])
+        except (ValueError, base64.binascii.Error):
+            return None
+    return hashlib.sha256(data).hexdigest() if isinstance(data, bytes) else None
+
+async def _find_cached_media(db: AsyncSession, user_id: int, msg_id: str, media_info: dict, role: str) -> Optional[models.MediaAnalysis]:
+    """
+    Cache persistente: a mesma mídia (pelo ID da mensagem ou pelo hash informado pelo WhatsApp) não é baixada nem analisada de novo.
+    Arquivos enviados pelo sistema só contam para mensagens nossas (fromMe).
+    """
+    return await crud_media.get_media_analysis(
+        db, user_id, message_id=msg_id, sha256=_file_sha256_hex(media_info.get("fileSha256")),
+        include_outbound=(role == "assistant")
+    )
+
 async def _process_raw_message(
     raw_msg: dict, 
     history_list_for_context: list,
@@ -30,7 +67,8 @@ async def _process_raw_message(
     whatsapp_service: WhatsAppService, 
     gemini_service: GeminiService,
     db: AsyncSession,
-    user: models.User
+    user: models.User,
+    media_data: Optional[Dict[str, Any]] = None
 ) -> Tuple[Optional[Dict[str, Any]], int]:
     try:
         key = raw_msg.get("key", {})
@@ -67,20 +105,58 @@ async def _process_raw_message(
             media_meta["longitude"] = long
             media_meta["thumbnail"] = loc_msg.get("jpegThumbnail")
 
-        elif msg_content.get("audioMessage") or msg_content.get("imageMessage") or msg_content.get("documentMessage") or msg_content.get("stickerMessage"):
-            media_data = await whatsapp_service.get_media_and_convert(instance_name, raw_msg)
-            if media_data:
-                # Passa o histórico apenas para análise de mídia, não para transcrição de áudio.
-                if 'image' in media_data['mime_type']:
-                    media_meta["mediaType"] = "sticker" if "stickerMessage" in msg_content else "image"
-                    media_meta["mimeType"] = media_data['mime_type']
-
-                history_for_analysis = history_list_for_context if 'audio' not in media_data['mime_type'] else None
-                analysis, tokens_used = await gemini_service.transcribe_and_analyze_media(
-                    media_data, persona_config, db, user, db_history=history_for_analysis
-                )
-                
-                if 'audio' in media_data['mime_type']:
+        elif msg_content.get("stickerMessage") and not settings.MEDIA_ANALYZE_STICKERS:
+            # Figurinhas não são baixadas nem analisadas pela IA (salvo se habilitado nas configurações)
+            content = "[Figurinha]"
+            media_meta["mediaType"] = "sticker"
+            media_meta["mimeType"] = msg_content["stickerMessage"].get("mimetype") or "image/webp"
+
+        elif any(msg_content.get(k) for k in MEDIA_MESSAGE_KEYS):
+            media_info = msg_content[next(k for k in MEDIA_MESSAGE_KEYS if msg_content.get(k))]
+            cached = await _find_cached_media(db, user.id, msg_id, media_info, role)
+            mime_type = None
+            analysis = None
+            if cached and cached.outbound:
+                # Arquivo do Drive enviado pelo próprio worker: vira o marcador registrado no envio, sem download nem IA
+                metrics.increment("media_analysis_cache", result="outbound")
+                mime_type = cached.mime_type or media_info.get("mimetype") or ""
+                content = cached.content
+            elif cached:
+                metrics.increment("media_analysis_cache", result="hit", source="metadata")
+                mime_type = cached.mime_type or media_info.get("mimetype") or ""
+                analysis = cached.content
+            else:
+                # A mídia pode ter sido baixada antecipadamente pela sincronização (em paralelo)
+                media_data = media_data or await whatsapp_service.get_media_and_convert(instance_name, raw_msg)
+                if media_data:
+                    mime_type = media_data['mime_type']
+                    content_hash = _media_sha256(media_data.get("data"))
+                    cached = await crud_media.get_media_analysis(db, user.id, sha256=content_hash, include_outbound=(role == "assistant")) if content_hash else None
+                    if cached and cached.outbound:
+                        metrics.increment("media_analysis_cache", result="outbound")
+                        content = cached.content
+                    elif cached:
+                        metrics.increment("media_analysis_cache", result="hit", source="content")
+                        analysis = cached.content
+                    else:
+                        metrics.increment("media_analysis_cache", result="miss")
+                        # Passa o histórico apenas para análise de mídia, não para transcrição de áudio.
+                        history_for_analysis = history_list_for_context if 'audio' not in mime_type else None
+                        analysis, tokens_used = await gemini_service.transcribe_and_analyze_media(
+                            media_data, persona_config, db, user, db_history=history_for_analysis
+                        )
+                    # Falhas não entram no cache, para que a mídia seja reprocessada na próxima sincronização
+                    if analysis is not None and not str(analysis).startswith("[Erro"):
+                        await crud_media.save_media_analysis(user.id, msg_id, content_hash, mime_type, analysis, tokens_used)
+
+            if (content or analysis is not None) and 'image' in mime_type:
+                media_meta["mediaType"] = "sticker" if "stickerMessage" in msg_content else "image"
+                media_meta["mimeType"] = mime_type
+
+            if content:
+                pass # Marcador de arquivo enviado, já definido acima
+            elif analysis is not None:
+                if 'audio' in mime_type:
                     content = f"[Áudio transcrito]: {analysis}"
                 else:
                     content = f"[Análise de Mídia]: {analysis}"
@@ -116,6 +192,67 @@ async def _process_raw_message(
         logger.error(f"Erro ao processar mensagem individual ID {msg_id}: {e}", exc_info=True)
         return None, 0
 
+async def _process_audio_message(
+    raw_msg: dict,
+    semaphore: asyncio.Semaphore,
+    instance_name: str,
+    persona_config: models.Config,
+    whatsapp_service: WhatsAppService,
+    gemini_service: GeminiService,
+    user: models.User
+) -> Tuple[Optional[Dict[str, Any]], int]:
+    """Transcreve um áudio com sessão própria do banco, para rodar em paralelo com as demais mídias da sincronização."""
+    async with semaphore:
+        async with SessionLocal() as session:
+            return await _process_raw_message(
+                raw_msg, [], instance_name, persona_config, whatsapp_service, gemini_service, session, user
+            )
+
+async def _prefetch_media(
+    raw_msg: dict,
+    semaphore: asyncio.Semaphore,
+    instance_name: str,
+    whatsapp_service: WhatsAppService,
+    user_id: int
+) -> Optional[Dict[str, Any]]:
+    """Baixa antecipadamente a mídia que ainda não está no cache de análises (a análise em si é feita em ordem)."""
+    async with semaphore:
+        try:
+            key = raw_msg.get("key", {})
+            msg_content = raw_msg.get("message") or {}
+            media_info = msg_content[next(k for k in MEDIA_MESSAGE_KEYS if msg_content.get(k))]
+            role = "assistant" if key.get("fromMe") else "user"
+            async with SessionLocal() as session:
+                if await _find_cached_media(session, user_id, key.get("id"), media_info, role):
+                    return None
+            return await whatsapp_service.get_media_and_convert(instance_name, raw_msg)
+        except Exception as e:
+            logger.warning(f"Falha ao baixar antecipadamente a mídia da mensagem {raw_msg.get('key', {}).get('id')}: {e}")
+            return None
+
+def _iso_to_epoch(value: Any) -> Optional[int]:
+    try:
+        return int(datetime.fromisoformat(str(value)).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+def _incremental_since(prospect_contact: models.ProspectContact, db_history: List[Dict[str, Any]], processed_message_ids: set) -> Optional[int]:
+    """
+    messageTimestamp a partir do qual buscar as mensagens na Evolution, ou None para buscar o histórico completo
+    (contato sem marca de sincronização, ou cuja mensagem da marca não está mais no histórico salvo).
+    """
+    watermark_ts = prospect_contact.history_watermark_ts
+    if not watermark_ts or prospect_contact.history_watermark_id not in processed_message_ids:
+        return None
+    since = watermark_ts
+    # Mensagens enviadas ainda com ID temporário precisam voltar da Evolution com o ID real
+    for msg in db_history:
+        if str(msg.get('id', '')).startswith('sent_'):
+            sent_at = _iso_to_epoch(msg.get('timestamp'))
+            if sent_at:
+                since = min(since, sent_at)
+    return max(since - HISTORY_SYNC_OVERLAP_SECONDS, 0)
+
 def _get_sort_key(msg: Dict[str, Any]) -> str:
     """Helper para ordenar mensagens por timestamp, com fallback para o ID."""
     if msg.get("timestamp"):
@@ -139,9 +276,13 @@ async def _synchronize_and_process_history(
     whatsapp_service: WhatsAppService,
     gemini_service: GeminiService,
     mode: str = None,
-    whatsapp_instance: Optional[models.WhatsappInstance] = None
+    whatsapp_instance: Optional[models.WhatsappInstance] = None,
+    full_resync: bool = False
 ) -> List[Dict[str, Any]]:
-    
+    """
+    Sincroniza o histórico salvo do contato com as mensagens da Evolution. Por padrão busca apenas as mensagens
+    a partir da marca (messageTimestamp/ID) da última sincronização; 'full_resync' força a busca do histórico completo.
+    """
     # Prioriza a instância passada como argumento
     if not whatsapp_instance:
         whatsapp_instance = prospect_contact.whatsapp_instance
@@ -166,13 +307,13 @@ async def _synchronize_and_process_history(
         logger.info(f"Removendo/reprocessando {len(db_history) - len(clean_db_history)} mensagens temporárias ou sem ID.")
     
     processed_message_ids = {msg['id'] for msg in clean_db_history}
+    since_timestamp = None if full_resync else _incremental_since(prospect_contact, db_history, processed_message_ids)
     contact_details = await crud_prospect.get_contact_details_from_prospect_contact(db, prospect_contact.id)
 
     # --- Lógica de JID ---
-    target_jids = []
-    if prospect_contact.jid_options:
-        # jid_options agora é uma string separada por vírgulas
-        target_jids = [jid.strip() for jid in prospect_contact.jid_options.split(',') if jid.strip()]
+    # Mapeamento local (contact_jids); o jid_options (CSV) legado entra como semente até ser importado
+    legacy_jids = [jid.strip() for jid in (prospect_contact.jid_options or "").split(',') if jid.strip()]
+    target_jids = await whatsapp_service.resolve_contact_jids(db, contact_details.id, contact_details.whatsapp, seed_jids=legacy_jids)
     
     if not target_jids:
         # Tenta buscar na API
@@ -184,25 +325,18 @@ async def _synchronize_and_process_history(
                 if first_result.get("exists"):
                     found_jid = first_result.get("jid")
                     
-                    # Busca jidOptions no banco da Evolution usando o JID encontrado
-                    db_jid_options = await whatsapp_service.get_jid_options_from_db(whatsapp_instance.instance_name, found_jid)
-                    
-                    if db_jid_options:
-                        # Converte a lista de dicts para string CSV
-                        jid_list = [item.get("jid") for item in db_jid_options if isinstance(item, dict) and item.get("jid")]
-                        jid_options_str = ",".join(jid_list)
-                        await crud_prospect.update_prospect_contact(
-                            db, 
-                            pc_id=prospect_contact.id, 
-                            situacao=None, 
-                            jid_options=jid_options_str
-                        )
-                        target_jids = jid_list
-                        logger.info(f"JIDs encontrados no DB da Evolution e salvos: {target_jids}")
-                    else:
-                        # Fallback: Se não encontrar no DB, usa o JID retornado pela API
-                        target_jids = [found_jid]
-                        logger.warning(f"jidOptions não encontrado no DB para {found_jid}. Usando JID da API.")
+                    # Amplia com os jidOptions do banco da Evolution e salva no mapeamento local
+                    target_jids = await whatsapp_service.resolve_contact_jids(
+                        db, contact_details.id, contact_details.whatsapp, seed_jids=[found_jid]
+                    )
+                    # Mantém o jid_options (exibido e editável no frontend) em dia
+                    await crud_prospect.update_prospect_contact(
+                        db, 
+                        pc_id=prospect_contact.id, 
+                        situacao=None, 
+                        jid_options=",".join(target_jids)
+                    )
+                    logger.info(f"JIDs do contato salvos: {target_jids}")
         except Exception as e:
             logger.error(f"Erro ao verificar número no WhatsApp: {e}")
 
@@ -213,37 +347,35 @@ async def _synchronize_and_process_history(
         count=999, 
         mode=None,
         jids=target_jids,
-        evolution_instance_id=whatsapp_instance.instance_id
+        evolution_instance_id=whatsapp_instance.instance_id,
+        since_timestamp=since_timestamp,
+        expand_jids=False
     )
 
-    if not raw_history_api:
+    # Na sincronização incremental, nenhuma mensagem nova é o caso comum (não é falha de busca)
+    if not raw_history_api and since_timestamp is None:
         logger.warning("Não foi possível buscar o histórico da API. Tentando fallback de LID...")
         
-        lid_found = None
         # Filtra mensagens da IA que tenham conteúdo de texto significativo (evita 'Oi', 'Olá')
         # Usa db_history para incluir mensagens que talvez ainda estejam com ID temporário 'sent_'
-        ai_messages = [
-            msg for msg in db_history 
+        ai_contents = [
+            str(msg.get('content')) for msg in db_history 
             if msg.get('role') == 'assistant' and msg.get('content') and len(str(msg.get('content'))) > 5
         ]
         
-        # Itera do mais recente para o mais antigo
-        for msg in reversed(ai_messages):
-            content = msg.get('content')
-            found_jid = await whatsapp_service.find_lid_by_message_content(whatsapp_instance.instance_name, content)
-            if found_jid:
-                lid_found = found_jid
-                logger.info(f"Fallback LID: Encontrado {lid_found} através da mensagem '{content[:20]}...'")
-                break
+        # Todas as mensagens numa única consulta, priorizando a mais recente
+        lid_found = await whatsapp_service.find_lid_by_message_contents(whatsapp_instance.instance_name, list(reversed(ai_contents)))
+        if lid_found:
+            logger.info(f"Fallback LID: Encontrado {lid_found} através das mensagens enviadas.")
         
         if lid_found:
-            # Atualiza jid_options e tenta de novo
-            current_jids = []
-            if prospect_contact.jid_options:
-                current_jids = [j.strip() for j in prospect_contact.jid_options.split(',') if j.strip()]
+            # Salva o LID no mapeamento e no jid_options e tenta de novo
+            current_jids = list(target_jids)
             
             if lid_found not in current_jids:
-                current_jids.append(lid_found)
+                current_jids = await whatsapp_service.resolve_contact_jids(
+                    db, contact_details.id, contact_details.whatsapp, seed_jids=[lid_found]
+                )
                 new_jid_options = ",".join(current_jids)
                 
                 await crud_prospect.update_prospect_contact(
@@ -262,17 +394,22 @@ async def _synchronize_and_process_history(
                     count=999, 
                     mode=None,
                     jids=target_jids,
-                    evolution_instance_id=whatsapp_instance.instance_id
+                    evolution_instance_id=whatsapp_instance.instance_id,
+                    expand_jids=False
                 )
 
     if not raw_history_api:
-        logger.warning("Não foi possível buscar o histórico da API. Verifique a instância da Evolution API.")
+        if since_timestamp is None:
+            logger.warning("Não foi possível buscar o histórico da API. Verifique a instância da Evolution API.")
+        else:
+            logger.info(f"Sincronização incremental: nenhuma mensagem nova desde {since_timestamp}.")
         if len(db_history) > len(clean_db_history):
             await crud_prospect.update_prospect_contact_conversation(db, prospect_contact.id, json.dumps(clean_db_history))
         return clean_db_history
 
-    newly_processed_messages = []
-    total_tokens_used = 0
+    # Mensagens ainda não processadas, em ordem cronológica
+    new_raw_messages = []
+    fetched_marks = [] # (messageTimestamp, ID) de todas as mensagens retornadas, para a nova marca
     for raw_msg in reversed(raw_history_api):
         # Adiciona uma verificação para garantir que a mensagem é um dicionário.
         # A API da Evolution pode retornar um JSON string em vez de um objeto.
@@ -283,21 +420,62 @@ async def _synchronize_and_process_history(
                 logger.warning(f"Não foi possível decodificar a mensagem da API: {raw_msg}")
                 continue
         msg_id = raw_msg.get("key", {}).get("id")
+        if msg_id and isinstance(raw_msg.get("messageTimestamp"), int):
+            fetched_marks.append((raw_msg["messageTimestamp"], msg_id))
         if msg_id and msg_id not in processed_message_ids:
-            # --- CORREÇÃO: Atualizar o contexto a cada iteração ---
-            # O histórico de contexto (`current_context_history`) deve ser a soma do que já estava no banco
-            # com as mensagens que acabaram de ser processadas NESTA sincronização.
-            # Isso garante que, se houver dois áudios seguidos, a análise do segundo
-            # já terá o texto transcrito do primeiro como contexto.
-            current_context_history = clean_db_history + newly_processed_messages # A lista `newly_processed_messages` cresce a cada iteração.
-            
-            processed_msg, tokens_used = await _process_raw_message(
-                raw_msg, current_context_history, whatsapp_instance.instance_name, persona_config, whatsapp_service, gemini_service, db, user
-            )
+            new_raw_messages.append(raw_msg)
+
+    # Transcrições de áudio (que não usam o histórico como contexto) e downloads das demais mídias rodam em paralelo,
+    # limitados pelo semáforo. Só a análise de imagens/documentos fica em ordem, pois usa as mensagens anteriores como contexto.
+    semaphore = asyncio.Semaphore(settings.MEDIA_SYNC_CONCURRENCY)
+    media_tasks: Dict[int, asyncio.Task] = {}
+    for i, raw_msg in enumerate(new_raw_messages):
+        msg_content = raw_msg.get("message") or {}
+        if msg_content.get("audioMessage"):
+            media_tasks[i] = asyncio.create_task(_process_audio_message(
+                raw_msg, semaphore, whatsapp_instance.instance_name, persona_config, whatsapp_service, gemini_service, user
+            ))
+        elif any(msg_content.get(k) for k in MEDIA_MESSAGE_KEYS) and (settings.MEDIA_ANALYZE_STICKERS or not msg_content.get("stickerMessage")):
+            media_tasks[i] = asyncio.create_task(_prefetch_media(
+                raw_msg, semaphore, whatsapp_instance.instance_name, whatsapp_service, user.id
+            ))
+    if media_tasks:
+        logger.info(f"Sincronização: processando {len(media_tasks)} mídias em paralelo (limite {settings.MEDIA_SYNC_CONCURRENCY}).")
+
+    newly_processed_messages = []
+    total_tokens_used = 0
+    try:
+        for i, raw_msg in enumerate(new_raw_messages):
+            task = media_tasks.get(i)
+            if task and (raw_msg.get("message") or {}).get("audioMessage"):
+                processed_msg, tokens_used = await task
+            else:
+                # --- CORREÇÃO: Atualizar o contexto a cada iteração ---
+                # O histórico de contexto (`current_context_history`) deve ser a soma do que já estava no banco
+                # com as mensagens que acabaram de ser processadas NESTA sincronização.
+                # Isso garante que a análise de uma imagem enviada logo após um áudio
+                # já terá o texto transcrito do áudio como contexto.
+                current_context_history = clean_db_history + newly_processed_messages # A lista `newly_processed_messages` cresce a cada iteração.
+                prefetched_media = await task if task else None
+
+                processed_msg, tokens_used = await _process_raw_message(
+                    raw_msg, current_context_history, whatsapp_instance.instance_name, persona_config, whatsapp_service, gemini_service, db, user,
+                    media_data=prefetched_media
+                )
             if processed_msg: 
                 newly_processed_messages.append(processed_msg)
                 total_tokens_used += tokens_used
-    
+    finally:
+        for task in media_tasks.values():
+            task.cancel()
+
+    # A nova marca é a mensagem mais recente que está no histórico (mensagens ignoradas no processamento não contam)
+    history_ids = processed_message_ids | {msg.get('id') for msg in newly_processed_messages}
+    watermark = max((mark for mark in fetched_marks if mark[1] in history_ids), default=None)
+    current_watermark = (prospect_contact.history_watermark_ts, prospect_contact.history_watermark_id)
+    if watermark and current_watermark[0] and watermark[0] < current_watermark[0]:
+        watermark = None
+
     if newly_processed_messages:
         updated_history = clean_db_history + newly_processed_messages
         # Garante a ordem cronológica correta, usando um valor padrão para mensagens antigas sem timestamp
@@ -308,11 +486,14 @@ async def _synchronize_and_process_history(
             db, 
             prospect_contact.id, 
             json.dumps(updated_history),
-            tokens_to_add=total_tokens_used
+            tokens_to_add=total_tokens_used,
+            watermark=watermark
         )
         return updated_history
     else:
         logger.info(f"Sincronização concluída. Nenhuma alteração no histórico.")
+        if watermark and watermark != current_watermark:
+            await crud_prospect.update_history_watermark(db, prospect_contact.id, watermark)
         # Garante a ordem mesmo que não haja mensagens novas
         clean_db_history.sort(key=_get_sort_key)
         return clean_db_history
@@ -457,7 +638,14 @@ async def send_manual_message(
     instance = await db.get(models.WhatsappInstance, instance_id)
     contact = await db.get(models.Contact, pc.contact_id)
     
-    await whatsapp_service.send_text_message(instance.instance_name, contact.whatsapp, text)
+    sent = await whatsapp_service.send_text_message(instance.instance_name, contact.whatsapp, text)
+    # Captura o LID devolvido pela Evolution, se houver
+    try:
+        await crud_jid.record_message_key_jids(
+            contact.id, (sent or {}).get("key"), f"{whatsapp_service._normalize_number(contact.whatsapp)}@s.whatsapp.net"
+        )
+    except Exception as e:
+        logger.warning(f"Falha ao salvar os JIDs do envio para {contact.whatsapp}: {e}")
     
     history = json.loads(pc.conversa) if pc.conversa else []
     now_iso = datetime.now(timezone.utc).isoformat()
@@ -519,13 +707,43 @@ async def send_manual_media(
     items, _ = await crud_prospect.get_all_prospect_contacts(db, current_user.id, search=contact.whatsapp)
     return items[0] if items else {}
 
+@router.post("/contacts/{pc_id}/resync", summary="Ressincronizar o histórico completo de um contato")
+async def resync_contact_history(
+    pc_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(dependencies.get_current_active_user),
+    whatsapp_service: WhatsAppService = Depends(get_whatsapp_service)
+):
+    pc = await crud_prospect.get_prospect_contact_by_id(db, pc_id)
+    if not pc: raise HTTPException(status_code=404, detail="Contato não encontrado")
+
+    prospect = await db.get(models.Prospect, pc.prospect_id)
+    if prospect.user_id != current_user.id: raise HTTPException(status_code=403, detail="Acesso negado")
+
+    instance_id = pc.whatsapp_instance_id or (prospect.whatsapp_instance_ids[0] if prospect.whatsapp_instance_ids else None)
+    if not instance_id: raise HTTPException(status_code=400, detail="Instância não encontrada")
+    instance = await db.get(models.WhatsappInstance, instance_id)
+
+    persona_config = await crud_config.get_config(db, prospect.config_id, current_user.id)
+    if not persona_config: raise HTTPException(status_code=404, detail="Configuração da campanha não encontrada")
+
+    history = await _synchronize_and_process_history(
+        db=db, prospect_contact=pc, user=current_user, persona_config=persona_config,
+        whatsapp_service=whatsapp_service, gemini_service=get_gemini_service(),
+        whatsapp_instance=instance, full_resync=True
+    )
+    return {"status": "ok", "messages": len(history)}
+
 @router.get("/", response_model=List[Prospect], summary="Listar prospecções do usuário")
 async def get_prospects(db: AsyncSession = Depends(get_db), current_user: models.User = Depends(dependencies.get_current_active_user)):
     return await crud_prospect.get_prospects_by_user(db, user_id=current_user.id)
 
 @router.post("/", response_model=Prospect, status_code=201)
 async def create_prospect(prospect_data: ProspectCreate, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(dependencies.get_current_active_user)):
-    return await crud_prospect.create_prospect(db, prospect_in=prospect_data, user_id=current_user.id)
+    prospect = await crud_prospect.create_prospect(db, prospect_in=prospect_data, user_id=current_user.id)
+    # Mapeia os JIDs dos novos contatos para correlacioná-los na lista de conversas
+    await crud_jid.backfill_user_contact_jids(db, current_user.id, get_whatsapp_service()._normalize_number)
+    return prospect
 
 @router.get("/{prospect_id}/activity-log", response_model=List[schemas.ProspectActivityLog], summary="Obter o log de atividades de uma prospecção")
 async def get_prospect_activity_log(prospect_id: int, db: AsyncSession = Depends(get_db), current_user: models.User = Depends(dependencies.get_current_active_user)):
@@ -561,6 +779,8 @@ async def start_prospecting(prospect_id: int, background_tasks: BackgroundTasks,
         raise HTTPException(status_code=409, detail="Esta prospecção já está em andamento.")
     
     await crud_prospect.update_prospect(db, db_prospect=prospect, prospect_in=ProspectUpdate(status="Em Andamento"))
+    # Pré-gera as primeiras mensagens iniciais enquanto o worker não pega a campanha
+    background_tasks.add_task(pregenerate_initial_drafts, prospect.id)
     return {"message": "Campanha iniciada. O worker irá processá-la em breve."}
 
 @router.post("/{prospect_id}/stop", summary="Parar uma prospecção")
@@ -586,6 +806,8 @@ async def edit_prospect(prospect_id: int, prospect_in: ProspectUpdate, db: Async
         raise HTTPException(status_code=400, detail="Não é possível editar uma campanha em andamento. Pare-a primeiro.")
     
     updated_prospect = await crud_prospect.update_prospect_and_add_contacts(db, prospect=db_prospect, update_data=prospect_in)
+    if prospect_in.contact_ids_to_add:
+        await crud_jid.backfill_user_contact_jids(db, current_user.id, get_whatsapp_service()._normalize_number)
     return updated_prospect
 
 @router.delete("/{prospect_id}", summary="Excluir uma prospecção")
@@ -4,7 +4,7 @@ from datetime import datetime, timezone
 from fastapi import APIRouter, Request, HTTPException, BackgroundTasks
 
 from app.db.database import SessionLocal
-from app.crud import crud_user, crud_prospect
+from app.crud import crud_user, crud_prospect, crud_jid
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -36,7 +36,6 @@ async def process_webhook_message(data: dict):
             return
 
         contact_number = contact_number_full.split('@')[0]
-        normalized_contact_number = _normalize_number(contact_number)
         
         async with SessionLocal() as db:
             instance = await crud_user.get_whatsapp_instance_by_name(db, instance_name)
@@ -44,12 +43,29 @@ async def process_webhook_message(data: dict):
                 logger.warning(f"Webhook: Instância não encontrada no banco: {instance_name}")
                 return
 
-            prospect_info = await crud_prospect.find_prospect_contact_by_number(db, user_id=instance.user_id, number=normalized_contact_number)
-            if not prospect_info:
-                logger.info(f"Webhook: Contato {normalized_contact_number} não encontrado em nenhuma prospecção para o usuário {instance.user_id}.")
-                return
-            
-            _contact, prospect_contact, prospect = prospect_info
+            if "@lid" in contact_number_full:
+                # Mensagem só com o LID: correlaciona pelo mapeamento de JIDs (LIDs já capturados)
+                matches = await crud_jid.get_prospect_contacts_by_jids(db, instance.user_id, [contact_number_full])
+                if not matches:
+                    logger.info(f"Webhook: LID {contact_number_full} não mapeado para nenhum contato do usuário {instance.user_id}.")
+                    return
+                prospect_contact, _campaign_name = matches[contact_number_full]
+                phone_jid = None
+            else:
+                normalized_contact_number = _normalize_number(contact_number)
+                prospect_info = await crud_prospect.find_prospect_contact_by_number(db, user_id=instance.user_id, number=normalized_contact_number)
+                if not prospect_info:
+                    logger.info(f"Webhook: Contato {normalized_contact_number} não encontrado em nenhuma prospecção para o usuário {instance.user_id}.")
+                    return
+                
+                _contact, prospect_contact, prospect = prospect_info
+                phone_jid = f"{_normalize_number(_contact.whatsapp)}@s.whatsapp.net"
+
+            # Captura o LID (remoteJidAlt) direto da origem, para as próximas buscas de histórico
+            try:
+                await crud_jid.record_message_key_jids(prospect_contact.contact_id, key, phone_jid)
+            except Exception as e:
+                logger.warning(f"Webhook: Falha ao salvar os JIDs de {contact_number}: {e}")
 
             situacoes_de_parada = ["Conversa Manual", "Fechado", "Atendente Chamado"]
             if prospect_contact.situacao in situacoes_de_parada:
@@ -65,6 +81,12 @@ async def process_webhook_message(data: dict):
     except Exception as e:
         logger.error(f"Erro ao processar mensagem no webhook: {e}", exc_info=True)
 
+async def process_chat_summary(data: dict):
+    """Atualiza a conversa da mensagem na lista de conversas (recebidas e enviadas, inclusive de grupos)."""
+    from app.services.whatsapp_service import get_whatsapp_service
+
+    await get_whatsapp_service().record_chat_message(data.get('instance'), data.get('data', {}))
+
 async def process_connection_open(instance_name: str):
     """Processa evento de conexão aberta para verificar mensagens perdidas."""
     # Aguarda 5 minutos conforme solicitado antes de iniciar a varredura
@@ -76,6 +98,9 @@ async def process_connection_open(instance_name: str):
         instance = await crud_user.get_whatsapp_instance_by_name(db, instance_name)
         if instance:
             whatsapp_service = get_whatsapp_service()
+            # Mensagens recebidas enquanto a instância estava desconectada não passaram pelo webhook
+            if instance.instance_id:
+                await whatsapp_service.rebuild_chat_summaries(db, instance, mark_unread=True)
             await whatsapp_service.check_prospect_messages(db, instance.owner, instance_id=instance.id)
 
 @router.post("", summary="Receber eventos de webhook da Evolution API")
@@ -92,6 +117,9 @@ async def receive_evolution_webhook(request: Request, background_tasks: Backgrou
 
         is_connection_update = event == "connection.update"
 
+        if event == "messages.upsert":
+            background_tasks.add_task(process_chat_summary, data)
+
         if is_new_message:
             # Processa diretamente em background
             background_tasks.add_task(process_webhook_message, data)
@@ -104,6 +132,9 @@ async def receive_evolution_webhook(request: Request, background_tasks: Backgrou
                 background_tasks.add_task(process_connection_open, instance_name)
                 return {"status": "connection_checked"}
 
+        if event == "messages.upsert":
+            return {"status": "chat_updated"}
+
         return {"status": "event_ignored"}
     except Exception as e:
         logger.error(f"Erro ao processar corpo do webhook: {e}")
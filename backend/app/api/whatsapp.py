@@ -9,7 +9,7 @@ import base64
 from app.api import dependencies
 from app.db.database import get_db, SessionLocal
 from app.db import models, schemas
-from app.crud import crud_user
+from app.crud import crud_user, crud_jid, crud_chat
 from app.services.whatsapp_service import WhatsAppService, get_whatsapp_service
 
 router = APIRouter()
@@ -183,6 +183,8 @@ async def list_instance_chats(
     current_user: models.User = Depends(dependencies.get_current_active_user),
     whatsapp_service: WhatsAppService = Depends(get_whatsapp_service),
     limit: int = Query(100, description="Limite de conversas a retornar"),
+    before_ts: int | None = Query(None, description="Paginação: timestamp da última conversa da página anterior"),
+    before_jid: str | None = Query(None, description="Paginação: remoteJid da última conversa da página anterior"),
 ):
     instance = await crud_user.get_whatsapp_instance(db, instance_id, current_user.id)
     if not instance or not instance.instance_id:
@@ -190,10 +192,12 @@ async def list_instance_chats(
     
     # Agora o fetch_chats cuida de toda a lógica de correlação e enriquecimento
     return await whatsapp_service.fetch_chats(
-        instance.instance_id, 
-        limit=limit, 
-        db=db, 
-        user_id=current_user.id
+        db,
+        instance,
+        user_id=current_user.id,
+        limit=limit,
+        before_ts=before_ts,
+        before_jid=before_jid
     )
 
 @router.get("/{instance_id}/messages/{remote_jid}", summary="Obter histórico de mensagens de um JID (Evolution DB)")
@@ -209,7 +213,8 @@ async def get_chat_messages(
         raise HTTPException(status_code=404, detail="Instância não encontrada.")
     
     # Busca JIDs relacionados (jidOptions) antes de buscar o histórico
-    all_jids = await whatsapp_service.get_all_jids_for_contact(remote_jid)
+    # Mapeamento local primeiro; contatos fora da prospecção ainda consultam a Evolution
+    all_jids = await crud_jid.get_related_jids(db, current_user.id, remote_jid) or await whatsapp_service.get_all_jids_for_contact(remote_jid)
     
     raw_messages = await whatsapp_service.fetch_chat_history(
         instance_name=instance.instance_name,
@@ -217,6 +222,8 @@ async def get_chat_messages(
         jids=all_jids,
         evolution_instance_id=instance.instance_id
     )
+    # Conversa aberta: deixa de aparecer como não lida na lista
+    await crud_chat.mark_chat_read(db, instance.id, all_jids or [remote_jid])
     
     return [whatsapp_service.format_evolution_message(m) for m in reversed(raw_messages)]
 
@@ -27,6 +27,17 @@ class Settings(BaseSettings):
     EVOLUTION_API_KEY: str
     EVOLUTION_INSTANCE_NAME: str
     EVOLUTION_DATABASE_URL: str
+    # Cliente HTTP compartilhado da Evolution API (conexões keep-alive reaproveitadas)
+    EVOLUTION_HTTP_TIMEOUT: float = 10.0 # Prazo padrão; envios de mídia e afins têm prazos próprios
+    EVOLUTION_HTTP_MAX_CONNECTIONS: int = 50
+    EVOLUTION_HTTP_MAX_KEEPALIVE: int = 20
+    EVOLUTION_HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    EVOLUTION_HTTP2: bool = False # Requer o pacote 'h2'
+    # Pool de conexões com o banco da Evolution (leituras de histórico e conversas)
+    EVOLUTION_DB_POOL_MIN_SIZE: int = 1
+    EVOLUTION_DB_POOL_MAX_SIZE: int = 10
+    EVOLUTION_DB_STATEMENT_TIMEOUT_MS: int = 15000
+    EVOLUTION_DB_STATEMENT_CACHE_SIZE: int = 100 # 0 desliga os prepared statements (necessário atrás de pgbouncer em modo transaction)
 
     # Google
     GOOGLE_API_KEYS: str
@@ -44,6 +55,82 @@ class Settings(BaseSettings):
     ADMIN_EMAIL: str
     ADMIN_PASSWORD: str
 
+    # RAG: motor de busca vetorial ('pgvector' ou 'numpy')
+    RAG_ENGINE: str = "pgvector"
+    VECTOR_INDEX_DIR: str = "data/vector_index"
+    VECTOR_INDEX_DTYPE: str = "float32" # 'float32' ou 'float16'
+
+    # Log de prompts/respostas do Gemini (JSONL, escrito em background)
+    PROMPT_LOG_MODE: str = "full" # 'off', 'errors' ou 'full'
+    PROMPT_LOG_SAMPLE_RATE: float = 1.0
+    PROMPT_LOG_PATH: str = "logs/prompt_log.jsonl" # Cada processo grava o seu arquivo: logs/prompt_log.<papel>.jsonl
+    PROMPT_LOG_ROLE: str = "" # Papel do processo no nome do arquivo; vazio usa o nome do ponto de entrada (uvicorn, agent_worker...)
+    PROMPT_LOG_MAX_BYTES: int = 20 * 1024 * 1024
+    PROMPT_LOG_MAX_AGE_HOURS: int = 24
+    PROMPT_LOG_BACKUP_COUNT: int = 10
+    PROMPT_LOG_COMPRESS: bool = True
+    PROMPT_LOG_INCLUDE_SYSTEM: bool = False
+
+    # Compactação do histórico: últimas N mensagens literais + resumo acumulado das anteriores
+    HISTORY_VERBATIM_MESSAGES: int = 20
+    HISTORY_SUMMARY_STEP: int = 10 # O resumo só é refeito quando a janela avança esse número de mensagens
+
+    # Política de tentativas das chamadas ao Gemini
+    GEMINI_CALL_DEADLINE_SECONDS: float = 60.0 # Prazo total por chamada, incluindo novas tentativas
+    GEMINI_MAX_ATTEMPTS: int = 4 # Tentativas em erros transitórios (5xx, timeout, rede)
+    GEMINI_RETRY_BASE_DELAY: float = 0.5
+    GEMINI_RETRY_MAX_DELAY: float = 8.0
+    GEMINI_HEDGE_ENABLED: bool = False # Duplica em outra chave a requisição que passar do p95 de latência
+    GEMINI_HEDGE_MIN_SAMPLES: int = 20
+    GEMINI_STREAMING_ENABLED: bool = True # Respostas do worker em streaming (envio da 1ª parte antes do fim da geração)
+
+    # Geração de embeddings da base de conhecimento (lotes em paralelo entre as chaves de API)
+    EMBEDDING_BATCH_SIZE: int = 100
+    EMBEDDING_CONCURRENCY_PER_KEY: int = 2
+    EMBEDDING_MAX_ATTEMPTS: int = 6
+    EMBEDDING_RETRY_MAX_DELAY: float = 30.0 # Quotas por minuto precisam de esperas maiores
+
+    # Roteamento de modelos por tarefa (vazio = modelo padrão gemini-2.5-flash)
+    GEMINI_MODEL_INITIAL: str = ""
+    GEMINI_MODEL_REPLY: str = ""
+    GEMINI_MODEL_FOLLOWUP: str = ""
+    GEMINI_MODEL_TRANSCRIPTION: str = ""
+    GEMINI_MODEL_IMAGE_ANALYSIS: str = ""
+    GEMINI_MODEL_DASHBOARD_ANALYSIS: str = ""
+    # Cascata do follow-up: o modelo leve decide se é necessário; o modelo da rota 'followup' só escreve quando for
+    GEMINI_FOLLOWUP_CASCADE: bool = False
+    GEMINI_MODEL_FOLLOWUP_GATE: str = "gemini-2.5-flash-lite"
+
+    # Pré-geração das mensagens iniciais das campanhas
+    DRAFT_GENERATOR: str = "gemini" # 'gemini' ou 'fake' (gerador local, sem chamadas à API)
+    DRAFT_BATCH_SIZE: int = 20 # Quantos próximos contatos 'Aguardando Início' mantêm rascunho pronto
+    DRAFT_CONCURRENCY: int = 4
+    DRAFT_MAX_AGE_HOURS: int = 24
+    DRAFT_LEAD_MINUTES: int = 30 # Antecedência, em relação ao início do horário de funcionamento, para começar a pré-gerar
+
+    # Sincronização do histórico: downloads/transcrições de mídia simultâneos por contato
+    MEDIA_SYNC_CONCURRENCY: int = 4
+
+    # Pré-processamento das mídias com ffmpeg antes do envio ao Gemini
+    MEDIA_PREPROCESS_ENABLED: bool = True
+    MEDIA_PREPROCESS_WORKERS: int = 2 # Processos do pool do ffmpeg
+    MEDIA_AUDIO_BITRATE: str = "16k" # Opus mono 16 kHz
+    MEDIA_IMAGE_MAX_EDGE: int = 1536 # Maior lado (px) das imagens enviadas
+    MEDIA_ANALYZE_STICKERS: bool = False # Figurinhas só são analisadas pela IA se habilitado
+
+    # Cache das análises de dados de prospecção (mesma pergunta sobre os mesmos dados)
+    ANALYSIS_CACHE_TTL_SECONDS: int = 6 * 60 * 60
+
+    # Prazos da montagem do contexto da conversa (RAG e agenda são buscados em paralelo)
+    CONTEXT_RAG_TIMEOUT_SECONDS: float = 8.0
+    CONTEXT_CALENDAR_TIMEOUT_SECONDS: float = 5.0
+
+    # Mapeamento local contato <-> JIDs: após esse prazo os JIDs são conferidos de novo no IsOnWhatsapp da Evolution
+    CONTACT_JIDS_REFRESH_HOURS: int = 24
+
+    # Orçamento (estimado localmente) de tokens de entrada do prompt de conversação
+    PROMPT_TOKEN_BUDGET: int = 12000
+
     # Carrega as variáveis de um arquivo .env
     # Adicionado extra='ignore' para não falhar com variáveis extras no ambiente
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", extra="ignore")
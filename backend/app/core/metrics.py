@@ -0,0 +1,60 @@
+import bisect
+import threading
+from typing import Dict, Tuple
+
+# Limites (em ms) dos buckets dos histogramas de latência
+DEFAULT_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class Metrics:
+    """
+    Métricas simples em memória do processo (contadores e histogramas com rótulos).
+    Consultadas pelo endpoint de administração; cada processo (API, worker) mantém as suas.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], dict] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> Tuple[str, Tuple]:
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = {"count": 0, "sum": 0.0, "buckets": [0] * (len(DEFAULT_BUCKETS) + 1)}
+                self._histograms[key] = hist
+            hist["count"] += 1
+            hist["sum"] += value
+            hist["buckets"][bisect.bisect_left(DEFAULT_BUCKETS, value)] += 1
+
+    def snapshot(self) -> dict:
+        """Retorna uma cópia serializável de todas as métricas."""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._counters.items()
+            ]
+            histograms = []
+            for (name, labels), hist in self._histograms.items():
+                bounds = [str(b) for b in DEFAULT_BUCKETS] + ["+Inf"]
+                histograms.append({
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": hist["count"],
+                    "sum": round(hist["sum"], 3),
+                    "buckets": dict(zip(bounds, hist["buckets"]))
+                })
+        return {"counters": counters, "histograms": histograms}
+
+
+# Instância única das métricas para ser usada em toda a aplicação
+metrics = Metrics()
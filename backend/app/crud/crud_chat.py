@@ -0,0 +1,144 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import func, or_, and_, tuple_, true, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import Any, Dict, List, Optional
+from app.db import models
+from app.db.database import SessionLocal
+import logging
+
+logger = logging.getLogger(__name__)
+
+UPSERT_CHUNK_SIZE = 1000
+
+async def upsert_chat_summaries(db: AsyncSession, instance_id: int, summaries: List[Dict[str, Any]]):
+    """
+    Grava a última mensagem de cada conversa. Uma conversa existente só é atualizada se a mensagem for mais
+    recente (eventos fora de ordem não voltam o resumo). Nome e foto vazios não apagam os já conhecidos.
+    """
+    if not summaries:
+        return
+    for start in range(0, len(summaries), UPSERT_CHUNK_SIZE):
+        stmt = pg_insert(models.ChatSummary).values([
+            {**summary, "whatsapp_instance_id": instance_id} for summary in summaries[start:start + UPSERT_CHUNK_SIZE]
+        ])
+        current = models.ChatSummary.__table__.c
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[models.ChatSummary.whatsapp_instance_id, models.ChatSummary.remote_jid],
+            set_={
+                "name": func.coalesce(stmt.excluded.name, current.name),
+                "profile_pic_url": func.coalesce(stmt.excluded.profile_pic_url, current.profile_pic_url),
+                "last_message": stmt.excluded.last_message,
+                "last_message_id": stmt.excluded.last_message_id,
+                "last_message_ts": stmt.excluded.last_message_ts,
+                "last_message_from_me": stmt.excluded.last_message_from_me,
+                "last_message_sender": stmt.excluded.last_message_sender,
+                "status": stmt.excluded.status,
+                "unread": stmt.excluded.unread,
+                "updated_at": func.now(),
+            },
+            where=or_(
+                stmt.excluded.last_message_ts > current.last_message_ts,
+                and_(
+                    stmt.excluded.last_message_ts == current.last_message_ts,
+                    stmt.excluded.last_message_id.is_distinct_from(current.last_message_id)
+                )
+            )
+        ))
+    await db.commit()
+
+async def record_chat_message(instance_name: str, summary: Dict[str, Any], jids: List[str]):
+    """
+    Atualiza o resumo da conversa com uma mensagem do webhook ou da resposta de um envio.
+    'jids' são os JIDs da mensagem (remoteJid/remoteJidAlt): a conversa já existente com algum deles é mantida,
+    para que as mensagens com e sem o LID no 'key' caiam na mesma conversa.
+    Usa uma sessão própria para não comitar alterações pendentes da sessão do chamador.
+    """
+    async with SessionLocal() as session:
+        instance_id = await session.scalar(
+            select(models.WhatsappInstance.id).where(models.WhatsappInstance.instance_name == instance_name)
+        )
+        if not instance_id:
+            return
+        existing_jid = await session.scalar(
+            select(models.ChatSummary.remote_jid)
+            .where(models.ChatSummary.whatsapp_instance_id == instance_id, models.ChatSummary.remote_jid.in_(jids))
+            .limit(1)
+        )
+        if existing_jid:
+            summary = {**summary, "remote_jid": existing_jid}
+        await upsert_chat_summaries(session, instance_id, [summary])
+
+async def mark_chat_summaries_built(db: AsyncSession, instance_id: int):
+    await db.execute(
+        update(models.WhatsappInstance)
+        .where(models.WhatsappInstance.id == instance_id)
+        .values(chat_summaries_built_at=func.now())
+    )
+    await db.commit()
+
+async def mark_chat_read(db: AsyncSession, instance_id: int, remote_jids: List[str]):
+    await db.execute(
+        update(models.ChatSummary)
+        .where(
+            models.ChatSummary.whatsapp_instance_id == instance_id,
+            models.ChatSummary.remote_jid.in_(remote_jids),
+            models.ChatSummary.unread.is_(True)
+        )
+        .values(unread=False)
+    )
+    await db.commit()
+
+async def get_chat_summaries(db: AsyncSession, instance_id: int, user_id: int, limit: int = 100, before_ts: Optional[int] = None, before_jid: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Lista as conversas da instância, mais recentes primeiro, numa única consulta pelo índice (instância, timestamp, JID).
+    Paginação por chave: a próxima página começa depois do (timestamp, remoteJid) da última conversa recebida.
+    A situação e a campanha vêm do contato de prospecção ligado ao JID (contact_jids) no momento da leitura.
+    """
+    prospect_match = (
+        select(
+            models.ProspectContact.id.label("prospect_contact_id"),
+            models.ProspectContact.situacao,
+            models.ProspectContact.observacoes,
+            models.Prospect.nome_prospeccao.label("campanha"),
+        )
+        .join(models.ContactJid, models.ContactJid.contact_id == models.ProspectContact.contact_id)
+        .join(models.Prospect, models.ProspectContact.prospect_id == models.Prospect.id)
+        .where(models.ContactJid.jid == models.ChatSummary.remote_jid, models.Prospect.user_id == user_id)
+        .order_by(models.ProspectContact.updated_at.desc())
+        .limit(1)
+        .lateral()
+    )
+    query = (
+        select(models.ChatSummary, prospect_match)
+        .outerjoin(prospect_match, true())
+        .where(models.ChatSummary.whatsapp_instance_id == instance_id)
+    )
+    if before_ts is not None:
+        query = query.where(
+            tuple_(models.ChatSummary.last_message_ts, models.ChatSummary.remote_jid) < tuple_(before_ts, before_jid or "")
+        )
+    result = await db.execute(
+        query.order_by(models.ChatSummary.last_message_ts.desc(), models.ChatSummary.remote_jid.desc()).limit(limit)
+    )
+
+    return [
+        {
+            "id": chat.remote_jid,
+            "remoteJid": chat.remote_jid,
+            "name": chat.name or chat.remote_jid.split("@")[0],
+            "profilePicUrl": chat.profile_pic_url,
+            "isGroup": "@g.us" in chat.remote_jid,
+            "lastMessage": chat.last_message,
+            "timestamp": chat.last_message_ts,
+            "status": chat.status,
+            "fromMe": chat.last_message_from_me,
+            "lastMessageSender": chat.last_message_sender,
+            "unread": chat.unread,
+            "situacao": situacao,
+            "campanha": campanha,
+            "prospect_contact_id": prospect_contact_id,
+            "observacoes": observacoes,
+        }
+        for chat, prospect_contact_id, situacao, observacoes, campanha in result.all()
+    ]
@@ -0,0 +1,146 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import delete, exists
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+from app.db import models
+from app.db.database import SessionLocal
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Contatos importados do jid_options legado ainda não foram conferidos no IsOnWhatsapp
+NEVER_REFRESHED = datetime(1970, 1, 1, tzinfo=timezone.utc)
+BACKFILL_CHUNK_SIZE = 5000
+
+def jid_kind(jid: str, phone_jid: Optional[str] = None) -> str:
+    if jid.endswith("@lid"):
+        return "lid"
+    return "phone" if jid == phone_jid else "alt"
+
+def jids_from_message_key(key: Optional[dict]) -> List[str]:
+    """JIDs de conversa individual de um 'key' de mensagem da Evolution (remoteJid e remoteJidAlt)."""
+    jids = [(key or {}).get("remoteJid"), (key or {}).get("remoteJidAlt")]
+    return [jid for jid in dict.fromkeys(jids) if jid and jid.endswith(("@s.whatsapp.net", "@lid"))]
+
+async def get_contact_jids(db: AsyncSession, contact_id: int) -> List[models.ContactJid]:
+    """JIDs do contato, com o JID do número primeiro."""
+    result = await db.execute(
+        select(models.ContactJid)
+        .where(models.ContactJid.contact_id == contact_id)
+        .order_by(models.ContactJid.kind != "phone", models.ContactJid.id)
+    )
+    return result.scalars().all()
+
+async def save_contact_jids(db: AsyncSession, contact_id: int, jids: List[str], phone_jid: Optional[str] = None, remove: Optional[List[str]] = None):
+    """Insere os JIDs do contato (ou renova os existentes) num único comando e remove os JIDs descartados."""
+    if remove:
+        await db.execute(
+            delete(models.ContactJid).where(models.ContactJid.contact_id == contact_id, models.ContactJid.jid.in_(remove))
+        )
+    if not jids:
+        await db.commit()
+        return
+    refreshed_at = datetime.now(timezone.utc)
+    stmt = pg_insert(models.ContactJid).values([
+        {"contact_id": contact_id, "jid": jid, "kind": jid_kind(jid, phone_jid), "refreshed_at": refreshed_at}
+        for jid in dict.fromkeys(jids)
+    ])
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[models.ContactJid.contact_id, models.ContactJid.jid],
+        set_={"kind": stmt.excluded.kind, "refreshed_at": stmt.excluded.refreshed_at}
+    ))
+    await db.commit()
+
+async def record_message_key_jids(contact_id: int, key: Optional[dict], phone_jid: Optional[str] = None) -> List[str]:
+    """
+    Salva os JIDs de uma mensagem do contato (webhook ou resposta de envio) quando ela traz um LID.
+    São JIDs confirmados pelo próprio WhatsApp, então entram como conferidos. Retorna os JIDs novos.
+    Usa uma sessão própria para não comitar alterações pendentes da sessão do chamador.
+    """
+    jids = jids_from_message_key(key)
+    if not any(jid.endswith("@lid") for jid in jids):
+        return []
+    refreshed_at = datetime.now(timezone.utc)
+    async with SessionLocal() as session:
+        result = await session.execute(
+            pg_insert(models.ContactJid)
+            .values([{"contact_id": contact_id, "jid": jid, "kind": jid_kind(jid, phone_jid), "refreshed_at": refreshed_at} for jid in jids])
+            .on_conflict_do_nothing()
+            .returning(models.ContactJid.jid)
+        )
+        new_jids = list(result.scalars().all())
+        await session.commit()
+    if new_jids:
+        logger.info(f"Mapeamento de JIDs: {new_jids} capturados para o contato {contact_id}.")
+    return new_jids
+
+async def get_prospect_contacts_by_jids(db: AsyncSession, user_id: int, jids: List[str]) -> Dict[str, Tuple[models.ProspectContact, str]]:
+    """
+    Correlaciona JIDs com os contatos de prospecção do usuário (uma consulta pelo índice de contact_jids).
+    Retorna {jid: (ProspectContact, nome da campanha)}, priorizando o contato atualizado mais recentemente.
+    """
+    if not jids:
+        return {}
+    result = await db.execute(
+        select(models.ContactJid.jid, models.ProspectContact, models.Prospect.nome_prospeccao)
+        .join(models.ProspectContact, models.ProspectContact.contact_id == models.ContactJid.contact_id)
+        .join(models.Prospect, models.ProspectContact.prospect_id == models.Prospect.id)
+        .where(models.ContactJid.jid.in_(jids), models.Prospect.user_id == user_id)
+        .order_by(models.ProspectContact.updated_at.desc())
+    )
+    matches = {}
+    for jid, pc, campaign_name in result.all():
+        matches.setdefault(jid, (pc, campaign_name))
+    return matches
+
+async def get_related_jids(db: AsyncSession, user_id: int, jid: str) -> List[str]:
+    """Todos os JIDs dos contatos do usuário que têm o JID informado (inclui o próprio JID)."""
+    contact_ids = (
+        select(models.ContactJid.contact_id)
+        .join(models.Contact, models.Contact.id == models.ContactJid.contact_id)
+        .where(models.ContactJid.jid == jid, models.Contact.user_id == user_id)
+    )
+    result = await db.execute(
+        select(models.ContactJid.jid).where(models.ContactJid.contact_id.in_(contact_ids)).distinct()
+    )
+    jids = result.scalars().all()
+    return list(dict.fromkeys([jid, *jids])) if jids else []
+
+async def backfill_user_contact_jids(db: AsyncSession, user_id: int, normalize_number: Callable[[str], str]) -> int:
+    """
+    Cria o mapeamento dos contatos em prospecção do usuário que ainda não têm JIDs salvos, a partir do número
+    e do jid_options (CSV) legado. Esses JIDs são conferidos no IsOnWhatsapp na próxima sincronização do contato.
+    """
+    result = await db.execute(
+        select(models.Contact.id, models.Contact.whatsapp, models.ProspectContact.jid_options)
+        .join(models.ProspectContact, models.ProspectContact.contact_id == models.Contact.id)
+        .where(
+            models.Contact.user_id == user_id,
+            ~exists().where(models.ContactJid.contact_id == models.Contact.id)
+        )
+    )
+    jids_by_contact: Dict[int, Tuple[Optional[str], Dict[str, None]]] = {}
+    for contact_id, whatsapp, jid_options in result.all():
+        phone_jid = f"{normalize_number(whatsapp)}@s.whatsapp.net" if whatsapp else None
+        _, jids = jids_by_contact.setdefault(contact_id, (phone_jid, {}))
+        if phone_jid:
+            jids[phone_jid] = None
+        for jid in (jid_options or "").split(","):
+            if jid.strip():
+                jids[jid.strip()] = None
+
+    values = [
+        {"contact_id": contact_id, "jid": jid, "kind": jid_kind(jid, phone_jid), "refreshed_at": NEVER_REFRESHED}
+        for contact_id, (phone_jid, jids) in jids_by_contact.items()
+        for jid in jids
+    ]
+    if not values:
+        return 0
+    # Lotes limitados pelo máximo de parâmetros por comando do Postgres
+    for start in range(0, len(values), BACKFILL_CHUNK_SIZE):
+        await db.execute(pg_insert(models.ContactJid).values(values[start:start + BACKFILL_CHUNK_SIZE]).on_conflict_do_nothing())
+    await db.commit()
+    logger.info(f"Mapeamento de JIDs: {len(values)} JIDs de {len(jids_by_contact)} contatos importados para o usuário {user_id}.")
+    return len(values)
@@ -0,0 +1,42 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import Optional
+from app.db import models
+from app.db.database import SessionLocal
+import logging
+
+logger = logging.getLogger(__name__)
+
+async def get_media_analysis(db: AsyncSession, user_id: int, message_id: Optional[str] = None, sha256: Optional[str] = None, include_outbound: bool = True) -> models.MediaAnalysis | None:
+    """
+    Busca uma análise de mídia já feita pelo usuário, pelo ID da mensagem ou pelo hash do conteúdo.
+    Com include_outbound=False, a busca por hash ignora os arquivos enviados pelo próprio sistema.
+    """
+    if message_id:
+        result = await db.execute(
+            select(models.MediaAnalysis).where(models.MediaAnalysis.user_id == user_id, models.MediaAnalysis.message_id == message_id)
+        )
+        cached = result.scalars().first()
+        if cached:
+            return cached
+    if sha256:
+        stmt = select(models.MediaAnalysis).where(models.MediaAnalysis.user_id == user_id, models.MediaAnalysis.sha256 == sha256)
+        if not include_outbound:
+            stmt = stmt.where(models.MediaAnalysis.outbound.is_(False))
+        result = await db.execute(stmt.limit(1))
+        return result.scalars().first()
+    return None
+
+async def save_media_analysis(user_id: int, message_id: str, sha256: Optional[str], mime_type: Optional[str], content: str, tokens_used: int = 0, outbound: bool = False):
+    """
+    Grava a análise no cache do usuário (ignora se o ID da mensagem já existir para ele).
+    Usa uma sessão própria para não comitar alterações pendentes da sessão do chamador.
+    """
+    async with SessionLocal() as session:
+        await session.execute(
+            pg_insert(models.MediaAnalysis)
+            .values(user_id=user_id, message_id=message_id, sha256=sha256, mime_type=mime_type, content=content, tokens_used=tokens_used, outbound=outbound)
+            .on_conflict_do_nothing(index_elements=[models.MediaAnalysis.user_id, models.MediaAnalysis.message_id])
+        )
+        await session.commit()
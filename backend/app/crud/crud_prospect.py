@@ -30,6 +30,57 @@ async def get_prospects_by_user(db: AsyncSession, user_id: int) -> List[models.P
     )
     return result.scalars().unique().all()
 
+async def get_prospecting_summary(
+    db: AsyncSession,
+    user_id: int,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    prospect_ids: Optional[List[int]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Resumo por prospecção (totais de contatos por situação) calculado no banco, com GROUP BY,
+    sem carregar os contatos nem as conversas. Usado pela análise de dados com IA.
+    """
+    pc = models.ProspectContact
+    stmt = (
+        select(
+            models.Prospect.id,
+            models.Prospect.nome_prospeccao,
+            models.Prospect.status,
+            models.Prospect.created_at,
+            func.count(pc.id).label("total"),
+            func.count(pc.id).filter(pc.situacao == "Concluído").label("concluido"),
+            func.count(pc.id).filter(pc.situacao == "Lead Qualificado").label("lead_qualificado"),
+            func.count(pc.id).filter(pc.situacao == "Aguardando Resposta").label("aguardando_resposta"),
+        )
+        .outerjoin(pc, pc.prospect_id == models.Prospect.id)
+        .where(models.Prospect.user_id == user_id)
+        .group_by(models.Prospect.id)
+        .order_by(models.Prospect.created_at.desc())
+    )
+    # Datas sem fuso são tratadas como UTC
+    if start_date:
+        stmt = stmt.where(models.Prospect.created_at >= (start_date if start_date.tzinfo else start_date.replace(tzinfo=timezone.utc)))
+    if end_date:
+        stmt = stmt.where(models.Prospect.created_at <= (end_date if end_date.tzinfo else end_date.replace(tzinfo=timezone.utc)))
+    if prospect_ids:
+        stmt = stmt.where(models.Prospect.id.in_(prospect_ids))
+
+    result = await db.execute(stmt)
+    return [
+        {
+            "id": row.id, "nome": row.nome_prospeccao, "status": row.status,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+            "contacts_summary": {
+                "total": row.total,
+                "concluido": row.concluido,
+                "lead_qualificado": row.lead_qualificado,
+                "aguardando_resposta": row.aguardando_resposta,
+            }
+        }
+        for row in result.all()
+    ]
+
 async def create_prospect(db: AsyncSession, prospect_in: ProspectCreate, user_id: int) -> models.Prospect:
     """Cria uma nova prospecção e associa os contatos iniciais."""
     db_prospect = models.Prospect(
@@ -281,13 +332,22 @@ async def update_prospect_contact_status(db: AsyncSession, pc_id: int, situacao:
         prospect_contact.updated_at = datetime.now(timezone.utc)
         await db.commit()
 
-async def update_prospect_contact_conversation(db: AsyncSession, pc_id: int, conversa: str, tokens_to_add: Optional[int] = None):
-    """Atualiza o histórico de conversa e opcionalmente adiciona tokens ao uso total."""
+async def update_prospect_contact_conversation(db: AsyncSession, pc_id: int, conversa: str, tokens_to_add: Optional[int] = None, watermark: Optional[Tuple[int, str]] = None):
+    """Atualiza o histórico de conversa e opcionalmente adiciona tokens ao uso total e avança a marca de sincronização."""
     prospect_contact = await db.get(models.ProspectContact, pc_id)
     if prospect_contact:
         prospect_contact.conversa = conversa
         if tokens_to_add and tokens_to_add > 0:
             prospect_contact.token_usage = (prospect_contact.token_usage or 0) + tokens_to_add
+        if watermark:
+            prospect_contact.history_watermark_ts, prospect_contact.history_watermark_id = watermark
+        await db.commit()
+
+async def update_history_watermark(db: AsyncSession, pc_id: int, watermark: Tuple[int, str]):
+    """Avança a marca (messageTimestamp/ID) da última mensagem sincronizada, sem mexer no histórico."""
+    prospect_contact = await db.get(models.ProspectContact, pc_id)
+    if prospect_contact:
+        prospect_contact.history_watermark_ts, prospect_contact.history_watermark_id = watermark
         await db.commit()
 
 async def get_contact_details_from_prospect_contact(db: AsyncSession, pc_id: int) -> Optional[models.Contact]:
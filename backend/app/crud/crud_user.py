@@ -1,6 +1,10 @@
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import update, func, case
 from sqlalchemy.future import select
+from datetime import datetime
+from typing import Optional
 from app.db import models
+from app.db.database import SessionLocal
 from app.db.schemas import UserCreate, UserUpdate, WhatsappInstanceCreate, WhatsappInstanceUpdate
 from app.services.security import get_password_hash
 import logging
@@ -57,15 +61,68 @@ async def update_user(db: AsyncSession, db_user: models.User, user_in: UserUpdat
     return db_user
 # --- FIM DA CORREÇÃO ---
 
-async def decrement_user_tokens(db: AsyncSession, *, db_user: models.User, amount: int = 1):
-    """Decrementa os tokens de um usuário pela quantidade especificada."""
-    if db_user.tokens is not None and db_user.tokens >= amount:
-        db_user.tokens -= amount
-        await db.commit()
-        await db.refresh(db_user)
-        logger.info(f"DEBUG: {amount} token(s) deduzido(s) do usuário {db_user.id}. Restantes: {db_user.tokens}")
+async def decrement_user_tokens(user_id: int, amount: int, *, model: Optional[str] = None, input_tokens: int = 0, output_tokens: int = 0) -> Optional[int]:
+    """
+    Debita o saldo do usuário com um UPDATE atômico e registra o consumo no ledger (token_usage),
+    marcando se o valor foi de fato debitado. Usa uma sessão própria para não comitar alterações
+    pendentes da sessão do chamador. Retorna o saldo restante, ou None se o usuário não tinha tokens suficientes.
+    """
+    async with SessionLocal() as session:
+        result = await session.execute(
+            update(models.User)
+            .where(models.User.id == user_id, models.User.tokens >= amount)
+            .values(tokens=models.User.tokens - amount)
+            .returning(models.User.tokens)
+        )
+        remaining = result.scalar_one_or_none()
+        session.add(models.TokenUsage(
+            user_id=user_id,
+            model=model,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            tokens=amount,
+            debited=remaining is not None
+        ))
+        await session.commit()
+
+    if remaining is None:
+        logger.warning(f"Usuário {user_id} não possui tokens suficientes para deduzir {amount} token(s).")
     else:
-        logger.warning(f"Usuário {db_user.id} não possui tokens suficientes para deduzir {amount} token(s).")
+        logger.info(f"DEBUG: {amount} token(s) deduzido(s) do usuário {user_id}. Restantes: {remaining}")
+    return remaining
+
+async def get_token_usage_by_day(db: AsyncSession, user_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None) -> list[dict]:
+    """
+    Agrega o consumo de tokens do usuário por dia a partir do ledger. 'tokens' soma apenas o que foi debitado
+    do saldo; 'undebited_tokens', o custo das chamadas feitas com saldo insuficiente.
+    """
+    day = func.date_trunc('day', models.TokenUsage.created_at).label("day")
+    stmt = select(
+        day,
+        func.count(models.TokenUsage.id).label("calls"),
+        func.sum(models.TokenUsage.input_tokens).label("input_tokens"),
+        func.sum(models.TokenUsage.output_tokens).label("output_tokens"),
+        func.sum(case((models.TokenUsage.debited, models.TokenUsage.tokens), else_=0)).label("tokens"),
+        func.sum(case((models.TokenUsage.debited, 0), else_=models.TokenUsage.tokens)).label("undebited_tokens")
+    ).where(models.TokenUsage.user_id == user_id)
+    if start:
+        stmt = stmt.where(models.TokenUsage.created_at >= start)
+    if end:
+        stmt = stmt.where(models.TokenUsage.created_at < end)
+    stmt = stmt.group_by(day).order_by(day)
+
+    result = await db.execute(stmt)
+    return [
+        {
+            "day": row.day.date(),
+            "calls": row.calls,
+            "input_tokens": row.input_tokens or 0,
+            "output_tokens": row.output_tokens or 0,
+            "tokens": row.tokens or 0,
+            "undebited_tokens": row.undebited_tokens or 0
+        }
+        for row in result.all()
+    ]
 
 # --- Whatsapp Instances CRUD ---
 
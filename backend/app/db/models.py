@@ -1,4 +1,4 @@
-from sqlalchemy import ( Column, Integer, String, ForeignKey, Text, DateTime, func, ARRAY, Time, Boolean )
+from sqlalchemy import ( Column, Integer, String, ForeignKey, Text, DateTime, func, ARRAY, Time, Boolean, BigInteger, UniqueConstraint, Index )
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.dialects.postgresql import JSONB
 from typing import List, Optional
@@ -41,6 +41,7 @@ class WhatsappInstance(Base):
     interval_seconds: Mapped[int] = mapped_column(Integer, default=60)
     last_message_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
+    chat_summaries_built_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True, comment="Última reconstrução da lista de conversas (chat_summaries) a partir da Evolution")
 
     owner: Mapped["User"] = relationship(back_populates="whatsapp_instances")
     prospect_contacts: Mapped[List["ProspectContact"]] = relationship(back_populates="whatsapp_instance")
@@ -75,6 +76,8 @@ class Config(Base):
     google_calendar_credentials: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True)
     available_hours: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True, comment="Horários disponíveis para agendamento")
     is_calendar_active: Mapped[bool] = mapped_column(Boolean, default=False)
+    rag_version: Mapped[int] = mapped_column(Integer, default=0, server_default="0", comment="Versão dos vetores, incrementada a cada sincronização")
+    initial_rag_context: Mapped[Optional[str]] = mapped_column(Text, nullable=True, comment="Contexto RAG pré-formatado para mensagens iniciais (recalculado a cada sincronização)")
     
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
 
@@ -131,7 +134,77 @@ class ProspectContact(Base):
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     last_notification_message_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     whatsapp_instance_id: Mapped[Optional[int]] = mapped_column(ForeignKey("whatsapp_instances.id"), nullable=True)
+    history_reset_anchor: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True, comment="Último /reset da conversa (ID, timestamp e posição da mensagem)")
+    history_summary: Mapped[Optional[str]] = mapped_column(Text, nullable=True, comment="Resumo acumulado das mensagens fora da janela literal")
+    history_summary_anchor: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True, comment="Última mensagem coberta pelo resumo (ID, timestamp e posição)")
+    initial_draft: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True, comment="Mensagem inicial pré-gerada (resposta da IA + versão do RAG)")
+    initial_draft_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    history_watermark_ts: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True, comment="messageTimestamp da mensagem mais recente já sincronizada")
+    history_watermark_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True, comment="ID da mensagem mais recente já sincronizada")
     
     prospect = relationship("Prospect", back_populates="contacts")
     contact = relationship("Contact")
     whatsapp_instance = relationship("WhatsappInstance", back_populates="prospect_contacts")
+
+class TokenUsage(Base):
+    """Registro (append-only) de consumo de tokens por chamada ao Gemini."""
+    __tablename__ = "token_usage"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    model: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
+    input_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    output_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    tokens: Mapped[int] = mapped_column(Integer, nullable=False, comment="Custo equivalente da chamada")
+    debited: Mapped[bool] = mapped_column(Boolean, default=True, server_default="true", comment="Se o custo foi de fato deduzido do saldo (False quando o saldo era insuficiente)")
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+class ContactJid(Base):
+    """JIDs conhecidos de um contato no WhatsApp (número, LID e variações do IsOnWhatsapp da Evolution)."""
+    __tablename__ = "contact_jids"
+    __table_args__ = (UniqueConstraint("contact_id", "jid", name="uq_contact_jids_contact_jid"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    contact_id: Mapped[int] = mapped_column(ForeignKey("contacts.id", ondelete="CASCADE"), index=True)
+    jid: Mapped[str] = mapped_column(String(255), index=True)
+    kind: Mapped[str] = mapped_column(String(10), comment="'phone', 'lid' ou 'alt'")
+    refreshed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), comment="Última conferência no IsOnWhatsapp")
+
+class MediaAnalysis(Base):
+    """Cache persistente das transcrições/análises de mídia (por ID da mensagem e por hash do conteúdo), por usuário."""
+    __tablename__ = "media_analyses"
+    # A análise usa a persona, o RAG e o histórico do usuário: não pode ser reaproveitada por outro usuário
+    __table_args__ = (UniqueConstraint("user_id", "message_id", name="uq_media_analyses_user_message"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=True)
+    message_id: Mapped[str] = mapped_column(String(255), index=True)
+    sha256: Mapped[Optional[str]] = mapped_column(String(64), index=True, nullable=True, comment="SHA-256 (hex) dos bytes da mídia")
+    mime_type: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
+    content: Mapped[str] = mapped_column(Text, nullable=False, comment="Transcrição do áudio ou análise da imagem/documento")
+    tokens_used: Mapped[int] = mapped_column(Integer, default=0)
+    outbound: Mapped[bool] = mapped_column(Boolean, default=False, server_default="false", comment="Arquivo enviado pelo próprio sistema (não é analisado pela IA)")
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+class ChatSummary(Base):
+    """Resumo de cada conversa de uma instância (última mensagem), mantido pelos webhooks e envios para a lista de conversas."""
+    __tablename__ = "chat_summaries"
+    __table_args__ = (
+        UniqueConstraint("whatsapp_instance_id", "remote_jid", name="uq_chat_summaries_instance_jid"),
+        # Paginação por chave (last_message_ts, remote_jid) da lista de conversas, mais recentes primeiro
+        Index("ix_chat_summaries_instance_ts_jid", "whatsapp_instance_id", "last_message_ts", "remote_jid"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    whatsapp_instance_id: Mapped[int] = mapped_column(ForeignKey("whatsapp_instances.id", ondelete="CASCADE"))
+    remote_jid: Mapped[str] = mapped_column(String(255))
+    name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    profile_pic_url: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    last_message: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    last_message_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    last_message_ts: Mapped[int] = mapped_column(BigInteger, comment="messageTimestamp (epoch em segundos) da última mensagem")
+    last_message_from_me: Mapped[bool] = mapped_column(Boolean, default=False)
+    last_message_sender: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    status: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
+    unread: Mapped[bool] = mapped_column(Boolean, default=False, server_default="false")
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
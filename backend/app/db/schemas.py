@@ -1,6 +1,6 @@
 from pydantic import BaseModel, EmailStr, computed_field
 from typing import List, Optional, Dict, Any
-from datetime import datetime, time
+from datetime import datetime, time, date
 
 # --- Schemas de Contato ---
 class ContactBase(BaseModel):
@@ -221,6 +221,14 @@ class UserAdminDetail(User):
     prospects: List[ProspectSimple] = []
     configs: List[Config] = []
 
+class TokenUsageDaily(BaseModel):
+    day: date
+    calls: int
+    input_tokens: int
+    output_tokens: int
+    tokens: int
+    undebited_tokens: int = 0
+
 # --- Schemas de Token ---
 class Token(BaseModel):
     access_token: str
@@ -18,6 +18,8 @@ from app.api import google as google_contacts_router
 
 from app.db.database import engine
 from app.db import models
+from app.services.media_preprocessor import get_media_preprocessor
+from app.services.whatsapp_service import get_whatsapp_service
 
 # Carrega as variáveis de ambiente do arquivo .env
 # Isso deve ser feito antes de acessar as variáveis
@@ -27,6 +29,40 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Colunas adicionadas após a criação inicial das tabelas.
+# O create_all não altera tabelas existentes, então aplicamos os ALTERs de forma idempotente.
+SCHEMA_PATCHES = [
+    "ALTER TABLE configs ADD COLUMN IF NOT EXISTS rag_version INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE configs ADD COLUMN IF NOT EXISTS initial_rag_context TEXT",
+    "ALTER TABLE prospect_contacts ADD COLUMN IF NOT EXISTS history_summary TEXT",
+    "ALTER TABLE prospect_contacts ADD COLUMN IF NOT EXISTS initial_draft JSONB",
+    "ALTER TABLE prospect_contacts ADD COLUMN IF NOT EXISTS initial_draft_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE media_analyses ADD COLUMN IF NOT EXISTS outbound BOOLEAN NOT NULL DEFAULT false",
+    "ALTER TABLE prospect_contacts ADD COLUMN IF NOT EXISTS history_watermark_ts BIGINT",
+    "ALTER TABLE prospect_contacts ADD COLUMN IF NOT EXISTS history_watermark_id VARCHAR(255)",
+    # Cache de mídias por usuário: as análises antigas, sem dono, são descartadas
+    "ALTER TABLE media_analyses ADD COLUMN IF NOT EXISTS user_id INTEGER REFERENCES users(id) ON DELETE CASCADE",
+    "DELETE FROM media_analyses WHERE user_id IS NULL",
+    """
+    DO $$ BEGIN
+        IF EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'ix_media_analyses_message_id' AND indexdef LIKE 'CREATE UNIQUE%') THEN
+            DROP INDEX ix_media_analyses_message_id;
+            CREATE INDEX ix_media_analyses_message_id ON media_analyses (message_id);
+        END IF;
+    END $$
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_media_analyses_user_message ON media_analyses (user_id, message_id)",
+    "ALTER TABLE whatsapp_instances ADD COLUMN IF NOT EXISTS chat_summaries_built_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE token_usage ADD COLUMN IF NOT EXISTS debited BOOLEAN NOT NULL DEFAULT true",
+    # Limites da compactação do histórico por âncora (ID da mensagem) em vez de posição na lista
+    "ALTER TABLE prospect_contacts ADD COLUMN IF NOT EXISTS history_reset_anchor JSONB",
+    "ALTER TABLE prospect_contacts ADD COLUMN IF NOT EXISTS history_summary_anchor JSONB",
+    "ALTER TABLE prospect_contacts DROP COLUMN IF EXISTS history_reset_index",
+    "ALTER TABLE prospect_contacts DROP COLUMN IF EXISTS history_summary_until",
+    # Resumos gravados com os limites por posição não têm âncora: são refeitos
+    "UPDATE prospect_contacts SET history_summary = NULL WHERE history_summary IS NOT NULL AND history_summary_anchor IS NULL",
+]
+
 # --- Evento de Startup ---
 async def create_db_and_tables():
     """
@@ -39,6 +75,8 @@ async def create_db_and_tables():
         # Em um ambiente de produção, você provavelmente usaria Alembic para migrações.
         # Mas para desenvolvimento, isso é suficiente.
         await conn.run_sync(models.Base.metadata.create_all)
+        for patch in SCHEMA_PATCHES:
+            await conn.execute(text(patch))
 
     # Inicializa a instância do AtendAI automaticamente
     try:
@@ -58,6 +96,8 @@ app = FastAPI(
 async def shutdown_event():
     """Este evento é acionado quando a aplicação FastAPI está sendo desligada."""
     logger.info("Evento de shutdown acionado. Encerrando a aplicação.")
+    get_media_preprocessor().shutdown()
+    await get_whatsapp_service().aclose()
 
 # --- Configuração do CORS ---
 
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, text, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.database import SessionLocal, engine
+from app.db import models
+from app.crud import crud_user, crud_config
+from app.services.gemini_service import get_gemini_service
+from app.services.whatsapp_service import get_whatsapp_service
+
+logger = logging.getLogger(__name__)
+
+# Namespace do advisory lock do Postgres: impede que API e worker pré-gerem a mesma campanha ao mesmo tempo
+DRAFT_LOCK_NAMESPACE = 3501
+
+# Mesmo fuso do contexto temporal do prompt (Brasília)
+DRAFT_LOCAL_TZ = timezone(timedelta(hours=-3))
+
+
+def _draft_fingerprint(config: models.Config, contact: models.Contact) -> str:
+    """Hash das entradas do prompt da mensagem inicial: persona, agenda e dados do contato."""
+    inputs = [config.prompt, config.is_calendar_active, config.available_hours, contact.nome, contact.observacoes]
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _greeting_period_bounds(now: Optional[datetime] = None) -> Tuple[str, datetime]:
+    """
+    Período da saudação (manhã/tarde/noite) do instante informado e o instante em que ele termina.
+    A noite vai das 18h às 5h do dia seguinte e leva a data em que começou, para não virar à meia-noite.
+    """
+    local_now = (now or datetime.now(timezone.utc)).astimezone(DRAFT_LOCAL_TZ)
+    day = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if local_now.hour < 5:
+        return f"{(day - timedelta(days=1)).date().isoformat()}:noite", day.replace(hour=5)
+    if local_now.hour < 12:
+        return f"{day.date().isoformat()}:manha", day.replace(hour=12)
+    if local_now.hour < 18:
+        return f"{day.date().isoformat()}:tarde", day.replace(hour=18)
+    return f"{day.date().isoformat()}:noite", day.replace(hour=5) + timedelta(days=1)
+
+
+def _greeting_period(now: Optional[datetime] = None) -> str:
+    """Período da saudação em que a mensagem foi gerada (ver _greeting_period_bounds)."""
+    return _greeting_period_bounds(now)[0]
+
+
+def _sendable_before_period_end(campaign: models.Prospect, instances: List[models.WhatsappInstance]) -> int:
+    """
+    Quantas mensagens iniciais a campanha ainda consegue enviar antes de o período da saudação atual acabar,
+    pelo horário de funcionamento e pelo intervalo das instâncias. 0 se o envio não começa em breve
+    (fora da janela de antecedência) ou só começa em outro período, quando os rascunhos já estariam vencidos.
+    """
+    # Mesmo relógio da verificação de horário do worker
+    now = datetime.now().astimezone()
+    send_from, send_until = now, None
+    if campaign.horario_inicio and campaign.horario_fim:
+        window_start = datetime.combine(now.date(), campaign.horario_inicio, tzinfo=now.tzinfo)
+        send_until = datetime.combine(now.date(), campaign.horario_fim, tzinfo=now.tzinfo)
+        if now < window_start - timedelta(minutes=settings.DRAFT_LEAD_MINUTES) or now > send_until:
+            return 0
+        send_from = max(now, window_start)
+
+    period, period_end = _greeting_period_bounds(now)
+    if _greeting_period(send_from) != period:
+        return 0
+    available = ((min(period_end, send_until) if send_until else period_end) - send_from).total_seconds()
+    if available < 0:
+        return 0
+    return sum(int(available // (inst.interval_seconds or 60)) + 1 for inst in instances)
+
+
+class GeminiDraftGenerator:
+    """Gera a mensagem inicial com o mesmo fluxo do worker (modo 'initial', sem histórico)."""
+    async def generate(self, config: models.Config, contact: models.Contact, user: models.User) -> dict:
+        async with SessionLocal() as db:
+            return await get_gemini_service().generate_conversation_action(
+                config=config, contact=contact, conversation_history_db=[],
+                mode='initial', db=db, user=user
+            )
+
+
+class FakeDraftGenerator:
+    """Gerador local determinístico, para desenvolvimento e testes sem consumir a API."""
+    async def generate(self, config: models.Config, contact: models.Contact, user: models.User) -> dict:
+        return {
+            "mensagem_para_enviar": f"Olá, {contact.nome}! Tudo bem?",
+            "nova_situacao": "Aguardando Resposta",
+            "lead_score": 0,
+            "observacoes": "Mensagem inicial gerada localmente (gerador fake).",
+            "arquivos_anexos": [],
+            "novos_contatos": [],
+            "token_usage": 0
+        }
+
+
+def get_draft_generator():
+    if settings.DRAFT_GENERATOR == "fake":
+        return FakeDraftGenerator()
+    return GeminiDraftGenerator()
+
+
+def get_valid_draft(pc: models.ProspectContact, config: models.Config, contact: models.Contact) -> Optional[dict]:
+    """
+    Retorna a resposta pré-gerada do contato, se ainda for válida: mesma versão do RAG, mesmas entradas do prompt
+    (persona e dados do contato), mesmo dia e período da saudação e dentro do prazo máximo.
+    """
+    draft = pc.initial_draft
+    if not draft or not pc.initial_draft_at:
+        return None
+    if draft.get("rag_version") != config.rag_version:
+        return None
+    if draft.get("fingerprint") != _draft_fingerprint(config, contact):
+        return None
+    if draft.get("period") != _greeting_period():
+        return None
+    if datetime.now(timezone.utc) - pc.initial_draft_at > timedelta(hours=settings.DRAFT_MAX_AGE_HOURS):
+        return None
+    return draft.get("response")
+
+
+async def pregenerate_initial_drafts(campaign_id: int, limit: Optional[int] = None) -> int:
+    """
+    Pré-gera (em paralelo) as mensagens iniciais dos próximos contatos 'Aguardando Início' da campanha,
+    na mesma ordem em que o worker os enviará. Chamado ao iniciar a campanha e a cada ciclo do worker;
+    só gera dentro (ou pouco antes) do horário de funcionamento, e apenas para os contatos que devem ser
+    enviados antes de o período da saudação acabar. Retorna quantos rascunhos foram gerados.
+    """
+    limit = limit or settings.DRAFT_BATCH_SIZE
+    # O lock é de sessão do Postgres: usa uma conexão dedicada, mantida até o fim (a sessão ORM devolve a sua ao pool a cada commit)
+    async with engine.connect() as lock_conn:
+        lock_args = {"ns": DRAFT_LOCK_NAMESPACE, "id": campaign_id}
+        locked = (await lock_conn.execute(text("SELECT pg_try_advisory_lock(:ns, :id)"), lock_args)).scalar()
+        if not locked:
+            return 0
+        try:
+            return await _pregenerate_campaign_drafts(campaign_id, limit)
+        finally:
+            await lock_conn.execute(text("SELECT pg_advisory_unlock(:ns, :id)"), lock_args)
+            await lock_conn.commit()
+
+
+async def _confirmed_on_whatsapp(db: AsyncSession, instance_name: str, pending: list) -> list:
+    """
+    Confere os números dos contatos numa única consulta à Evolution e mantém só os que existem no WhatsApp,
+    para não gastar tokens com números que vão falhar. Os inexistentes já saem como 'Sem WhatsApp', como no worker.
+    """
+    whatsapp_service = get_whatsapp_service()
+    check_result = await whatsapp_service.check_whatsapp_numbers(instance_name, [contact.whatsapp for _, contact in pending])
+    if not isinstance(check_result, list):
+        logger.warning("Rascunhos: falha ao verificar os números no WhatsApp. Pré-geração adiada.")
+        return []
+
+    exists_by_number = {
+        whatsapp_service._normalize_number(item.get("number", "")): bool(item.get("exists"))
+        for item in check_result if isinstance(item, dict)
+    }
+    confirmed = []
+    for pc, contact in pending:
+        exists = exists_by_number.get(whatsapp_service._normalize_number(contact.whatsapp or ""))
+        if exists:
+            confirmed.append((pc, contact))
+        elif exists is False:
+            await db.execute(
+                update(models.ProspectContact)
+                .where(models.ProspectContact.id == pc.id, models.ProspectContact.situacao == "Aguardando Início")
+                .values(situacao="Sem WhatsApp", observacoes="Número verificado e identificado como inválido/inexistente.")
+            )
+    await db.commit()
+    return confirmed
+
+
+async def _pregenerate_campaign_drafts(campaign_id: int, limit: int) -> int:
+    async with SessionLocal() as db:
+        campaign = await db.get(models.Prospect, campaign_id)
+        if not campaign or campaign.status != "Em Andamento":
+            return 0
+        user = await crud_user.get_user(db, user_id=campaign.user_id)
+        config = await crud_config.get_config(db, config_id=campaign.config_id, user_id=campaign.user_id)
+        if not user or not config:
+            return 0
+
+        instances = (await db.execute(
+            select(models.WhatsappInstance).where(
+                models.WhatsappInstance.id.in_(campaign.whatsapp_instance_ids or []),
+                models.WhatsappInstance.is_active == True
+            )
+        )).scalars().all()
+        if not instances:
+            return 0
+        limit = min(limit, _sendable_before_period_end(campaign, instances))
+        if limit <= 0:
+            return 0
+
+        stmt = (
+            select(models.ProspectContact, models.Contact)
+            .join(models.Contact, models.ProspectContact.contact_id == models.Contact.id)
+            .where(models.ProspectContact.prospect_id == campaign_id, models.ProspectContact.situacao == "Aguardando Início")
+            .order_by(models.ProspectContact.id.asc()).limit(limit)
+        )
+        pending = [(pc, contact) for pc, contact in (await db.execute(stmt)).all() if get_valid_draft(pc, config, contact) is None]
+        if not pending:
+            return 0
+
+        pending = await _confirmed_on_whatsapp(db, instances[0].instance_name, pending)
+        if not pending:
+            return 0
+
+        logger.info(f"Rascunhos: pré-gerando {len(pending)} mensagens iniciais da campanha {campaign_id}.")
+        generator = get_draft_generator()
+        semaphore = asyncio.Semaphore(settings.DRAFT_CONCURRENCY)
+
+        async def generate(contact: models.Contact):
+            async with semaphore:
+                try:
+                    return await generator.generate(config, contact, user)
+                except Exception as e:
+                    logger.error(f"Rascunhos: erro ao gerar mensagem inicial do contato {contact.id}: {e}")
+                    return None
+
+        responses = await asyncio.gather(*(generate(contact) for _, contact in pending))
+
+        generated = 0
+        now = datetime.now(timezone.utc)
+        for (pc, contact), response in zip(pending, responses):
+            # Falhas da IA não viram rascunho: o worker gera a mensagem na hora, como antes
+            if not response or str(response.get("nova_situacao", "")).startswith("Erro"):
+                continue
+            tokens_used = response.pop("token_usage", 0) or 0
+            # UPDATE condicional: o worker pode ter iniciado a conversa com o contato durante a geração
+            result = await db.execute(
+                update(models.ProspectContact)
+                .where(models.ProspectContact.id == pc.id, models.ProspectContact.situacao == "Aguardando Início")
+                .values(
+                    initial_draft={
+                        "rag_version": config.rag_version,
+                        "fingerprint": _draft_fingerprint(config, contact),
+                        "period": _greeting_period(now),
+                        "response": response
+                    },
+                    initial_draft_at=now,
+                    token_usage=func.coalesce(models.ProspectContact.token_usage, 0) + tokens_used
+                )
+            )
+            generated += result.rowcount
+        await db.commit()
+
+        logger.info(f"Rascunhos: {generated}/{len(pending)} mensagens iniciais prontas para a campanha {campaign_id}.")
+        return generated
@@ -0,0 +1,78 @@
+import logging
+from typing import Dict, List
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Quantidade de dígitos finais do número usada na busca aproximada do histórico (sem DDI/DDD e sem o 9º dígito)
+PHONE_SUFFIX_LENGTH = 8
+
+
+def jid_suffix_sql(field: str) -> str:
+    """
+    Expressão SQL com os últimos dígitos do número do JID, invertidos (ex.: '554599924229@s.whatsapp.net' -> '92242999').
+    A mesma expressão é usada no índice e nas consultas, para que o Postgres consiga usá-lo.
+    """
+    return f"left(reverse(split_part(\"key\"->>'{field}', '@', 1)), {PHONE_SUFFIX_LENGTH})"
+
+
+# md5 do texto das mensagens enviadas: textos longos não cabem numa entrada de índice, o hash sempre cabe
+SENT_TEXT_MD5_SQL = "md5(COALESCE(\"message\"->>'conversation', \"message\"->'extendedTextMessage'->>'text'))"
+
+
+# Índices de expressão criados (opcionalmente) na tabela "Message" do banco da Evolution
+EVOLUTION_MESSAGE_INDEXES: Dict[str, str] = {
+    "prospectai_message_remotejid_ts": "(\"instanceId\", (\"key\"->>'remoteJid'), \"messageTimestamp\" DESC)",
+    "prospectai_message_remotejidalt_ts": "(\"instanceId\", (\"key\"->>'remoteJidAlt'), \"messageTimestamp\" DESC)",
+    "prospectai_message_remotejid_suffix": f"(\"instanceId\", ({jid_suffix_sql('remoteJid')}))",
+    "prospectai_message_remotejidalt_suffix": f"(\"instanceId\", ({jid_suffix_sql('remoteJidAlt')}))",
+    "prospectai_message_sent_text_md5": f"(\"instanceId\", ({SENT_TEXT_MD5_SQL})) WHERE \"key\"->>'fromMe' = 'true'",
+}
+
+
+async def _index_validity(conn: asyncpg.Connection, schema: str) -> Dict[str, bool]:
+    rows = await conn.fetch(
+        """
+        SELECT c.relname, i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = $1 AND c.relname = ANY($2::text[])
+        """,
+        schema, list(EVOLUTION_MESSAGE_INDEXES)
+    )
+    return {row["relname"]: row["indisvalid"] for row in rows}
+
+
+async def ensure_evolution_indexes(conn: asyncpg.Connection, schema: str = "public") -> List[str]:
+    """
+    Cria (CONCURRENTLY, sem bloquear as escritas da Evolution) os índices que faltam na tabela "Message".
+    Índices inválidos, deixados por uma criação interrompida, são removidos e recriados.
+    Retorna os nomes dos índices criados. Não pode rodar dentro de uma transação.
+    """
+    # A criação em tabelas grandes passa de qualquer statement_timeout razoável
+    await conn.execute("SET statement_timeout = 0")
+    existing = await _index_validity(conn, schema)
+    created = []
+    for name, definition in EVOLUTION_MESSAGE_INDEXES.items():
+        if existing.get(name):
+            continue
+        if name in existing:
+            logger.warning(f"Índice '{name}' inválido (criação interrompida). Recriando...")
+            await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{schema}"."{name}"')
+        logger.info(f"Criando índice '{name}' em \"{schema}\".\"Message\"...")
+        await conn.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{schema}"."Message" {definition}')
+        created.append(name)
+    if created:
+        await conn.execute(f'ANALYZE "{schema}"."Message"')
+    return created
+
+
+async def verify_evolution_indexes(conn: asyncpg.Connection, schema: str = "public") -> Dict[str, str]:
+    """Retorna o estado de cada índice: 'ok', 'invalid' ou 'missing'."""
+    existing = await _index_validity(conn, schema)
+    return {
+        name: ("ok" if existing[name] else "invalid") if name in existing else "missing"
+        for name in EVOLUTION_MESSAGE_INDEXES
+    }
@@ -1,25 +1,106 @@
-import os
-import re
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
 from collections.abc import Set
 import logging
 import json
 from datetime import datetime, timezone, timedelta
 import base64
-from typing import Optional, List, Dict, Any
+import hashlib
+import time
+import random
+from collections import deque
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable
 import asyncio
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func
 import numpy as np
 
 from app.core.config import settings
+from app.core.metrics import metrics
 from app.db import models
+from app.db.database import SessionLocal
 from app.crud import crud_user # Import necessário para a função de débito
 from app.services.google_calendar_service import get_google_calendar_service
+from app.services.vector_index import get_vector_index_store
+from app.services.prompt_log import get_prompt_log_writer
+from app.services.prompt_packer import PromptPacker, estimate_tokens
+from app.services.media_preprocessor import get_media_preprocessor
+from app.utils.json_repair import repair_json, JsonStringFieldStream, MessageLineSplitter
 
 logger = logging.getLogger(__name__)
 
+# Query RAG fixa usada em toda mensagem inicial (sem histórico)
+INITIAL_RAG_QUERY = "Abordagem inicial prospecção"
+
+# Mensagens recentes enviadas ao modelo leve da cascata do follow-up
+FOLLOWUP_GATE_HISTORY_LINES = 12
+
+# Roteamento de modelos por tarefa: rota -> configuração com o nome do modelo
+DEFAULT_MODEL = "gemini-2.5-flash"
+ROUTE_MODEL_SETTINGS = {
+    "initial": "GEMINI_MODEL_INITIAL",
+    "reply": "GEMINI_MODEL_REPLY",
+    "followup": "GEMINI_MODEL_FOLLOWUP",
+    "followup_gate": "GEMINI_MODEL_FOLLOWUP_GATE",
+    "transcription": "GEMINI_MODEL_TRANSCRIPTION",
+    "image_analysis": "GEMINI_MODEL_IMAGE_ANALYSIS",
+    "dashboard_analysis": "GEMINI_MODEL_DASHBOARD_ANALYSIS",
+}
+
+# Limite de entradas do cache de análises de dados de prospecção (descarta as mais antigas)
+ANALYSIS_CACHE_MAX_ENTRIES = 256
+
+# Situações que a IA pode atribuir a um contato
+CONVERSATION_STATUSES = ["Aguardando Resposta", "Lead Qualificado", "Não Interessado", "Atendente Chamado"]
+
+# Schemas de saída estruturada: o modelo é restringido pelo SDK a gerar exatamente este formato
+CONVERSATION_ACTION_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "mensagem_para_enviar": types.Schema(type=types.Type.STRING, nullable=True),
+        "nova_situacao": types.Schema(type=types.Type.STRING, enum=CONVERSATION_STATUSES),
+        "lead_score": types.Schema(type=types.Type.INTEGER, minimum=0, maximum=10),
+        "observacoes": types.Schema(type=types.Type.STRING),
+        "arquivos_anexos": types.Schema(type=types.Type.ARRAY, items=types.Schema(type=types.Type.STRING)),
+        "novos_contatos": types.Schema(
+            type=types.Type.ARRAY,
+            items=types.Schema(
+                type=types.Type.OBJECT,
+                properties={
+                    "nome": types.Schema(type=types.Type.STRING),
+                    "numero": types.Schema(type=types.Type.STRING),
+                    "observacao": types.Schema(type=types.Type.STRING, nullable=True),
+                },
+                required=["nome", "numero"]
+            )
+        ),
+        "acao_agenda": types.Schema(type=types.Type.STRING, enum=["agendar_reuniao"], nullable=True),
+        "data_agendamento": types.Schema(type=types.Type.STRING, nullable=True),
+        "email_cliente": types.Schema(type=types.Type.STRING, nullable=True),
+    },
+    required=["mensagem_para_enviar", "nova_situacao", "lead_score", "observacoes"],
+    property_ordering=[
+        "mensagem_para_enviar", "nova_situacao", "lead_score", "observacoes", "arquivos_anexos",
+        "novos_contatos", "acao_agenda", "data_agendamento", "email_cliente"
+    ]
+)
+
+MEDIA_ANALYSIS_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={"analise": types.Schema(type=types.Type.STRING)},
+    required=["analise"]
+)
+
+FOLLOWUP_GATE_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "precisa_followup": types.Schema(type=types.Type.BOOLEAN),
+        "motivo": types.Schema(type=types.Type.STRING),
+    },
+    required=["precisa_followup", "motivo"],
+)
+
 class SetEncoder(json.JSONEncoder):
     """Codificador JSON para lidar com objetos 'set'."""
     def default(self, obj):
@@ -43,17 +124,29 @@ class GeminiService:
                 "presence_penalty": 0.4
             }
             self.output_token_multiplier = 2.5 / 0.3
+            self._clients: Dict[int, genai.Client] = {}
+            # Latências recentes (s) das chamadas bem-sucedidas, por modelo, para o limiar de hedging (p95)
+            self._latencies: Dict[str, deque] = {}
+            # Análises de dados de prospecção já geradas: (usuário, pergunta, impressão digital dos dados) -> (instante, análise)
+            self._analysis_cache: Dict[Tuple[int, str, str], Tuple[float, Dict[str, Any]]] = {}
             self._initialize_model()
             
         except Exception as e:
             logger.error(f"🚨 ERRO CRÍTICO ao configurar o Gemini: {e}")
             raise
 
+    def _get_client(self, key_index: int) -> genai.Client:
+        """Retorna o cliente da chave informada, criando-o na primeira vez (um cliente por chave, reaproveitado)."""
+        client = self._clients.get(key_index)
+        if client is None:
+            client = genai.Client(api_key=self.api_keys[key_index])
+            self._clients[key_index] = client
+        return client
+
     def _initialize_model(self):
         """Inicializa o cliente Gemini com a chave atual usando o novo SDK."""
         try:
-            current_key = self.api_keys[self.current_key_index]
-            self.client = genai.Client(api_key=current_key)
+            self.client = self._get_client(self.current_key_index)
             logger.info(f"✅ Cliente Gemini (New SDK) inicializado (chave índice {self.current_key_index}).")
         except Exception as e:
             logger.error(f"🚨 ERRO CRÍTICO ao configurar o Gemini com a chave índice {self.current_key_index}: {e}", exc_info=True)
@@ -66,79 +159,57 @@ class GeminiService:
         self._initialize_model()
         return self.current_key_index
 
-    def _save_prompt_to_log(self, prompt: Any, system_instruction: Optional[str] = None):
-        """Adiciona o prompt enviado a um arquivo de log na raiz do backend."""
-        try:
-            # requirements.txt está em backend/requirements.txt
-            # gemini_service.py está em backend/app/services/gemini_service.py
-            base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-            file_path = os.path.join(base_dir, "prompt_log.txt")
-            
-            with open(file_path, "a", encoding="utf-8") as f:
-                f.write(f"\n\n{'='*20} LOG ENTRY: {datetime.now(timezone.utc).isoformat()} {'='*20}\n\n")
-                if system_instruction:
-                    f.write("=== SYSTEM INSTRUCTION ===\n")
-                    f.write(str(system_instruction))
-                    f.write("\n\n")
-                
-                f.write("=== PROMPT CONTENTS ===\n")
-                if isinstance(prompt, list):
-                    for part in prompt:
-                        if isinstance(part, str):
-                            f.write(part)
-                        elif hasattr(part, 'text') and part.text:
-                            f.write(part.text)
-                        elif isinstance(part, types.Part) and part.inline_data:
-                            f.write(f"[Part Mídia: {part.inline_data.mime_type or 'unknown'}]")
-                        else:
-                            f.write(f"[{type(part).__name__} object]")
-                        f.write("\n")
-                else:
-                    f.write(str(prompt))
-            logger.info(f"Prompt adicionado ao log em {file_path}")
-        except Exception as e:
-            logger.error(f"Erro ao salvar prompt no log: {e}")
-
-    def _save_response_to_log(self, response_text: str):
-        """Adiciona a resposta gerada ao arquivo de log."""
+    def _parse_json_response(self, response_text: str) -> dict:
+        """
+        Parseia o JSON da resposta da IA. Se o JSON vier malformado (blocos de código, vírgulas sobrando,
+        quebras de linha cruas, resposta truncada), tenta o reparo local antes de qualquer nova geração.
+        """
         try:
-            base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-            file_path = os.path.join(base_dir, "prompt_log.txt")
-            
-            with open(file_path, "a", encoding="utf-8") as f:
-                f.write("\n=== GEMINI RESPONSE ===\n")
-                f.write(str(response_text))
-                f.write("\n")
-        except Exception as e:
-            logger.error(f"Erro ao salvar resposta no log: {e}")
+            return json.loads(response_text)
+        except (json.JSONDecodeError, TypeError):
+            pass
 
-    def _parse_json_response(self, response_text: str) -> dict:
-        """Limpa e parseia JSON da resposta da IA, com tratamento de erros de escape."""
-        clean_response = response_text.strip().replace("```json", "").replace("```", "")
-        
         try:
-            return json.loads(clean_response)
+            result = repair_json(response_text or "")
         except json.JSONDecodeError:
-            # Tenta corrigir backslashes soltos (comum em caminhos de arquivo ou LaTeX)
-            try:
-                fixed_response = re.sub(r'\\(?![/\"\\bfnrtu])', r'\\\\', clean_response)
-                return json.loads(fixed_response)
-            except json.JSONDecodeError:
-                raise
+            metrics.increment("gemini_json_repair", outcome="failed")
+            raise
+        metrics.increment("gemini_json_repair", outcome="repaired")
+        logger.warning("Resposta JSON da IA malformada: recuperada pelo reparo local.")
+        return result
 
-    async def _generate_with_retry_async(
-        self, 
-        prompt: Any, 
-        db: AsyncSession, 
-        user: models.User, 
-        force_json: bool = True,
-        model_name: str = 'gemini-2.5-flash',
-        system_instruction: Optional[str] = None
-    ):
+    def _validate_conversation_action(self, data: Any) -> dict:
         """
-        Executa a chamada assíncrona para a API Gemini, com rotação de chaves e débito de token no sucesso.
+        Confere a ação parseada contra o CONVERSATION_ACTION_SCHEMA (campos obrigatórios, situação e lead score).
+        Levanta ValueError se não conferir, para que a resposta seja gerada de novo.
         """
-        
+        if not isinstance(data, dict):
+            raise ValueError("a resposta não é um objeto JSON")
+        missing = [key for key in CONVERSATION_ACTION_SCHEMA.required if key not in data]
+        if missing:
+            raise ValueError(f"campos obrigatórios ausentes: {', '.join(missing)}")
+
+        properties = CONVERSATION_ACTION_SCHEMA.properties
+        message = data["mensagem_para_enviar"]
+        if message is not None and not isinstance(message, str):
+            raise ValueError("'mensagem_para_enviar' não é texto")
+        if data["nova_situacao"] not in properties["nova_situacao"].enum:
+            raise ValueError(f"'nova_situacao' inválida: {data['nova_situacao']!r}")
+        score = data["lead_score"]
+        score_schema = properties["lead_score"]
+        if isinstance(score, bool) or not isinstance(score, int) or not score_schema.minimum <= score <= score_schema.maximum:
+            raise ValueError(f"'lead_score' inválido: {score!r}")
+        if not isinstance(data["observacoes"], str):
+            raise ValueError("'observacoes' não é texto")
+        return data
+
+    def _build_generation_config(
+        self,
+        model_name: str,
+        force_json: bool,
+        system_instruction: Optional[str],
+        response_schema: Optional[types.Schema]
+    ) -> types.GenerateContentConfig:
         # Configuração do novo SDK
         config_args = {
             "temperature": self.generation_config.get("temperature", 0.2),
@@ -153,75 +224,277 @@ class GeminiService:
 
         if force_json:
             config_args["response_mime_type"] = "application/json"
+            if response_schema is not None:
+                config_args["response_schema"] = response_schema
         
         if system_instruction:
             config_args["system_instruction"] = system_instruction
 
-        # Exporta o prompt para debug antes de enviar
-        self._save_prompt_to_log(prompt, system_instruction)
+        return types.GenerateContentConfig(**config_args)
 
-        gen_config = types.GenerateContentConfig(**config_args)
-        
-        initial_key_index = self.current_key_index
-        max_attempts_per_key = 2
+    async def _charge_usage(self, user: models.User, model_name: str, usage_metadata) -> int:
+        """Calcula o custo equivalente da chamada e o debita do usuário (ledger de tokens)."""
+        # --- LÓGICA DE TOKEN (ODÔMETRO) ---
+        tokens_to_deduct = 0
+        input_tokens = output_tokens = 0
+
+        if usage_metadata:
+            input_tokens = usage_metadata.prompt_token_count or 0
+            output_tokens = usage_metadata.candidates_token_count or 0
+            
+            # Calcula o custo equivalente em "tokens de input"
+            equivalent_total_tokens = input_tokens + (output_tokens * self.output_token_multiplier)
+            tokens_to_deduct = round(equivalent_total_tokens)
+            
+            logger.info(
+                f"Uso de tokens (User {user.id}): "
+                f"Input={input_tokens}, Output={output_tokens}. "
+                f"Custo Equivalente (x{self.output_token_multiplier:.2f}) = {tokens_to_deduct} tokens."
+            )
+
+        # O admin do .env (id 0) não existe no banco e não é cobrado
+        if tokens_to_deduct > 0 and user.id:
+            try:
+                await crud_user.decrement_user_tokens(
+                    user.id, tokens_to_deduct, model=model_name,
+                    input_tokens=input_tokens, output_tokens=output_tokens
+                )
+            except Exception as ledger_error:
+                # Falha no débito não deve repetir a chamada (já paga) ao Gemini
+                logger.error(f"Erro ao registrar consumo de tokens do usuário {user.id}: {ledger_error}")
+
+        return tokens_to_deduct
+
+    async def _generate_with_retry_async(
+        self, 
+        prompt: Any, 
+        db: AsyncSession, 
+        user: models.User, 
+        force_json: bool = True,
+        model_name: str = DEFAULT_MODEL,
+        system_instruction: Optional[str] = None,
+        response_schema: Optional[types.Schema] = None,
+        route: str = "outros"
+    ):
+        """
+        Executa a chamada assíncrona para a API Gemini, com rotação de chaves e débito de token no sucesso.
+        'route' identifica a tarefa nas métricas de latência e custo por rota.
+        """
+        gen_config = self._build_generation_config(model_name, force_json, system_instruction, response_schema)
+
+        prompt_log = get_prompt_log_writer()
+        started_at = time.monotonic()
+        deadline = started_at + settings.GEMINI_CALL_DEADLINE_SECONDS
+
+        def fail(message: str, error: Optional[Exception] = None):
+            prompt_log.record(
+                model=model_name, prompt=prompt, system_instruction=system_instruction,
+                error=message, user_id=user.id, latency_ms=(time.monotonic() - started_at) * 1000
+            )
+            raise error or Exception(message)
+
+        keys_tried = {self.current_key_index}
+        transient_attempts = 0
 
         while True:
-            for attempt in range(max_attempts_per_key):
-                try:
-                    response = await self.client.aio.models.generate_content(
-                        model=model_name,
-                        contents=prompt,
-                        config=gen_config
-                    )
-                    
-                    # --- LÓGICA DE TOKEN (ODÔMETRO) ---
-                    usage_metadata = response.usage_metadata
-                    tokens_to_deduct = 0
-
-                    if usage_metadata:
-                        input_tokens = usage_metadata.prompt_token_count
-                        output_tokens = usage_metadata.candidates_token_count
-                        
-                        # Calcula o custo equivalente em "tokens de input"
-                        equivalent_total_tokens = input_tokens + (output_tokens * self.output_token_multiplier)
-                        tokens_to_deduct = round(equivalent_total_tokens)
-                        
-                        logger.info(
-                            f"Uso de tokens (User {user.id}): "
-                            f"Input={input_tokens}, Output={output_tokens}. "
-                            f"Custo Equivalente (x{self.output_token_multiplier:.2f}) = {tokens_to_deduct} tokens."
-                        )
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.error(f"Prazo de {settings.GEMINI_CALL_DEADLINE_SECONDS}s da chamada ao Gemini esgotado.")
+                fail("Prazo da chamada ao Gemini esgotado.")
 
-                    if tokens_to_deduct > 0:
-                        # Usa 'amount' conforme padrão do ProspectAI
-                        await crud_user.decrement_user_tokens(db, db_user=user, amount=tokens_to_deduct)
+            try:
+                response = await self._generate_hedged(model_name, prompt, gen_config, remaining)
+            except Exception as e:
+                error_kind = self._classify_error(e)
+                metrics.increment("gemini_error", kind=error_kind)
+
+                if error_kind == "fatal":
+                    logger.error(f"Erro não recuperável (Bloqueio/Inválido): {e}")
+                    fail(str(e), e)
+
+                if error_kind == "rotate":
+                    # Quota (429), chave suspensa/sem permissão (401/403): troca de chave sem esperar
+                    logger.warning(f"Erro de API (Quota/Permissão) com a chave {self.current_key_index}. Rotacionando... Erro: {e}")
+                    new_key_index = self._rotate_key()
+                    if new_key_index in keys_tried:
+                        logger.critical(f"Todas as {len(self.api_keys)} chaves de API falharam.")
+                        fail("Todas as chaves de API excederam a quota.")
+                    keys_tried.add(new_key_index)
+                    continue
+
+                # Erro transitório (5xx, timeout, rede): backoff exponencial com jitter, dentro do prazo
+                transient_attempts += 1
+                if transient_attempts >= settings.GEMINI_MAX_ATTEMPTS:
+                    logger.error(f"Erro inesperado na API Gemini após {transient_attempts} tentativas: {e}")
+                    fail(str(e), e)
+                delay = random.uniform(0, min(settings.GEMINI_RETRY_MAX_DELAY, settings.GEMINI_RETRY_BASE_DELAY * 2 ** transient_attempts))
+                if time.monotonic() + delay >= deadline:
+                    logger.error(f"Erro inesperado na API Gemini e sem prazo para nova tentativa: {e}")
+                    fail(str(e), e)
+                logger.error(f"Erro inesperado na API Gemini: {e}. Tentativa {transient_attempts}, nova tentativa em {delay:.2f}s.")
+                metrics.increment("gemini_retry", model=model_name)
+                await asyncio.sleep(delay)
+                continue
 
-                    try:
-                        self._save_response_to_log(response.text)
-                    except Exception:
-                        pass
+            tokens_to_deduct = await self._charge_usage(user, model_name, response.usage_metadata)
+            latency_ms = (time.monotonic() - started_at) * 1000
+            self._record_route(route, model_name, latency_ms, tokens_to_deduct)
+            prompt_log.record(
+                model=model_name, prompt=prompt, system_instruction=system_instruction,
+                response_text=response.text, user_id=user.id, tokens=tokens_to_deduct,
+                latency_ms=latency_ms
+            )
+            return response, tokens_to_deduct
 
-                    return response, tokens_to_deduct
+    def _route_model(self, route: str) -> str:
+        """Modelo configurado para a tarefa (rota); tarefas sem configuração própria usam o modelo padrão."""
+        return getattr(settings, ROUTE_MODEL_SETTINGS.get(route, ""), None) or DEFAULT_MODEL
 
-                except Exception as e:
-                    error_str = str(e).lower()
-                    # Detecção de Erro de Cota (429), Recurso Esgotado ou Chave Suspensa/Permissão (403)
-                    if "429" in error_str or "resource exhausted" in error_str or "quota" in error_str or "403" in error_str or "permission denied" in error_str or "suspended" in error_str:
-                        logger.warning(f"Erro de API (Quota/Permissão) com a chave {self.current_key_index}. Rotacionando... Erro: {e}")
-                        break # Sai do loop 'for' para rotacionar a chave
-                    
-                    elif "blocked" in error_str or "invalid argument" in error_str:
-                        logger.error(f"Erro não recuperável (Bloqueio/Inválido): {e}")
-                        raise e
-                    else:
-                        logger.error(f"Erro inesperado na API Gemini: {e}. Tentativa {attempt + 1}.")
-                        await asyncio.sleep(1)
+    def _record_route(self, route: str, model_name: str, latency_ms: float, tokens: int):
+        """Latência total (com novas tentativas) e custo debitado por rota, para comparar os modelos."""
+        metrics.increment("gemini_route_calls", route=route, model=model_name)
+        metrics.increment("gemini_route_tokens", tokens, route=route, model=model_name)
+        metrics.observe("gemini_route_latency_ms", latency_ms, route=route, model=model_name)
+
+    def _classify_error(self, error: Exception) -> str:
+        """
+        Classifica o erro pelas exceções tipadas do SDK:
+        'rotate' (quota/chave inválida), 'fatal' (requisição inválida/bloqueada) ou 'transient' (5xx, timeout, rede).
+        """
+        if isinstance(error, genai_errors.APIError):
+            if error.code in (401, 403, 429):
+                return "rotate"
+            if error.code == 408 or (error.code or 0) >= 500:
+                return "transient"
+            return "fatal"
+        return "transient"
+
+    def _hedge_threshold(self, model_name: str) -> Optional[float]:
+        """Latência p95 recente do modelo (s), a partir da qual uma requisição duplicada é disparada."""
+        if not settings.GEMINI_HEDGE_ENABLED or len(self.api_keys) < 2:
+            return None
+        samples = self._latencies.get(model_name)
+        if not samples or len(samples) < settings.GEMINI_HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, 95))
+
+    async def _timed_generate(self, key_index: int, model_name: str, prompt: Any, gen_config: types.GenerateContentConfig):
+        started_at = time.monotonic()
+        response = await self._get_client(key_index).aio.models.generate_content(
+            model=model_name,
+            contents=prompt,
+            config=gen_config
+        )
+        elapsed = time.monotonic() - started_at
+        self._latencies.setdefault(model_name, deque(maxlen=200)).append(elapsed)
+        metrics.observe("gemini_latency_ms", elapsed * 1000, model=model_name)
+        return response
 
-            # Se saiu do loop 'for', significa que precisa trocar de chave
-            new_key_index = self._rotate_key()
-            if new_key_index == initial_key_index:
-                logger.critical(f"Todas as {len(self.api_keys)} chaves de API falharam.")
-                raise Exception("Todas as chaves de API excederam a quota.")
+    async def _generate_hedged(self, model_name: str, prompt: Any, gen_config: types.GenerateContentConfig, timeout: float):
+        """
+        Executa a chamada na chave atual. Se ultrapassar a latência p95 recente, dispara uma cópia
+        em outra chave e fica com a primeira resposta bem-sucedida (a outra é cancelada).
+        """
+        primary = asyncio.ensure_future(self._timed_generate(self.current_key_index, model_name, prompt, gen_config))
+        hedge_after = self._hedge_threshold(model_name)
+        if hedge_after is None or hedge_after >= timeout:
+            return await asyncio.wait_for(primary, timeout)
+
+        done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        hedge_key_index = (self.current_key_index + 1) % len(self.api_keys)
+        logger.info(f"Gemini: resposta acima do p95 ({hedge_after:.2f}s), disparando requisição duplicada na chave {hedge_key_index}.")
+        metrics.increment("gemini_hedge", outcome="fired")
+        hedge = asyncio.ensure_future(self._timed_generate(hedge_key_index, model_name, prompt, gen_config))
+
+        pending = {primary, hedge}
+        deadline = time.monotonic() + timeout - hedge_after
+        last_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.increment("gemini_hedge", outcome="won")
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in (primary, hedge):
+                if not task.done():
+                    task.cancel()
+
+    async def _generate_stream_async(
+        self,
+        prompt: Any,
+        user: models.User,
+        on_message_line: Callable[[str], Awaitable[None]],
+        model_name: str = DEFAULT_MODEL,
+        system_instruction: Optional[str] = None,
+        response_schema: Optional[types.Schema] = None,
+        route: str = "outros"
+    ) -> Tuple[str, int]:
+        """
+        Gera a resposta JSON em streaming. Cada linha completa de 'mensagem_para_enviar' é repassada
+        a on_message_line assim que chega, enquanto o restante do JSON (situação, score, arquivos) continua chegando.
+        Retorna o texto JSON completo e os tokens debitados. Sem novas tentativas: o chamador faz o fallback.
+        """
+        gen_config = self._build_generation_config(model_name, True, system_instruction, response_schema)
+        prompt_log = get_prompt_log_writer()
+        started_at = time.monotonic()
+        field_stream = JsonStringFieldStream("mensagem_para_enviar")
+        splitter = MessageLineSplitter()
+        chunks = []
+        usage_metadata = None
+        first_line_at = None
+
+        try:
+            async with asyncio.timeout(settings.GEMINI_CALL_DEADLINE_SECONDS):
+                stream = await self._get_client(self.current_key_index).aio.models.generate_content_stream(
+                    model=model_name,
+                    contents=prompt,
+                    config=gen_config
+                )
+                async for chunk in stream:
+                    if chunk.usage_metadata:
+                        usage_metadata = chunk.usage_metadata
+                    text = chunk.text or ""
+                    if not text:
+                        continue
+                    chunks.append(text)
+                    for line in splitter.feed(field_stream.feed(text)):
+                        if first_line_at is None:
+                            first_line_at = time.monotonic()
+                        await on_message_line(line)
+                    if field_stream.done:
+                        for line in splitter.flush():
+                            await on_message_line(line)
+        except Exception as e:
+            prompt_log.record(
+                model=model_name, prompt=prompt, system_instruction=system_instruction,
+                error=str(e), user_id=user.id, latency_ms=(time.monotonic() - started_at) * 1000
+            )
+            raise
+
+        response_text = "".join(chunks)
+        elapsed = time.monotonic() - started_at
+        metrics.observe("gemini_latency_ms", elapsed * 1000, model=model_name, mode="stream")
+        if first_line_at is not None:
+            metrics.observe("gemini_first_line_ms", (first_line_at - started_at) * 1000, model=model_name)
+
+        tokens_to_deduct = await self._charge_usage(user, model_name, usage_metadata)
+        self._record_route(route, model_name, elapsed * 1000, tokens_to_deduct)
+        prompt_log.record(
+            model=model_name, prompt=prompt, system_instruction=system_instruction,
+            response_text=response_text, user_id=user.id, tokens=tokens_to_deduct,
+            latency_ms=elapsed * 1000
+        )
+        return response_text, tokens_to_deduct
 
     async def generate_embedding(self, text: str) -> List[float]:
         """
@@ -247,78 +520,97 @@ class GeminiService:
             logger.error(f"Erro ao gerar embedding: {e}")
             return []
 
-    async def generate_embeddings_batch(self, texts: List[str], batch_size: int = 100) -> List[List[float]]:
+    async def _embed_batch_with_retry(
+        self,
+        batch: List[str],
+        key_index: int,
+        semaphores: List[asyncio.Semaphore],
+        embed_config: types.EmbedContentConfig
+    ) -> List[List[float]]:
+        """
+        Gera os embeddings de um lote com novas tentativas: em quota/permissão troca de chave, em erros
+        transitórios faz backoff exponencial com jitter e em requisição inválida divide o lote.
+        Se esgotar as tentativas, retorna [] para cada linha que falhou.
+        """
+        attempts = 0
+        while True:
+            async with semaphores[key_index]:
+                try:
+                    response = await self._get_client(key_index).aio.models.embed_content(
+                        model="gemini-embedding-001",
+                        contents=batch,
+                        config=embed_config
+                    )
+                    if response.embeddings and len(response.embeddings) == len(batch):
+                        return [e.values for e in response.embeddings]
+                    error = ValueError(f"{len(response.embeddings or [])} embeddings retornados para {len(batch)} textos")
+                except Exception as e:
+                    error = e
+
+            error_kind = self._classify_error(error)
+            metrics.increment("embedding_batch_error", kind=error_kind)
+            attempts += 1
+            if error_kind == "fatal" and len(batch) > 1:
+                # Requisição inválida: divide o lote ao meio para isolar a(s) linha(s) problemática(s)
+                middle = len(batch) // 2
+                halves = await asyncio.gather(
+                    self._embed_batch_with_retry(batch[:middle], key_index, semaphores, embed_config),
+                    self._embed_batch_with_retry(batch[middle:], key_index, semaphores, embed_config)
+                )
+                return halves[0] + halves[1]
+            if error_kind == "fatal" or attempts >= settings.EMBEDDING_MAX_ATTEMPTS:
+                logger.error(f"Erro ao gerar embeddings em lote ({len(batch)} textos) após {attempts} tentativa(s): {error}")
+                return [[] for _ in batch]
+
+            if error_kind == "rotate" and len(self.api_keys) > 1:
+                key_index = (key_index + 1) % len(self.api_keys)
+                # Enquanto houver chaves não tentadas, troca sem esperar
+                if attempts < len(self.api_keys):
+                    continue
+            delay = random.uniform(0, min(settings.EMBEDDING_RETRY_MAX_DELAY, settings.GEMINI_RETRY_BASE_DELAY * 2 ** attempts))
+            logger.warning(f"Erro ao gerar embeddings em lote: {error}. Tentativa {attempts}, nova tentativa em {delay:.2f}s.")
+            await asyncio.sleep(delay)
+
+    async def generate_embeddings_batch(self, texts: List[str], batch_size: Optional[int] = None) -> List[List[float]]:
         """
         Gera embeddings em lote usando gemini-embedding-001 com 768 dimensões.
+        Os lotes rodam em paralelo, distribuídos entre as chaves de API; linhas que falharem mesmo após as
+        novas tentativas ficam com [] (na mesma posição do texto), para que o chamador possa reportá-las.
         """
-        all_embeddings = []
-        
+        batch_size = batch_size or settings.EMBEDDING_BATCH_SIZE
+
         # Configuração para 768 dimensões
         embed_config = types.EmbedContentConfig(
             output_dimensionality=768
         )
 
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            try:
-                response = await self.client.aio.models.embed_content(
-                    model="gemini-embedding-001",
-                    contents=batch,
-                    config=embed_config
-                )
-                if response.embeddings:
-                    batch_embeddings = [e.values for e in response.embeddings]
-                    all_embeddings.extend(batch_embeddings)
-                else:
-                    logger.warning(f"Batch {i} retornou sem embeddings.")
-                    all_embeddings.extend([[] for _ in batch])
-            except Exception as e:
-                logger.error(f"Erro ao gerar embeddings em lote (índice {i}): {e}")
-                all_embeddings.extend([[] for _ in batch])
+        semaphores = [asyncio.Semaphore(settings.EMBEDDING_CONCURRENCY_PER_KEY) for _ in self.api_keys]
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        started_at = time.monotonic()
+        results = await asyncio.gather(*(
+            self._embed_batch_with_retry(batch, n % len(self.api_keys), semaphores, embed_config)
+            for n, batch in enumerate(batches)
+        ))
+
+        all_embeddings = [embedding for batch_embeddings in results for embedding in batch_embeddings]
+        failed = sum(1 for embedding in all_embeddings if not embedding)
+        logger.info(
+            f"Embeddings: {len(texts)} textos em {len(batches)} lotes ({len(self.api_keys)} chaves) "
+            f"em {time.monotonic() - started_at:.1f}s. Falhas: {failed}."
+        )
         return all_embeddings
 
-    async def _retrieve_rag_context(self, db: AsyncSession, config_id: int, query_text: str) -> str:
-        """Busca contexto relevante na base vetorial (PGVector)."""
-        if not query_text: return ""
-        
-        query_embedding = await self.generate_embedding(query_text)
-        if not query_embedding:
-            logger.warning(f"RAG: Falha ao gerar embedding para a query: '{query_text[:50]}...'")
-            return ""
-
-        # Busca as origens únicas (abas/drive) para garantir a recuperação por categoria
-        origins_stmt = select(models.KnowledgeVector.origin).where(
-            models.KnowledgeVector.config_id == config_id
-        ).distinct()
-        origins_result = await db.execute(origins_stmt)
-        origins = origins_result.scalars().all()
-        
-        if not origins:
-            return ""
-
+    def _format_rag_sections(self, results_by_origin: Dict[str, List[str]]) -> str:
+        """Agrupa as linhas recuperadas de cada origem sob um único cabeçalho (tabela por seção)."""
         all_formatted_sections = []
-        
-        for origin in origins:
-            # Recupera os 10 itens mais relevantes para cada aba/origem
-            stmt = select(models.KnowledgeVector).where(
-                models.KnowledgeVector.config_id == config_id,
-                models.KnowledgeVector.origin == origin
-            ).order_by(
-                models.KnowledgeVector.embedding.cosine_distance(query_embedding)
-            ).limit(10)
-            
-            res = await db.execute(stmt)
-            vectors = res.scalars().all()
-            
-            if not vectors:
-                continue
-                
+
+        for origin, contents in results_by_origin.items():
             # Agrupa as linhas sob um único cabeçalho para formar a tabela
             header = ""
             rows = []
-            for v in vectors:
+            for content in contents:
                 # O conteúdo está no formato: "# Nome\nHeader|Header\nValue|Value"
-                lines = v.content.split('\n')
+                lines = content.split('\n')
                 if len(lines) >= 3:
                     header = lines[1]
                     rows.append(lines[2])
@@ -329,28 +621,145 @@ class GeminiService:
                 section_text = f"# {section_name}\n{header}\n" + "\n".join(rows)
                 all_formatted_sections.append(section_text)
 
-        if not all_formatted_sections:
+        return "\n\n".join(all_formatted_sections)
+
+    async def _retrieve_rag_rows(self, db: AsyncSession, config_id: int, query_text: str, rag_version: Optional[int] = None) -> List[Tuple[str, str, float]]:
+        """
+        Busca na base vetorial os 10 conteúdos mais similares de cada origem, como (origem, conteúdo, similaridade).
+        Usa o índice numpy em memória quando RAG_ENGINE='numpy' e a versão dos vetores é conhecida;
+        caso contrário, consulta o PGVector.
+        """
+        if not query_text: return []
+        
+        query_embedding = await self.generate_embedding(query_text)
+        if not query_embedding:
+            logger.warning(f"RAG: Falha ao gerar embedding para a query: '{query_text[:50]}...'")
+            return []
+
+        rows: List[Tuple[str, str, float]] = []
+
+        if settings.RAG_ENGINE == "numpy" and rag_version is not None:
+            index = await get_vector_index_store().get_index(db, config_id, rag_version)
+            for origin, matches in index.search(query_embedding, k=10).items():
+                rows.extend((origin, content, score) for content, score in matches)
+        else:
+            # Busca as origens únicas (abas/drive) para garantir a recuperação por categoria
+            origins_stmt = select(models.KnowledgeVector.origin).where(
+                models.KnowledgeVector.config_id == config_id
+            ).distinct()
+            origins_result = await db.execute(origins_stmt)
+            origins = origins_result.scalars().all()
+            
+            for origin in origins:
+                # Recupera os 10 itens mais relevantes para cada aba/origem
+                distance = models.KnowledgeVector.embedding.cosine_distance(query_embedding)
+                stmt = select(models.KnowledgeVector.content, distance.label("distance")).where(
+                    models.KnowledgeVector.config_id == config_id,
+                    models.KnowledgeVector.origin == origin
+                ).order_by(distance).limit(10)
+                
+                res = await db.execute(stmt)
+                rows.extend((origin, r.content, 1.0 - float(r.distance)) for r in res.all() if r.distance is not None)
+
+        return rows
+
+    async def _retrieve_rag_context(self, db: AsyncSession, config_id: int, query_text: str, rag_version: Optional[int] = None) -> str:
+        """Busca contexto relevante na base vetorial e o formata em tabelas por seção."""
+        rows = await self._retrieve_rag_rows(db, config_id, query_text, rag_version=rag_version)
+
+        results_by_origin: Dict[str, List[str]] = {}
+        for origin, content, _score in rows:
+            results_by_origin.setdefault(origin, []).append(content)
+
+        context = self._format_rag_sections(results_by_origin)
+        if not context:
             return ""
 
-        context = "\n\n".join(all_formatted_sections)
         logger.info(f"RAG: Contexto recuperado e formatado em tabelas por seção.")
         return context
 
-    def _format_history_for_prompt(self, db_history: List[dict]) -> str:
-        """Formata o histórico de conversa em uma string simples e legível."""
-        
-        # --- LÓGICA DE RESET ---
-        # Filtra o histórico para enviar ao prompt apenas o que ocorreu APÓS o último '/reset'
-        start_index = 0
-        for i, msg in enumerate(db_history):
-            content = str(msg.get("content", "")).strip()
+    async def _load_rag_rows_with_timeout(self, config: models.Config, query_text: str) -> List[Tuple[str, str, float]]:
+        """Busca do RAG com sessão própria do banco (pode rodar em paralelo com outras etapas) e prazo máximo."""
+        started_at = time.monotonic()
+        try:
+            async with asyncio.timeout(settings.CONTEXT_RAG_TIMEOUT_SECONDS):
+                async with SessionLocal() as rag_db:
+                    return await self._retrieve_rag_rows(rag_db, config.id, query_text, rag_version=config.rag_version)
+        except TimeoutError:
+            metrics.increment("context_timeout", part="rag")
+            logger.warning(f"RAG: busca excedeu {settings.CONTEXT_RAG_TIMEOUT_SECONDS}s; seguindo sem contexto da base.")
+            return []
+        except Exception as e:
+            logger.error(f"RAG: erro na busca de contexto: {e}")
+            return []
+        finally:
+            metrics.observe("context_assembly_ms", (time.monotonic() - started_at) * 1000, part="rag")
+
+    async def _load_busy_slots_with_timeout(self, config: models.Config) -> str:
+        """Compromissos dos próximos 7 dias na agenda, com prazo máximo para não atrasar a resposta."""
+        started_at = time.monotonic()
+        try:
+            async with asyncio.timeout(settings.CONTEXT_CALENDAR_TIMEOUT_SECONDS):
+                events = await get_google_calendar_service(config).get_upcoming_events(days=7)
+            if not events:
+                return "Nenhum compromisso agendado nos próximos dias."
+            busy_slots_text = "Compromissos já agendados (HORÁRIOS OCUPADOS):\n"
+            for ev in events:
+                busy_slots_text += f"- {ev['summary']}: {ev['start']} até {ev['end']}\n"
+            return busy_slots_text
+        except TimeoutError:
+            metrics.increment("context_timeout", part="calendar")
+            logger.warning(f"Agenda: busca excedeu {settings.CONTEXT_CALENDAR_TIMEOUT_SECONDS}s; seguindo sem os compromissos.")
+            return "Erro ao carregar compromissos existentes."
+        except Exception as e:
+            logger.error(f"Erro ao buscar agenda para prompt: {e}")
+            return "Erro ao carregar compromissos existentes."
+        finally:
+            metrics.observe("context_assembly_ms", (time.monotonic() - started_at) * 1000, part="calendar")
+
+    def _pack_rag_rows(self, packer: PromptPacker, rows: List[Tuple[str, str, float]]) -> str:
+        """Preenche o orçamento com as linhas mais similares entre todas as origens e as formata por seção."""
+        selected: Dict[str, List[str]] = {}
+        for origin, content, _score in sorted(rows, key=lambda r: r[2], reverse=True):
+            lines = content.split('\n')
+            if len(lines) < 3:
+                continue
+            cost = estimate_tokens(lines[2]) + 1
+            if origin not in selected:
+                # Primeira linha da origem também paga o cabeçalho da seção
+                cost += estimate_tokens(f"# {origin}\n{lines[1]}") + 2
+            if packer.take("rag", cost):
+                selected.setdefault(origin, []).append(content)
+        return self._format_rag_sections(selected)
+
+    async def build_initial_rag_context(self, db: AsyncSession, config: models.Config) -> Optional[str]:
+        """
+        Pré-calcula o contexto RAG da abordagem inicial e o salva na configuração.
+        Chamado após cada sincronização de vetores, já que a query é sempre a mesma.
+        Só resultados de fato são salvos: se a busca falhar (ex.: embedding da query) ou vier vazia,
+        a coluna fica None e as mensagens iniciais consultam o RAG normalmente.
+        """
+        context = await self._retrieve_rag_context(db, config.id, INITIAL_RAG_QUERY, rag_version=config.rag_version)
+        config.initial_rag_context = context or None
+        await db.commit()
+        if not context:
+            logger.warning(f"RAG: Contexto inicial da config {config.id} não pré-calculado (busca vazia ou com falha).")
+            return None
+        logger.info(f"RAG: Contexto inicial pré-calculado para config {config.id} ({len(context)} caracteres).")
+        return context
+
+    def _find_reset_index(self, db_history: List[dict], start: int = 0) -> int:
+        """Retorna a posição logo após o último '/reset', varrendo apenas a partir de 'start'."""
+        reset_index = start
+        for i in range(start, len(db_history)):
+            content = str(db_history[i].get("content", "")).strip()
             if "/reset" in content:
-                start_index = i + 1
-        
-        filtered_history = db_history[start_index:]
-        
+                reset_index = i + 1
+        return reset_index
+
+    def _format_history_lines(self, messages: List[dict]) -> List[str]:
         history_lines = []
-        for msg in filtered_history:
+        for msg in messages:
             # Define o remetente como 'ia' ou 'contato'
             role = "IA" if msg.get("role") == "assistant" else "Contato"
             content = str(msg.get("content", "")).strip()
@@ -358,6 +767,15 @@ class GeminiService:
             # Adiciona a linha apenas se houver conteúdo
             if content:
                 history_lines.append(f"{role}: {content}")
+        return history_lines
+
+    def _format_history_for_prompt(self, db_history: List[dict]) -> str:
+        """Formata o histórico de conversa em uma string simples e legível."""
+        
+        # --- LÓGICA DE RESET ---
+        # Filtra o histórico para enviar ao prompt apenas o que ocorreu APÓS o último '/reset'
+        filtered_history = db_history[self._find_reset_index(db_history):]
+        history_lines = self._format_history_lines(filtered_history)
         
         # Se não houver histórico, retorna uma mensagem padrão
         if not history_lines:
@@ -365,6 +783,92 @@ class GeminiService:
             
         return "\n".join(history_lines)
 
+    async def _summarize_history(self, db: AsyncSession, user: models.User, previous_summary: Optional[str], messages: List[dict]) -> tuple[str, int]:
+        """Incorpora um bloco de mensagens ao resumo acumulado da conversa."""
+        prompt = (
+            "Atualize o resumo de uma conversa de prospecção pelo WhatsApp.\n"
+            "Mantenha fatos, dados fornecidos pelo contato (nomes, números, e-mails, valores, datas), "
+            "objeções, interesses, perguntas já respondidas e compromissos assumidos. "
+            "Seja conciso (no máximo 15 linhas), sem introduções.\n\n"
+            f"# RESUMO ATUAL\n{previous_summary or 'Nenhum.'}\n\n"
+            f"# NOVAS MENSAGENS\n" + "\n".join(self._format_history_lines(messages))
+        )
+        response, tokens_used = await self._generate_with_retry_async(prompt, db, user, force_json=False, route="summary")
+        return response.text.strip(), tokens_used
+
+    def _history_anchor(self, db_history: List[dict], position: int) -> Optional[Dict[str, Any]]:
+        """Âncora de um limite do histórico: a mensagem logo antes de 'position' (ID, timestamp e posição)."""
+        if position <= 0:
+            return None
+        msg = db_history[position - 1]
+        return {"id": str(msg.get("id", "")), "timestamp": msg.get("timestamp"), "position": position}
+
+    def _resolve_history_anchor(self, db_history: List[dict], anchor: Optional[Dict[str, Any]]) -> Optional[int]:
+        """
+        Reencontra a posição de um limite pelo ID da mensagem âncora. Retorna None se a âncora sumiu ou se
+        mensagens foram inseridas ou removidas antes dela (a sincronização reordena e troca os placeholders),
+        casos em que as posições antigas já não delimitam as mesmas mensagens.
+        """
+        if not anchor:
+            return 0
+        for i in range(len(db_history) - 1, -1, -1):
+            msg = db_history[i]
+            if str(msg.get("id", "")) == anchor.get("id"):
+                if i + 1 != anchor.get("position") or msg.get("timestamp") != anchor.get("timestamp"):
+                    return None
+                return i + 1
+        return None
+
+    async def _build_compacted_history(
+        self,
+        db: AsyncSession,
+        user: models.User,
+        prospect_contact: models.ProspectContact,
+        db_history: List[dict]
+    ) -> Tuple[Optional[str], List[str], int]:
+        """
+        Monta o histórico do prompt com tamanho aproximadamente constante: resumo acumulado
+        + mensagens literais após a âncora do resumo ('history_summary_anchor').
+        O resumo só é recalculado quando a janela literal avança HISTORY_SUMMARY_STEP mensagens.
+        O estado é gravado no prospect_contact e persistido pelo commit do chamador.
+        """
+        tokens_used = 0
+        reset_index = self._resolve_history_anchor(db_history, prospect_contact.history_reset_anchor)
+        summary_until = self._resolve_history_anchor(db_history, prospect_contact.history_summary_anchor)
+
+        # Âncora perdida ou deslocada (ex.: histórico reconstruído na sincronização): recomeça a compactação
+        if reset_index is None or summary_until is None:
+            reset_index, summary_until = 0, 0
+            prospect_contact.history_summary = None
+
+        new_reset_index = self._find_reset_index(db_history, start=reset_index)
+        if new_reset_index != reset_index or summary_until < new_reset_index:
+            reset_index = new_reset_index
+            summary_until = reset_index
+            prospect_contact.history_summary = None
+
+        # O resumo termina numa mensagem com ID definitivo: placeholders 'sent_'/'internal_' são trocados na sincronização
+        window_start = len(db_history) - settings.HISTORY_VERBATIM_MESSAGES
+        while window_start > summary_until and str(db_history[window_start - 1].get("id", "")).startswith(("sent_", "internal_")):
+            window_start -= 1
+        if window_start - summary_until >= settings.HISTORY_SUMMARY_STEP:
+            try:
+                summary, tokens_used = await self._summarize_history(
+                    db, user, prospect_contact.history_summary, db_history[summary_until:window_start]
+                )
+                prospect_contact.history_summary = summary
+                summary_until = window_start
+                logger.info(f"Histórico: resumo do contato {prospect_contact.id} atualizado até a mensagem {summary_until}.")
+            except Exception as e:
+                # Sem resumo novo, a janela apenas cresce até a próxima tentativa
+                logger.error(f"Erro ao resumir histórico do contato {prospect_contact.id}: {e}")
+
+        prospect_contact.history_reset_anchor = self._history_anchor(db_history, reset_index)
+        prospect_contact.history_summary_anchor = self._history_anchor(db_history, summary_until)
+
+        history_lines = self._format_history_lines(db_history[summary_until:])
+        return prospect_contact.history_summary, history_lines, tokens_used
+
     def _get_time_context(self) -> str:
         """Retorna uma string formatada com a data, hora e dia da semana atual (Brasília)."""
         now_utc = datetime.now(timezone.utc)
@@ -412,6 +916,9 @@ class GeminiService:
             logger.error(f"Os dados da mídia não são binários e não puderam ser convertidos. Tipo: {type(raw_data)}")
             return "[Erro: Dados de mídia em formato inesperado]", 0
 
+        # Áudio em Opus mono 16 kHz sem silêncios e imagens reduzidas: menos bytes e menos tokens multimodais
+        raw_data, mime_type = await get_media_preprocessor().preprocess(raw_data, mime_type)
+
         # --- NOVO SDK: Criação do objeto Part ---
         try:
             media_part = types.Part.from_bytes(data=raw_data, mime_type=mime_type)
@@ -445,7 +952,10 @@ class GeminiService:
             for attempt in range(max_retries):
                 try:
                     # force_json=False, pois não esperamos mais um JSON como resposta.
-                    response, tokens_used = await self._generate_with_retry_async(prompt_contents, db, user, force_json=False)
+                    response, tokens_used = await self._generate_with_retry_async(
+                        prompt_contents, db, user, force_json=False,
+                        model_name=self._route_model("transcription"), route="transcription"
+                    )
                     
                     transcription = response.text.strip()
                     if not transcription:
@@ -459,9 +969,10 @@ class GeminiService:
                     return transcription, tokens_used
 
                 except Exception as e:
+                    # Erros de API já foram retentados (com prazo) em _generate_with_retry_async
                     logger.error(f"Tentativa {attempt + 1}/{max_retries}: Erro ao transcrever áudio: {e}", exc_info=True)
                     last_error = str(e)
-                    await asyncio.sleep(1)
+                    break
 
             logger.error(f"Falha ao transcrever áudio após {max_retries} tentativas. Último erro: {last_error}")
             return f"[Erro ao processar áudio após {max_retries} tentativas]", 0
@@ -473,7 +984,7 @@ class GeminiService:
 
             # RAG para análise de imagem (se houver texto na imagem que precise de contexto)
             last_user_msg = next((m.get('content', '') for m in reversed(db_history) if m.get('role') == 'user'), "")
-            rag_context = await self._retrieve_rag_context(db, config.id, last_user_msg)
+            rag_context = await self._retrieve_rag_context(db, config.id, last_user_msg, rag_version=config.rag_version)
 
             # A função agora retorna uma string formatada, não mais um JSON.
             historico_conversa_str = self._format_history_for_prompt(db_history or [])
@@ -500,7 +1011,11 @@ class GeminiService:
             prompt_contents = [analysis_prompt_text, media_part]
 
             try:
-                response, tokens_used = await self._generate_with_retry_async(prompt_contents, db, user, force_json=True, system_instruction=system_instruction)
+                response, tokens_used = await self._generate_with_retry_async(
+                    prompt_contents, db, user, force_json=True,
+                    system_instruction=system_instruction, response_schema=MEDIA_ANALYSIS_SCHEMA,
+                    model_name=self._route_model("image_analysis"), route="image_analysis"
+                )
                 response_json = self._parse_json_response(response.text)
                 analysis = response_json.get("analise", "[Não foi possível extrair a análise]").strip()
                 logger.info(f"Análise de mídia gerada: '{analysis[:100]}...'")
@@ -509,69 +1024,57 @@ class GeminiService:
                 logger.error(f"Erro ao analisar mídia com prompt JSON: {e}")
                 return f"[Erro ao processar mídia: {media_data.get('mime_type')}]", 0
 
-    # --- ASSINATURA ATUALIZADA PARA PASSAR DB E USER ---
-    async def generate_conversation_action(
+    async def _followup_gate(
         self,
-        config: models.Config,
-        contact: models.Contact,
-        conversation_history_db: List[dict],
-        mode: str,
         db: AsyncSession,
-        user: models.User
-    ) -> dict:
-
-        task_map = {
-            'initial': "Gerar a primeira mensagem de prospecção para iniciar a conversa. Seja breve e direto.",
-            'reply': "Analisar a última mensagem do contato e formular a PRÓXIMA resposta para avançar na conversa, usando o contexto disponível.",
-            'followup': "Analisar as mensagens e decidir entre continuar o fluxo, fazer um follow-up ou se não é necessário mais nada apenas retorne 'null' no campo 'mensagem_para_enviar"
-        }
-        # A função agora retorna uma string formatada, não mais um JSON.
-        formatted_history = self._format_history_for_prompt(conversation_history_db)
-        
-        # --- RAG QUERY BUILDER ---
-        rag_query = ""
-        if conversation_history_db:
-            recent_msgs = conversation_history_db[-3:]
-            rag_query = " | ".join([m.get('content', '') for m in recent_msgs])
-        elif mode == 'initial':
-            rag_query = "Abordagem inicial prospecção"
-
-        rag_context = await self._retrieve_rag_context(db, config.id, rag_query)
-        
-        # System Instruction (Prompt Fixo)
-        system_instruction = config.prompt or "Você é um assistente de prospecção."
-        
-        # --- TIME CONTEXT ---
-        time_context = self._get_time_context()
-
-        # --- CALENDAR CONTEXT ---
-        calendar_context = ""
-        if config.is_calendar_active and config.google_calendar_credentials and config.available_hours:
-            # Busca eventos ocupados para os próximos 7 dias
-            busy_slots_text = "Nenhum compromisso agendado nos próximos dias."
-            try:
-                calendar_service = get_google_calendar_service(config)
-                events = await calendar_service.get_upcoming_events(days=7)
-                if events:
-                    busy_slots_text = "Compromissos já agendados (HORÁRIOS OCUPADOS):\n"
-                    for ev in events:
-                        busy_slots_text += f"- {ev['summary']}: {ev['start']} até {ev['end']}\n"
-            except Exception as e:
-                logger.error(f"Erro ao buscar agenda para prompt: {e}")
-                busy_slots_text = "Erro ao carregar compromissos existentes."
-
-            calendar_context = (
-                f"\n# DISPONIBILIDADE DE AGENDA\n"
-                f"Seu padrão de horários disponíveis: {json.dumps(config.available_hours, ensure_ascii=False)}.\n"
-                f"{busy_slots_text}\n"
-                f"REGRAS DE AGENDAMENTO:\n"
-                f"1. Verifique se o horário proposto pelo cliente não conflita com os compromissos listados acima.\n"
-                f"2. Proponha apenas horários dentro do seu padrão de disponibilidade.\n"
-                f"3. Se o cliente confirmar, solicite o e-mail. Com horário E e-mail, use a ação 'agendar_reuniao'.\n"
+        user: models.User,
+        contact: models.Contact,
+        history_summary: Optional[str],
+        history_lines: List[str]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Primeira etapa da cascata do follow-up: o modelo leve decide, só com o histórico recente,
+        se vale enviar um follow-up. Só decide isso: a situação do contato fica a cargo do modelo completo.
+        Retorna None em caso de falha (o modelo completo decide, como antes).
+        """
+        history_text = "\n".join(history_lines[-FOLLOWUP_GATE_HISTORY_LINES:]) or "Nenhuma mensagem no histórico."
+        if history_summary:
+            history_text = f"[Resumo das mensagens anteriores]\n{history_summary}\n\n{history_text}"
+        prompt = (
+            f"{self._get_time_context()}\n"
+            f"# CONTATO\nNome: {contact.nome}\n\n"
+            f"# HISTÓRICO DA CONVERSA\n{history_text}\n\n"
+            f"# TAREFA ATUAL: Decidir sobre Follow-up\n"
+            f"O contato ainda não respondeu à última mensagem enviada. Decida se um follow-up (nova mensagem) é necessário agora.\n"
+            f"Não é necessário se a conversa já foi encerrada, se o contato demonstrou desinteresse, se já foram enviados "
+            f"follow-ups demais sem resposta ou se a última mensagem é recente demais.\n\n"
+            f"# FORMATO DE RESPOSTA (JSON OBRIGATÓRIO)\n"
+            f'{{"precisa_followup": true | false, "motivo": "Justificativa curta"}}'
+        )
+        try:
+            response, tokens_used = await self._generate_with_retry_async(
+                prompt, db, user, force_json=True, response_schema=FOLLOWUP_GATE_SCHEMA,
+                model_name=self._route_model("followup_gate"), route="followup_gate"
             )
+            decision = self._parse_json_response(response.text)
+            decision["token_usage"] = tokens_used
+            return decision
+        except Exception as e:
+            metrics.increment("followup_cascade", outcome="gate_error")
+            logger.warning(f"Cascata do follow-up: falha no modelo leve ({e}). Usando o modelo completo.")
+            return None
 
-        # Montagem do Prompt Texto (Estilo AtendAI)
-        prompt_text = (
+    def _render_conversation_prompt(
+        self,
+        rag_context: str,
+        formatted_history: str,
+        calendar_context: str,
+        contact: models.Contact,
+        time_context: str,
+        task: str
+    ) -> str:
+        """Monta o prompt de conversação (Estilo AtendAI) a partir das seções já dimensionadas."""
+        return (
             f"# CONTEXTO (RAG)\n{rag_context}\n\n"
             f"# HISTÓRICO\n{formatted_history}\n\n"
             f"# DADOS DO CONTATO\n"
@@ -603,7 +1106,7 @@ class GeminiService:
             f"3. O contato concordou com um próximo passo claro (visita, reunião, envio de projeto).\n"
             f"Se o interesse for vago ou inicial, mantenha como 'Aguardando Resposta'.\n"
             f"Se a pessoa demonstrar desinterece, hostilidade, mude para 'Não Interessado'.\n\n"
-            f"# TAREFA ATUAL: {task_map.get(mode, 'Responder')}\n\n"
+            f"# TAREFA ATUAL: {task}\n\n"
             f"# REGRAS DE EXECUÇÃO\n"
             f"1. **Fonte de Verdade:** Use prioritariamente o CONTEXTO (RAG) e (System).\n"
             f"2. **Envio de Arquivos do Drive (IMPORTANTE):**\n"
@@ -629,27 +1132,171 @@ class GeminiService:
             f"}}"
         )
 
+    # --- ASSINATURA ATUALIZADA PARA PASSAR DB E USER ---
+    async def generate_conversation_action(
+        self,
+        config: models.Config,
+        contact: models.Contact,
+        conversation_history_db: List[dict],
+        mode: str,
+        db: AsyncSession,
+        user: models.User,
+        prospect_contact: Optional[models.ProspectContact] = None,
+        on_message_line: Optional[Callable[[str], Awaitable[None]]] = None
+    ) -> dict:
+        """
+        Gera a próxima ação da conversa. Se on_message_line for informado (e GEMINI_STREAMING_ENABLED),
+        a resposta é gerada em streaming e cada linha de 'mensagem_para_enviar' é repassada assim que completa;
+        as linhas repassadas correspondem às primeiras partes da mensagem final.
+        """
+
+        task_map = {
+            'initial': "Gerar a primeira mensagem de prospecção para iniciar a conversa. Seja breve e direto.",
+            'reply': "Analisar a última mensagem do contato e formular a PRÓXIMA resposta para avançar na conversa, usando o contexto disponível.",
+            'followup': "Analisar as mensagens e decidir entre continuar o fluxo, fazer um follow-up ou se não é necessário mais nada apenas retorne 'null' no campo 'mensagem_para_enviar"
+        }
+        summary_tokens = 0
+        history_summary = None
+        if prospect_contact is not None:
+            history_summary, history_lines, summary_tokens = await self._build_compacted_history(db, user, prospect_contact, conversation_history_db)
+        else:
+            history_lines = self._format_history_lines(conversation_history_db[self._find_reset_index(conversation_history_db):])
+
+        route = mode if mode in ('initial', 'reply', 'followup') else 'reply'
+        model_name = self._route_model(route)
+
+        # --- CASCATA DO FOLLOW-UP ---
+        # Um modelo leve decide antes se o follow-up é necessário; o modelo completo (com RAG) só escreve quando for
+        if mode == 'followup' and settings.GEMINI_FOLLOWUP_CASCADE:
+            gate = await self._followup_gate(db, user, contact, history_summary, history_lines)
+            if gate is not None and not gate.get("precisa_followup"):
+                metrics.increment("followup_cascade", outcome="skipped")
+                logger.info(f"Cascata do follow-up: não é necessário para o contato {contact.id} ({gate.get('motivo', '')}).")
+                # Sem follow-up, a situação do contato não muda (nova_situacao None: o worker mantém a anterior)
+                return {
+                    "mensagem_para_enviar": None,
+                    "nova_situacao": None,
+                    "lead_score": prospect_contact.lead_score if prospect_contact is not None else 0,
+                    "observacoes": prospect_contact.observacoes if prospect_contact is not None else gate.get("motivo", ""),
+                    "arquivos_anexos": [],
+                    "novos_contatos": [],
+                    "token_usage": gate["token_usage"] + summary_tokens
+                }
+            if gate is not None:
+                metrics.increment("followup_cascade", outcome="escalated")
+                summary_tokens += gate["token_usage"]
+        
+        # --- RAG QUERY BUILDER ---
+        rag_query = ""
+        if conversation_history_db:
+            recent_msgs = conversation_history_db[-3:]
+            rag_query = " | ".join([m.get('content', '') for m in recent_msgs])
+        elif mode == 'initial':
+            rag_query = INITIAL_RAG_QUERY
+
+        # Contexto idêntico para todos os contatos da campanha: usa o pré-calculado na sincronização
+        use_initial_cache = rag_query == INITIAL_RAG_QUERY and config.initial_rag_context is not None
+        calendar_enabled = bool(config.is_calendar_active and config.google_calendar_credentials and config.available_hours)
+
+        # RAG (embedding + busca vetorial) e agenda são independentes: buscados em paralelo, cada um com seu prazo
+        context_started_at = time.monotonic()
+        rag_rows, busy_slots_text = await asyncio.gather(
+            self._load_rag_rows_with_timeout(config, rag_query) if not use_initial_cache else asyncio.sleep(0, result=[]),
+            self._load_busy_slots_with_timeout(config) if calendar_enabled else asyncio.sleep(0, result=None)
+        )
+        metrics.observe("context_assembly_ms", (time.monotonic() - context_started_at) * 1000, part="total")
+        
+        # System Instruction (Prompt Fixo)
+        system_instruction = config.prompt or "Você é um assistente de prospecção."
+        
+        # --- TIME CONTEXT ---
+        time_context = self._get_time_context()
+
+        # --- CALENDAR CONTEXT ---
+        calendar_context = ""
+        if calendar_enabled:
+            calendar_context = (
+                f"\n# DISPONIBILIDADE DE AGENDA\n"
+                f"Seu padrão de horários disponíveis: {json.dumps(config.available_hours, ensure_ascii=False)}.\n"
+                f"{busy_slots_text}\n"
+                f"REGRAS DE AGENDAMENTO:\n"
+                f"1. Verifique se o horário proposto pelo cliente não conflita com os compromissos listados acima.\n"
+                f"2. Proponha apenas horários dentro do seu padrão de disponibilidade.\n"
+                f"3. Se o cliente confirmar, solicite o e-mail. Com horário E e-mail, use a ação 'agendar_reuniao'.\n"
+            )
+
+        # --- ORÇAMENTO DE TOKENS ---
+        # Prioridade: instruções fixas > mensagens recentes > RAG (mais similares entre todas as origens) > agenda
+        packer = PromptPacker(settings.PROMPT_TOKEN_BUDGET)
+        packer.reserve("instrucoes", system_instruction)
+        packer.reserve("instrucoes", self._render_conversation_prompt("", "", "", contact, time_context, task_map.get(mode, 'Responder')))
+
+        history_parts = []
+        if history_summary and packer.add("historico", history_summary):
+            history_parts.append(f"[Resumo das mensagens anteriores]\n{history_summary}")
+        kept_lines = packer.add_tail("historico", history_lines)
+        if kept_lines:
+            history_parts.append("\n".join(kept_lines))
+        formatted_history = "\n\n".join(history_parts) or "Nenhuma mensagem no histórico."
+
+        if use_initial_cache and packer.add("rag", config.initial_rag_context):
+            rag_context = config.initial_rag_context
+        else:
+            if use_initial_cache:
+                rag_rows = await self._load_rag_rows_with_timeout(config, rag_query)
+            rag_context = self._pack_rag_rows(packer, rag_rows)
+
+        if calendar_context and not packer.add("agenda", calendar_context):
+            calendar_context = ""
+
+        logger.info(f"Prompt (Modo: {mode}): {packer.report()}")
+
+        prompt_text = self._render_conversation_prompt(
+            rag_context, formatted_history, calendar_context, contact, time_context, task_map.get(mode, 'Responder')
+        )
+
         max_retries = 3
         last_error = None
 
         for attempt in range(max_retries):
             try:
-                response, tokens_used = await self._generate_with_retry_async(
-                    prompt_text, 
-                    db, 
-                    user, 
-                    force_json=True, 
-                    system_instruction=system_instruction
-                )
-                response_data = self._parse_json_response(response.text)
+                response_text = None
+                # Streaming só na primeira tentativa: em uma regeneração, as linhas já repassadas não se repetem
+                if on_message_line is not None and settings.GEMINI_STREAMING_ENABLED and attempt == 0:
+                    try:
+                        response_text, tokens_used = await self._generate_stream_async(
+                            prompt_text, user, on_message_line,
+                            model_name=model_name,
+                            system_instruction=system_instruction,
+                            response_schema=CONVERSATION_ACTION_SCHEMA,
+                            route=route
+                        )
+                    except Exception as e:
+                        logger.warning(f"Streaming falhou ({e}). Gerando a resposta sem streaming.")
+                        metrics.increment("gemini_stream_fallback")
+
+                if response_text is None:
+                    response, tokens_used = await self._generate_with_retry_async(
+                        prompt_text, 
+                        db, 
+                        user, 
+                        force_json=True, 
+                        model_name=model_name,
+                        system_instruction=system_instruction,
+                        response_schema=CONVERSATION_ACTION_SCHEMA,
+                        route=route
+                    )
+                    response_text = response.text
+                response_data = self._validate_conversation_action(self._parse_json_response(response_text))
 
                 # A validação de mensagem vazia foi removida, pois a IA pode intencionalmente
                 # decidir não enviar uma mensagem. O agent_worker está preparado para lidar com essa situação.
-                response_data['token_usage'] = tokens_used
+                response_data['token_usage'] = tokens_used + summary_tokens
                 return response_data  # Retorna a resposta válida
 
-            except (json.JSONDecodeError, KeyError) as e:
+            except (json.JSONDecodeError, KeyError, ValueError) as e:
                 logger.warning(f"Tentativa {attempt + 1}/{max_retries}: Erro de formato na resposta da IA ({e}). Tentando novamente...")
+                metrics.increment("gemini_json_regeneration", task="conversation")
                 last_error = f"Erro de formato JSON: {e}"
                 await asyncio.sleep(1)
                 continue
@@ -664,7 +1311,7 @@ class GeminiService:
             "mensagem_para_enviar": None,
             "nova_situacao": "Erro IA",
             "observacoes": f"Falha da IA após {max_retries} tentativas: {last_error}",
-            "token_usage": 0
+            "token_usage": summary_tokens
         }
 
     async def analyze_prospecting_data(
@@ -677,33 +1324,24 @@ class GeminiService:
         prospect_ids: Optional[List[int]] = None
     ) -> Dict[str, Any]:
         """Usa a IA para analisar dados de prospecção com base em uma pergunta do usuário."""
-        from app.crud import crud_prospect, crud_config
+        from app.crud import crud_prospect
 
         logger.info(f"Iniciando análise de dados de prospecção para user_id={user.id} com a pergunta: '{question[:100]}...'")
 
-        # Coletar dados relevantes
-        prospects = await crud_prospect.get_prospects_by_user(db, user_id=user.id)
-        simplified_prospects = []
-        for p in prospects:
-            if prospect_ids and p.id not in prospect_ids:
-                continue
-
-            p_date = p.created_at.replace(tzinfo=timezone.utc)
-            if start_date and p_date < start_date:
-                continue
-            if end_date and p_date > end_date:
-                continue
+        # Coletar dados relevantes (agregados no banco)
+        simplified_prospects = await crud_prospect.get_prospecting_summary(
+            db, user_id=user.id, start_date=start_date, end_date=end_date, prospect_ids=prospect_ids
+        )
 
-            contacts_summary = {
-                "total": len(p.contacts),
-                "concluido": sum(1 for c in p.contacts if c.situacao == 'Concluído'),
-                "lead_qualificado": sum(1 for c in p.contacts if c.situacao == 'Lead Qualificado'),
-                "aguardando_resposta": sum(1 for c in p.contacts if c.situacao == 'Aguardando Resposta'),
-            }
-            simplified_prospects.append({
-                "id": p.id, "nome": p.nome_prospeccao, "status": p.status,
-                "created_at": p.created_at.isoformat(), "contacts_summary": contacts_summary
-            })
+        # Cache por (usuário, pergunta, impressão digital dos dados): a mesma pergunta sobre os mesmos números não chama a IA de novo
+        fingerprint = hashlib.sha256(json.dumps(simplified_prospects, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        cache_key = (user.id, " ".join(question.lower().split()), fingerprint)
+        cached = self._analysis_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < settings.ANALYSIS_CACHE_TTL_SECONDS:
+            metrics.increment("prospecting_analysis_cache", result="hit")
+            logger.info(f"Análise de dados de prospecção servida do cache para user_id={user.id}.")
+            return cached[1]
+        metrics.increment("prospecting_analysis_cache", result="miss")
 
         analysis_prompt = {
             "objetivo": "Você é um analista de vendas sênior. Analise os dados de prospecção fornecidos para responder à pergunta do usuário. Sua resposta DEVE ser um objeto JSON.",
@@ -728,8 +1366,16 @@ class GeminiService:
             }
         }
         
-        response, _ = await self._generate_with_retry_async(json.dumps(analysis_prompt, ensure_ascii=False, cls=SetEncoder), db, user, force_json=True)
-        return self._parse_json_response(response.text)
+        response, _ = await self._generate_with_retry_async(
+            json.dumps(analysis_prompt, ensure_ascii=False, cls=SetEncoder), db, user, force_json=True,
+            model_name=self._route_model("dashboard_analysis"), route="dashboard_analysis"
+        )
+        analysis = self._parse_json_response(response.text)
+
+        if len(self._analysis_cache) >= ANALYSIS_CACHE_MAX_ENTRIES:
+            self._analysis_cache.pop(next(iter(self._analysis_cache)))
+        self._analysis_cache[cache_key] = (time.monotonic(), analysis)
+        return analysis
 
 _gemini_service_instance = None
 def get_gemini_service():
@@ -6,6 +6,8 @@ from typing import Optional, Dict, Any, List
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 from app.core.config import settings
 from app.db import models
 
@@ -18,6 +20,9 @@ class GoogleCalendarService:
     def __init__(self, config: Optional[models.Config] = None):
         self.config = config
         self.flow: Optional[Flow] = None
+        # Cliente da Calendar API e credenciais reaproveitados entre chamadas (o token renovado fica em memória)
+        self._credentials: Optional[Credentials] = None
+        self._service = None
 
     def _create_flow(self, redirect_uri_override: Optional[str] = None) -> Flow:
         """Cria uma instância do fluxo de autorização do Google."""
@@ -78,6 +83,19 @@ class GoogleCalendarService:
             return None
         return Credentials.from_authorized_user_info(self.config.google_calendar_credentials, SCOPES)
 
+    def _get_cached_service(self):
+        """Cliente da Calendar API criado uma única vez por configuração (o build é síncrono e custoso)."""
+        if self._service is None:
+            self._credentials = self._get_credentials()
+            if not self._credentials:
+                raise Exception("Configuração não autenticada com o Google Calendar.")
+            self._service = build('calendar', 'v3', credentials=self._credentials, cache_discovery=False)
+        return self._service
+
+    def _new_http(self) -> AuthorizedHttp:
+        # httplib2 não é thread-safe: cada requisição no executor usa a sua própria conexão
+        return AuthorizedHttp(self._credentials, http=httplib2.Http())
+
     def get_service(self):
         """Cria o cliente de serviço da Calendar API."""
         credentials = self._get_credentials()
@@ -88,21 +106,20 @@ class GoogleCalendarService:
     async def get_upcoming_events(self, days: int = 7) -> List[Dict[str, Any]]:
         """Busca eventos agendados para os próximos X dias."""
         try:
-            service = self.get_service()
             now = datetime.now(timezone.utc).isoformat()
             end_time = (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
             
-            # Executa em um executor pois a biblioteca do Google é síncrona
+            # Executa em um executor pois a biblioteca do Google é síncrona (inclusive a criação do cliente)
             loop = asyncio.get_running_loop()
             events_result = await loop.run_in_executor(
                 None,
-                lambda: service.events().list(
+                lambda: self._get_cached_service().events().list(
                     calendarId='primary',
                     timeMin=now,
                     timeMax=end_time,
                     singleEvents=True,
                     orderBy='startTime'
-                ).execute()
+                ).execute(http=self._new_http())
             )
             events = events_result.get('items', [])
             
@@ -120,5 +137,14 @@ class GoogleCalendarService:
             logger.error(f"Erro ao buscar eventos do Google Calendar: {e}")
             return []
 
+# Serviços por configuração, reaproveitados enquanto as credenciais salvas não mudarem
+_calendar_services: Dict[int, GoogleCalendarService] = {}
+
 def get_google_calendar_service(config: models.Config) -> GoogleCalendarService:
-    return GoogleCalendarService(config=config)
+    cached = _calendar_services.get(config.id)
+    if cached is not None and cached.config.google_calendar_credentials == config.google_calendar_credentials:
+        cached.config = config
+        return cached
+    service = GoogleCalendarService(config=config)
+    _calendar_services[config.id] = service
+    return service
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import multiprocessing
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_TIMEOUT_SECONDS = 60
+
+# Remove o silêncio do início e encurta pausas longas (> 1s) no meio do áudio
+SILENCE_FILTER = (
+    "silenceremove=start_periods=1:start_threshold=-45dB:start_silence=0.2"
+    ":stop_periods=-1:stop_duration=1:stop_threshold=-45dB"
+)
+
+
+def _run_ffmpeg(args: list, data: bytes) -> bytes:
+    """Executa o ffmpeg lendo a mídia do stdin e devolvendo a saída do stdout."""
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", *args, "pipe:1"],
+        input=data, capture_output=True, timeout=FFMPEG_TIMEOUT_SECONDS, check=False
+    )
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(result.stderr.decode("utf-8", errors="ignore").strip() or f"ffmpeg retornou {result.returncode}")
+    return result.stdout
+
+
+def preprocess_audio(data: bytes, bitrate: str) -> bytes:
+    """Converte o áudio para Opus mono 16 kHz em baixa taxa de bits, sem os silêncios."""
+    return _run_ffmpeg(
+        ["-vn", "-af", SILENCE_FILTER, "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", bitrate, "-f", "ogg"],
+        data
+    )
+
+
+def preprocess_image(data: bytes, max_edge: int) -> bytes:
+    """Reduz a imagem para no máximo 'max_edge' pixels no maior lado (sem ampliar) e recodifica em JPEG."""
+    scale = f"scale='min(iw,{max_edge})':'min(ih,{max_edge})':force_original_aspect_ratio=decrease"
+    return _run_ffmpeg(
+        ["-frames:v", "1", "-vf", scale, "-c:v", "mjpeg", "-q:v", "4", "-f", "image2pipe"],
+        data
+    )
+
+
+class MediaPreprocessor:
+    """
+    Etapa de pré-processamento das mídias antes do envio ao Gemini (áudio e imagens), executada com ffmpeg
+    num pool de processos para não bloquear o event loop. Em qualquer falha, a mídia original é mantida.
+    """
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._ffmpeg_available = shutil.which("ffmpeg") is not None
+        if settings.MEDIA_PREPROCESS_ENABLED and not self._ffmpeg_available:
+            logger.warning("ffmpeg não encontrado: mídias serão enviadas ao Gemini sem pré-processamento.")
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # 'spawn' evita herdar (via fork) threads e conexões abertas do processo principal
+            self._executor = ProcessPoolExecutor(
+                max_workers=settings.MEDIA_PREPROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def preprocess(self, data: bytes, mime_type: str) -> Tuple[bytes, str]:
+        """Retorna (bytes, mime_type) da mídia otimizada, ou a original se não houver ganho."""
+        if not settings.MEDIA_PREPROCESS_ENABLED or not self._ffmpeg_available or not data or not mime_type:
+            return data, mime_type
+
+        if mime_type.startswith("audio/"):
+            kind, func, arg, new_mime = "audio", preprocess_audio, settings.MEDIA_AUDIO_BITRATE, "audio/ogg"
+        elif mime_type.startswith("image/") and mime_type != "image/gif":
+            kind, func, arg, new_mime = "image", preprocess_image, settings.MEDIA_IMAGE_MAX_EDGE, "image/jpeg"
+        else:
+            return data, mime_type
+
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            processed = await loop.run_in_executor(self._get_executor(), func, data, arg)
+        except Exception as e:
+            metrics.increment("media_preprocess_errors", kind=kind)
+            logger.warning(f"Falha no pré-processamento de mídia ({mime_type}); usando o original. Erro: {e}")
+            return data, mime_type
+        finally:
+            metrics.observe("media_preprocess_ms", (time.perf_counter() - start) * 1000, kind=kind)
+
+        if len(processed) >= len(data):
+            return data, mime_type
+        metrics.increment("media_preprocess_bytes_saved", len(data) - len(processed), kind=kind)
+        logger.info(f"Mídia {mime_type} pré-processada: {len(data)} -> {len(processed)} bytes.")
+        return processed, new_mime
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+_media_preprocessor = None
+def get_media_preprocessor() -> MediaPreprocessor:
+    global _media_preprocessor
+    if _media_preprocessor is None:
+        _media_preprocessor = MediaPreprocessor()
+    return _media_preprocessor
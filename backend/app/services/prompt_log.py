@@ -0,0 +1,187 @@
+import os
+import sys
+import gzip
+import json
+import time
+import queue
+import atexit
+import random
+import shutil
+import hashlib
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+from google.genai import types
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _process_log_path(path: str) -> str:
+    """
+    Caminho do prompt log deste processo. API e workers montam o mesmo diretório e o RotatingFileHandler
+    não é seguro entre processos: cada papel grava e rotaciona o seu próprio arquivo.
+    """
+    role = settings.PROMPT_LOG_ROLE or os.path.splitext(os.path.basename(sys.argv[0] or ""))[0]
+    if not role or role.startswith("-"):
+        role = "app"
+    root, ext = os.path.splitext(path)
+    return f"{root}.{role}{ext}"
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotaciona o arquivo ao atingir o tamanho máximo OU a idade máxima, comprimindo os arquivos antigos (gzip)."""
+    def __init__(self, filename: str, max_bytes: int, max_age_seconds: int, backup_count: int, compress: bool):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.max_age_seconds = max_age_seconds
+        self._started_at = time.time()
+        if compress:
+            self.namer = lambda name: f"{name}.gz"
+            self.rotator = self._gzip_rotator
+
+    @staticmethod
+    def _gzip_rotator(source: str, dest: str):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def _file_started_at(self) -> float:
+        """Idade do arquivo pelo primeiro registro (o arquivo sobrevive a reinícios); sem registro legível, pela data de modificação."""
+        try:
+            with open(self.baseFilename, encoding="utf-8") as f:
+                return datetime.fromisoformat(json.loads(f.readline())["ts"]).timestamp()
+        except FileNotFoundError:
+            return time.time()
+        except (OSError, ValueError, KeyError, TypeError):
+            try:
+                return os.path.getmtime(self.baseFilename)
+            except OSError:
+                return time.time()
+
+    def _open(self):
+        self._started_at = self._file_started_at()
+        return super()._open()
+
+    def shouldRollover(self, record: logging.LogRecord) -> int:
+        if self.stream is None:
+            self.stream = self._open()
+        if self.max_age_seconds and self.stream.tell() and time.time() - self._started_at >= self.max_age_seconds:
+            return 1
+        return super().shouldRollover(record)
+
+
+class PromptLogWriter:
+    """
+    Registra prompts e respostas do Gemini em JSONL, fora do caminho crítico.
+    O chamador apenas enfileira o registro; a escrita em disco, a rotação e a compressão
+    acontecem na thread do QueueListener.
+
+    Modos (PROMPT_LOG_MODE): 'off', 'errors' (apenas chamadas com erro) ou 'full' (amostrado por PROMPT_LOG_SAMPLE_RATE).
+    """
+    def __init__(self):
+        self.mode = settings.PROMPT_LOG_MODE
+        self.sample_rate = settings.PROMPT_LOG_SAMPLE_RATE
+        self.include_system = settings.PROMPT_LOG_INCLUDE_SYSTEM
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._logger = logging.getLogger("prompt_log")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+
+        if self.mode == "off":
+            return
+
+        path = _process_log_path(settings.PROMPT_LOG_PATH)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        file_handler = SizeAndTimeRotatingFileHandler(
+            path,
+            max_bytes=settings.PROMPT_LOG_MAX_BYTES,
+            max_age_seconds=settings.PROMPT_LOG_MAX_AGE_HOURS * 3600,
+            backup_count=settings.PROMPT_LOG_BACKUP_COUNT,
+            compress=settings.PROMPT_LOG_COMPRESS
+        )
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        log_queue = queue.SimpleQueue()
+        self._logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self._listener = logging.handlers.QueueListener(log_queue, file_handler)
+        self._listener.start()
+        atexit.register(self.stop)
+
+    def should_log(self, is_error: bool) -> bool:
+        if self.mode == "off":
+            return False
+        if self.mode == "errors":
+            return is_error
+        return is_error or random.random() < self.sample_rate
+
+    def _serialize_prompt(self, prompt: Any) -> list:
+        """Converte o prompt em uma lista serializável, substituindo mídias por um marcador (nunca grava os bytes)."""
+        items = prompt if isinstance(prompt, list) else [prompt]
+        serialized = []
+        for part in items:
+            if isinstance(part, str):
+                serialized.append(part)
+            elif isinstance(part, types.Part) and part.inline_data:
+                data = part.inline_data.data or b""
+                serialized.append({"media": part.inline_data.mime_type or "unknown", "bytes": len(data)})
+            elif hasattr(part, 'text') and part.text:
+                serialized.append(part.text)
+            else:
+                serialized.append(f"[{type(part).__name__} object]")
+        return serialized
+
+    def record(
+        self,
+        *,
+        model: str,
+        prompt: Any,
+        system_instruction: Optional[str] = None,
+        response_text: Optional[str] = None,
+        error: Optional[str] = None,
+        user_id: Optional[int] = None,
+        tokens: Optional[int] = None,
+        latency_ms: Optional[float] = None
+    ):
+        """Enfileira um registro de chamada. Nunca bloqueia nem levanta exceção."""
+        try:
+            if not self.should_log(is_error=error is not None):
+                return
+
+            entry = {
+                "ts": datetime.now(timezone.utc).isoformat(),
+                "model": model,
+                "user_id": user_id,
+                "latency_ms": round(latency_ms, 1) if latency_ms is not None else None,
+                "tokens": tokens,
+                "prompt": self._serialize_prompt(prompt),
+                "response": response_text,
+                "error": error,
+            }
+            if system_instruction:
+                if self.include_system:
+                    entry["system_instruction"] = system_instruction
+                else:
+                    # O prompt de sistema é fixo por configuração: grava apenas a impressão digital
+                    entry["system_instruction_sha256"] = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()
+                    entry["system_instruction_chars"] = len(system_instruction)
+
+            self._logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+        except Exception as e:
+            logger.error(f"Erro ao enfileirar registro do prompt log: {e}")
+
+    def stop(self):
+        """Esvazia a fila e encerra a thread de escrita."""
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+
+
+_prompt_log_writer = None
+def get_prompt_log_writer():
+    global _prompt_log_writer
+    if _prompt_log_writer is None:
+        _prompt_log_writer = PromptLogWriter()
+    return _prompt_log_writer
@@ -0,0 +1,69 @@
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Média aproximada de caracteres por token do Gemini para texto em português
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Estimativa local de tokens (sem chamada à API), suficiente para controle de orçamento."""
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+class PromptPacker:
+    """
+    Distribui um orçamento de tokens entre as seções do prompt, na ordem em que são adicionadas.
+    Seções obrigatórias entram sempre (mesmo estourando o orçamento); as demais só entram se couberem.
+    """
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self.filled: Dict[str, int] = {}
+        self.dropped: Dict[str, int] = {}
+
+    @property
+    def remaining(self) -> int:
+        return max(self.budget - self.used, 0)
+
+    def reserve(self, section: str, text: str):
+        """Contabiliza uma seção obrigatória."""
+        tokens = estimate_tokens(text)
+        self.used += tokens
+        self.filled[section] = self.filled.get(section, 0) + tokens
+
+    def take(self, section: str, tokens: int) -> bool:
+        """Consome 'tokens' do orçamento para a seção, se couberem. Retorna False (e registra o descarte) caso contrário."""
+        if tokens > self.remaining:
+            self.dropped[section] = self.dropped.get(section, 0) + 1
+            return False
+        self.used += tokens
+        self.filled[section] = self.filled.get(section, 0) + tokens
+        return True
+
+    def add(self, section: str, text: str) -> bool:
+        """Adiciona um bloco inteiro, se couber."""
+        return self.take(section, estimate_tokens(text))
+
+    def add_tail(self, section: str, items: List[str]) -> List[str]:
+        """Mantém os itens mais recentes (do fim da lista) que couberem, preservando a ordem original."""
+        kept = []
+        for item in reversed(items):
+            # +1 pela quebra de linha entre os itens
+            if not self.take(section, estimate_tokens(item) + 1):
+                self.dropped[section] += len(items) - len(kept) - 1
+                break
+            kept.append(item)
+        kept.reverse()
+        return kept
+
+    def report(self) -> str:
+        filled = ", ".join(f"{name}={tokens}" for name, tokens in self.filled.items())
+        report = f"orçamento={self.budget}, usado={self.used} ({filled})"
+        if self.dropped:
+            dropped = ", ".join(f"{name}={count}" for name, count in self.dropped.items())
+            report += f", descartados: {dropped}"
+        return report
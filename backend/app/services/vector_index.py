@@ -0,0 +1,177 @@
+import os
+import json
+import glob
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db import models
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigVectorIndex:
+    """
+    Índice vetorial em memória de uma configuração.
+    A matriz é contígua, normalizada (para similaridade por cosseno) e agrupada por origem,
+    de modo que cada origem ocupa um intervalo [início, fim) de linhas.
+    """
+    def __init__(self, config_id: int, version: int, matrix: np.ndarray, origins: List[Tuple[str, int, int]], contents: List[str]):
+        self.config_id = config_id
+        self.version = version
+        self.matrix = matrix
+        self.origins = origins
+        self.contents = contents
+
+    def search(self, query_embedding: List[float], k: int = 10) -> Dict[str, List[Tuple[str, float]]]:
+        """Retorna os k conteúdos mais similares de cada origem, do mais para o menos similar."""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0 or self.matrix.shape[0] == 0:
+            return {}
+        query = query / norm
+
+        # Um único produto matriz-vetor para todas as linhas
+        scores = np.asarray(self.matrix @ query, dtype=np.float32)
+
+        results = {}
+        for origin, start, end in self.origins:
+            origin_scores = scores[start:end]
+            if origin_scores.size == 0:
+                continue
+            top_k = min(k, origin_scores.size)
+            top_idx = np.argpartition(-origin_scores, top_k - 1)[:top_k]
+            top_idx = top_idx[np.argsort(-origin_scores[top_idx])]
+            results[origin] = [(self.contents[start + i], float(origin_scores[i])) for i in top_idx]
+        return results
+
+
+class VectorIndexStore:
+    """
+    Mantém os índices por configuração, persistidos como snapshots memory-mapped em disco.
+    Os arquivos são nomeados por (config_id, rag_version), permitindo que vários processos
+    (API e workers) compartilhem as mesmas páginas de memória.
+    """
+    def __init__(self, base_dir: Optional[str] = None):
+        self.base_dir = base_dir or settings.VECTOR_INDEX_DIR
+        self.dtype = np.float16 if settings.VECTOR_INDEX_DTYPE == "float16" else np.float32
+        self._indexes: Dict[int, ConfigVectorIndex] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    def _paths(self, config_id: int, version: int) -> Tuple[str, str]:
+        prefix = os.path.join(self.base_dir, f"config_{config_id}_v{version}")
+        return f"{prefix}.npy", f"{prefix}.json"
+
+    def _load_snapshot(self, config_id: int, version: int) -> Optional[ConfigVectorIndex]:
+        matrix_path, meta_path = self._paths(config_id, version)
+        if not (os.path.exists(matrix_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        matrix = np.load(matrix_path, mmap_mode="r")
+        origins = [(o["origin"], o["start"], o["end"]) for o in meta["origins"]]
+        return ConfigVectorIndex(config_id, version, matrix, origins, meta["contents"])
+
+    def _write_snapshot(self, config_id: int, version: int, matrix: np.ndarray, origins: List[Tuple[str, int, int]], contents: List[str]):
+        os.makedirs(self.base_dir, exist_ok=True)
+        matrix_path, meta_path = self._paths(config_id, version)
+        pid = os.getpid()
+
+        # Escrita atômica: grava em arquivo temporário e renomeia
+        tmp_matrix = f"{matrix_path}.{pid}.tmp"
+        with open(tmp_matrix, "wb") as f:
+            np.save(f, matrix)
+        tmp_meta = f"{meta_path}.{pid}.tmp"
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump({
+                "origins": [{"origin": o, "start": s, "end": e} for o, s, e in origins],
+                "contents": contents
+            }, f, ensure_ascii=False)
+
+        os.replace(tmp_meta, meta_path)
+        os.replace(tmp_matrix, matrix_path)
+
+    async def _build_from_db(self, db: AsyncSession, config_id: int, version: int) -> ConfigVectorIndex:
+        stmt = select(
+            models.KnowledgeVector.origin,
+            models.KnowledgeVector.content,
+            models.KnowledgeVector.embedding
+        ).where(
+            models.KnowledgeVector.config_id == config_id,
+            models.KnowledgeVector.embedding.is_not(None)
+        ).order_by(models.KnowledgeVector.origin, models.KnowledgeVector.id)
+        rows = (await db.execute(stmt)).all()
+
+        def build():
+            contents = [r.content for r in rows]
+            origins = []
+            for i, r in enumerate(rows):
+                if origins and origins[-1][0] == r.origin:
+                    origins[-1] = (r.origin, origins[-1][1], i + 1)
+                else:
+                    origins.append((r.origin, i, i + 1))
+
+            if rows:
+                matrix = np.vstack([np.asarray(r.embedding, dtype=np.float32) for r in rows])
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                matrix = np.ascontiguousarray(matrix / norms, dtype=self.dtype)
+            else:
+                matrix = np.zeros((0, 768), dtype=self.dtype)
+
+            self._write_snapshot(config_id, version, matrix, origins, contents)
+            return self._load_snapshot(config_id, version)
+
+        index = await asyncio.to_thread(build)
+        logger.info(f"Índice vetorial: snapshot criado para config {config_id} (v{version}, {len(rows)} vetores).")
+        return index
+
+    async def get_index(self, db: AsyncSession, config_id: int, version: int) -> ConfigVectorIndex:
+        """
+        Retorna o índice da configuração na versão pedida.
+        Ordem: memória do processo -> snapshot em disco (mmap) -> reconstrução a partir do banco.
+        """
+        index = self._indexes.get(config_id)
+        if index and index.version == version:
+            return index
+
+        lock = self._locks.setdefault(config_id, asyncio.Lock())
+        async with lock:
+            index = self._indexes.get(config_id)
+            if index and index.version == version:
+                return index
+
+            index = await asyncio.to_thread(self._load_snapshot, config_id, version)
+            if index is None:
+                index = await self._build_from_db(db, config_id, version)
+
+            self._indexes[config_id] = index
+            return index
+
+    def invalidate(self, config_id: int, current_version: Optional[int] = None):
+        """
+        Descarta o índice em memória e remove os snapshots antigos da configuração (chamado após re-sincronização).
+        O snapshot da versão atual, se já tiver sido criado por outro processo, é preservado.
+        """
+        self._indexes.pop(config_id, None)
+        keep_prefix = f"config_{config_id}_v{current_version}." if current_version is not None else None
+        for path in glob.glob(os.path.join(self.base_dir, f"config_{config_id}_v*")):
+            if keep_prefix and os.path.basename(path).startswith(keep_prefix):
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Índice vetorial: não foi possível remover o snapshot {path}: {e}")
+
+
+_vector_index_store = None
+def get_vector_index_store():
+    global _vector_index_store
+    if _vector_index_store is None:
+        _vector_index_store = VectorIndexStore()
+    return _vector_index_store
@@ -1,17 +1,172 @@
 import httpx
 from app.core.config import settings
+from app.core.metrics import metrics
 import logging
 import json
+import time
+import hashlib
 from typing import Dict, Any, List, Optional
 import base64
 import asyncio
 import asyncpg
-from sqlalchemy import select
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.db import models
+from app.services.evolution_indexes import PHONE_SUFFIX_LENGTH, SENT_TEXT_MD5_SQL, jid_suffix_sql
 
 logger = logging.getLogger(__name__)
 
+# Prazos (em segundos) por endpoint da Evolution API; os demais usam EVOLUTION_HTTP_TIMEOUT
+EVOLUTION_ENDPOINT_TIMEOUTS = {
+    "instance/create": 120.0,
+    "instance/connect": 120.0,
+    "message/sendText": 30.0,
+    "message/sendMedia": 120.0,
+    "message/sendWhatsAppAudio": 60.0,
+    "chat/getBase64FromMediaMessage": 60.0,
+    "chat/findContacts": 30.0,
+    "chat/whatsappNumbers": 30.0,
+    "chat/sendPresence": 5.0,
+    "group/fetchAllGroups": 30.0,
+}
+
+# Consultas do histórico na tabela "Message" da Evolution (ver app/utils/create_evolution_indexes.py)
+HISTORY_BY_JIDS_QUERY = """
+    SELECT "key", "message", "messageTimestamp", "pushName", "status"
+    FROM "Message"
+    WHERE "instanceId" = $1
+      AND (
+        "key"->>'remoteJid' = ANY($2::text[])
+        OR "key"->>'remoteJidAlt' = ANY($2::text[])
+      )
+      AND "messageTimestamp" >= $4
+    ORDER BY "messageTimestamp" DESC
+    LIMIT $3
+"""
+
+# Busca do histórico pelo final do número (sem DDI/DDD/9º dígito); usa os índices de sufixo, se criados
+HISTORY_BY_PHONE_SUFFIX_QUERY = f"""
+    SELECT "key", "message", "messageTimestamp", "pushName", "status"
+    FROM "Message"
+    WHERE "instanceId" = $1
+      AND ({jid_suffix_sql('remoteJid')} = $2 OR {jid_suffix_sql('remoteJidAlt')} = $2)
+      AND "messageTimestamp" >= $4
+    ORDER BY "messageTimestamp" DESC
+    LIMIT $3
+"""
+
+# Conversas das mensagens enviadas, pelo md5 do texto; usa o índice prospectai_message_sent_text_md5, se criado
+SENT_TEXT_LOOKUP_QUERY = f"""
+    SELECT {SENT_TEXT_MD5_SQL} AS content_md5,
+           count(DISTINCT "key"->>'remoteJid') AS chats,
+           max("key"->>'remoteJid') AS remote_jid
+    FROM "Message"
+    WHERE "instanceId" = $1
+      AND "key"->>'fromMe' = 'true'
+      AND {SENT_TEXT_MD5_SQL} = ANY($2::text[])
+    GROUP BY 1
+"""
+
+# Última mensagem de cada conversa da instância, usada para (re)construir a tabela chat_summaries
+CHAT_SUMMARIES_REBUILD_QUERY = """
+    WITH LatestMessages AS (
+        -- O DISTINCT ON garante uma única linha por conversa; prioriza remoteJidAlt para não duplicar chats vinculados
+        SELECT DISTINCT ON (COALESCE("key"->>'remoteJidAlt', "key"->>'remoteJid'))
+            COALESCE("key"->>'remoteJidAlt', "key"->>'remoteJid') as "remoteJid",
+            "message",
+            "key",
+            "status",
+            "messageTimestamp",
+            "instanceId",
+            "pushName"
+        FROM "Message"
+        WHERE "instanceId" = $1
+        ORDER BY COALESCE("key"->>'remoteJidAlt', "key"->>'remoteJid'), "messageTimestamp" DESC
+    )
+    SELECT 
+        lm."remoteJid",
+        lm."pushName" as last_message_sender,
+        c."pushName" as display_name,
+        c."profilePicUrl",
+        c."updatedAt",
+        lm.message,
+        lm.key,
+        lm.status,
+        lm."messageTimestamp"
+    FROM LatestMessages lm
+    -- Enriquece os dados da mensagem com informações do contato (nome, foto)
+    LEFT JOIN "Contact" c ON c."remoteJid" = lm."remoteJid" AND c."instanceId" = lm."instanceId"
+"""
+
+# Conversas exibidas na lista: individuais, grupos e identidades vinculadas (LID)
+CHAT_JID_SUFFIXES = ("@s.whatsapp.net", "@g.us", "@lid")
+
+IS_ON_WHATSAPP_BULK_QUERY = 'SELECT "remoteJid", "jidOptions" FROM "IsOnWhatsapp" WHERE "remoteJid" = ANY($1::text[])'
+
+def _json_obj(value: Any) -> Dict[str, Any]:
+    return (json.loads(value) if isinstance(value, str) else value) or {}
+
+
+def _chat_preview(msg_obj: Dict[str, Any]) -> str:
+    """Conteúdo textual da mensagem ou um marcador de mídia, para exibição na lista de conversas."""
+    if not msg_obj:
+        return ""
+    content = msg_obj.get("conversation") or msg_obj.get("extendedTextMessage", {}).get("text", "")
+    if content:
+        return content
+    if "imageMessage" in msg_obj: return "[Imagem]"
+    if "videoMessage" in msg_obj: return "[Vídeo]"
+    if "audioMessage" in msg_obj: return "[Áudio]"
+    if "documentMessage" in msg_obj: return "[Documento]"
+    if "stickerMessage" in msg_obj: return "[Figurinha]"
+    return "[Mídia]"
+
+
+def chat_summary_from_message(message_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Colunas de chat_summaries a partir de uma mensagem da Evolution (webhook, resposta de envio ou tabela "Message")."""
+    key = _json_obj(message_data.get("key"))
+    remote_jid = key.get("remoteJidAlt") or key.get("remoteJid")
+    if not remote_jid or not remote_jid.endswith(CHAT_JID_SUFFIXES):
+        return None
+    from_me = bool(key.get("fromMe"))
+    try:
+        timestamp = int(message_data.get("messageTimestamp"))
+    except (TypeError, ValueError):
+        timestamp = int(time.time())
+    return {
+        "remote_jid": remote_jid,
+        # O pushName é de quem enviou: o próprio usuário (fromMe) ou um participante, nos grupos
+        "name": None if from_me or "@g.us" in remote_jid else message_data.get("pushName"),
+        "profile_pic_url": None,
+        "last_message": _chat_preview(_json_obj(message_data.get("message"))),
+        "last_message_id": key.get("id"),
+        "last_message_ts": timestamp,
+        "last_message_from_me": from_me,
+        "last_message_sender": message_data.get("pushName"),
+        "status": message_data.get("status"),
+        "unread": not from_me,
+    }
+
+
+def _parse_jid_options(value: Any) -> List[str]:
+    """Lista de JIDs do campo jidOptions do IsOnWhatsapp (JSON com objetos {"jid": ...} ou CSV)."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            return [j.strip() for j in value.split(',') if j.strip()]
+    if isinstance(value, str):
+        return [j.strip() for j in value.split(',') if j.strip()]
+    jids = []
+    for item in value if isinstance(value, list) else []:
+        jid = item.get("jid") if isinstance(item, dict) else item
+        if isinstance(jid, str) and jid.strip():
+            jids.append(jid.strip())
+    return jids
+
 class MessageSendError(Exception):
     pass
 
@@ -21,6 +176,114 @@ class WhatsAppService:
         self.api_key = settings.EVOLUTION_API_KEY
         self.headers = {"apikey": self.api_key, "Content-Type": "application/json"}
         self.db_url = getattr(settings, "EVOLUTION_DATABASE_URL", None)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._db_pool: Optional[asyncpg.Pool] = None
+        self._db_pool_lock = asyncio.Lock()
+        # Cache nome da instância -> id no banco da Evolution (invalidado ao recriar a instância)
+        self._instance_ids: Dict[str, str] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Cliente HTTP único do processo, com conexões keep-alive reaproveitadas entre as chamadas."""
+        if self._client is None or self._client.is_closed:
+            http2 = settings.EVOLUTION_HTTP2
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    logger.warning("EVOLUTION_HTTP2 habilitado, mas o pacote 'h2' não está instalado. Usando HTTP/1.1.")
+                    http2 = False
+            self._client = httpx.AsyncClient(
+                headers=self.headers,
+                http2=http2,
+                timeout=settings.EVOLUTION_HTTP_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=settings.EVOLUTION_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.EVOLUTION_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=settings.EVOLUTION_HTTP_KEEPALIVE_EXPIRY
+                )
+            )
+        return self._client
+
+    async def _request(self, method: str, endpoint: str, instance_name: str, instance_in_path: bool = True, **kwargs) -> httpx.Response:
+        """
+        Faz uma chamada à Evolution API pelo cliente compartilhado, com o prazo do endpoint,
+        registrando a latência por endpoint/instância/status.
+        """
+        url = f"{self.api_url}/{endpoint}/{instance_name}" if instance_in_path else f"{self.api_url}/{endpoint}"
+        kwargs.setdefault("timeout", EVOLUTION_ENDPOINT_TIMEOUTS.get(endpoint, settings.EVOLUTION_HTTP_TIMEOUT))
+        status = "error"
+        start = time.perf_counter()
+        try:
+            response = await self._get_client().request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            metrics.observe(
+                "evolution_http_ms", (time.perf_counter() - start) * 1000,
+                endpoint=endpoint, instance=instance_name, status=status
+            )
+
+    async def _get_db_pool(self) -> asyncpg.Pool:
+        """
+        Pool de conexões com o banco da Evolution, criado na primeira leitura. O cache de statements do
+        asyncpg mantém as queries fixas preparadas em cada conexão, então cada leitura custa uma ida ao banco.
+        """
+        if self._db_pool is None:
+            async with self._db_pool_lock:
+                if self._db_pool is None:
+                    # Remove o prefixo '+asyncpg' se presente, pois o driver asyncpg puro não o reconhece
+                    db_url = self.db_url.replace("postgresql+asyncpg://", "postgresql://")
+                    self._db_pool = await asyncpg.create_pool(
+                        db_url,
+                        min_size=settings.EVOLUTION_DB_POOL_MIN_SIZE,
+                        max_size=settings.EVOLUTION_DB_POOL_MAX_SIZE,
+                        statement_cache_size=settings.EVOLUTION_DB_STATEMENT_CACHE_SIZE,
+                        max_inactive_connection_lifetime=300.0,
+                        server_settings={
+                            "statement_timeout": str(settings.EVOLUTION_DB_STATEMENT_TIMEOUT_MS),
+                            "application_name": "prospectai"
+                        }
+                    )
+        return self._db_pool
+
+    @asynccontextmanager
+    async def _evolution_db(self):
+        """Empresta uma conexão do pool do banco da Evolution, registrando a espera pela conexão."""
+        pool = await self._get_db_pool()
+        start = time.perf_counter()
+        async with pool.acquire() as conn:
+            metrics.observe("evolution_db_acquire_ms", (time.perf_counter() - start) * 1000)
+            yield conn
+
+    def db_pool_stats(self) -> dict:
+        """Ocupação atual do pool do banco da Evolution (para o endpoint de métricas)."""
+        if self._db_pool is None:
+            return {"size": 0, "idle": 0, "max_size": settings.EVOLUTION_DB_POOL_MAX_SIZE}
+        return {
+            "size": self._db_pool.get_size(),
+            "idle": self._db_pool.get_idle_size(),
+            "max_size": self._db_pool.get_max_size()
+        }
+
+    async def _get_instance_id(self, conn: asyncpg.Connection, instance_name: str) -> Optional[str]:
+        instance_id = self._instance_ids.get(instance_name)
+        if instance_id is None:
+            instance_id = await conn.fetchval('SELECT id FROM "Instance" WHERE name = $1', instance_name)
+            metrics.increment("evolution_instance_id_cache", result="miss")
+            if instance_id:
+                self._instance_ids[instance_name] = instance_id
+        else:
+            metrics.increment("evolution_instance_id_cache", result="hit")
+        return instance_id
+
+    async def aclose(self):
+        """Fecha o cliente HTTP e o pool do banco da Evolution (shutdown da API e do worker)."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._db_pool is not None:
+            await self._db_pool.close()
+            self._db_pool = None
 
     def _normalize_number(self, number: str) -> str:
         clean_number = "".join(filter(str.isdigit, str(number)))
@@ -40,25 +303,20 @@ class WhatsAppService:
         Útil para recuperar o 'owner' (número conectado).
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.api_url}/instance/fetchInstances",
-                    headers=self.headers,
-                    params={"instanceName": instance_name},
-                    timeout=10.0
-                )
-                response.raise_for_status()
-                data = response.json()
-
-                print(data)
-
-                # A resposta é uma lista.
-                if isinstance(data, list) and len(data) > 0:
-                    item = data[0]
-                    if "instance" in item:
-                        return item.get("instance", {})
-                    return item
-                return {}
+            response = await self._request(
+                "GET", "instance/fetchInstances", instance_name, instance_in_path=False,
+                params={"instanceName": instance_name}
+            )
+            response.raise_for_status()
+            data = response.json()
+
+            # A resposta é uma lista.
+            if isinstance(data, list) and len(data) > 0:
+                item = data[0]
+                if "instance" in item:
+                    return item.get("instance", {})
+                return item
+            return {}
         except Exception as e:
             logger.error(f"Erro ao buscar instância '{instance_name}': {e}")
             return {}
@@ -71,20 +329,15 @@ class WhatsAppService:
         if not instance_name:
             return {"status": "no_instance_name"}
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.api_url}/instance/connectionState/{instance_name}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                response.raise_for_status()
-                data = response.json()
-                # Correção: O estado vem aninhado dentro do objeto 'instance'
-                instance_data = data.get("instance", {})
-                state = instance_data.get("state")
-                if state in ["open", "connected"]:
-                    return {"status": "connected", "instance": instance_data}
-                return {"status": "disconnected", "instance": instance_data}
+            response = await self._request("GET", "instance/connectionState", instance_name)
+            response.raise_for_status()
+            data = response.json()
+            # Correção: O estado vem aninhado dentro do objeto 'instance'
+            instance_data = data.get("instance", {})
+            state = instance_data.get("state")
+            if state in ["open", "connected"]:
+                return {"status": "connected", "instance": instance_data}
+            return {"status": "disconnected", "instance": instance_data}
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
                 logger.warning(f"Instância '{instance_name}' não encontrada na Evolution API. Status: disconnected.")
@@ -103,72 +356,67 @@ class WhatsAppService:
             await self.delete_instance(instance_name)
             await asyncio.sleep(2) # Pausa técnica para a Evolution processar
 
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                # 2. CRIA A INSTÂNCIA NOVA
-                create_payload = {
-                    "instanceName": instance_name,
-                    "qrcode": True,
-                    "syncFullHistory": True,
-                    "integration": "WHATSAPP-BAILEYS",
-                    "webhook": {
-                        "url": settings.WEBHOOK_URL, "enabled": True, "events": ["MESSAGES_UPSERT"]
-                    }
+            # 2. CRIA A INSTÂNCIA NOVA
+            create_payload = {
+                "instanceName": instance_name,
+                "qrcode": True,
+                "syncFullHistory": True,
+                "integration": "WHATSAPP-BAILEYS",
+                "webhook": {
+                    "url": settings.WEBHOOK_URL, "enabled": True, "events": ["MESSAGES_UPSERT"]
                 }
-                
-                # A chamada de criação já retorna o QR Code. Vamos capturar a resposta.
-                create_response = await client.post(
-                    f"{self.api_url}/instance/create",
-                    json=create_payload,
-                    headers=self.headers
-                )
-                create_response.raise_for_status()
-                data = create_response.json()
-
-                # Verifica se já conectou de cara (raro, mas possível)
-                if data.get("instance", {}).get("state") == "open":
-                    return {"status": "connected", "instance": data.get("instance")}
-
-                # --- CORREÇÃO: Lidar com a resposta da API que pode não conter o base64 imediatamente ---
-                # A API pode retornar o pairingCode sem o base64. Se isso acontecer, precisamos buscar o QR Code.
-                qr_code_base64 = data.get("qrcode", {}).get("base64")
-                
-                if not qr_code_base64:
-                    logger.info(f"Base64 do QR Code não veio na criação. Tentando obter via /connect para '{instance_name}'...")
-                    await asyncio.sleep(3) # Pausa para a instância inicializar
-                    connect_response = await client.get(
-                        f"{self.api_url}/instance/connect/{instance_name}",
-                        headers=self.headers,
-                    )
-                    connect_response.raise_for_status()
-                    connect_data = connect_response.json()
-                    qr_code_base64 = connect_data.get("base64")
-
-                if qr_code_base64:
-                     return {
-                         "status": "qrcode", 
-                         "instance": {
-                             "id": data.get("instance", {}).get("instanceId"),
-                             "instanceName": data.get("instance", {}).get("instanceName"),
-                             "qrcode": qr_code_base64
-                         }
+            }
+            
+            # A chamada de criação já retorna o QR Code. Vamos capturar a resposta.
+            create_response = await self._request(
+                "POST", "instance/create", instance_name, instance_in_path=False, json=create_payload
+            )
+            create_response.raise_for_status()
+            data = create_response.json()
+
+            # Verifica se já conectou de cara (raro, mas possível)
+            if data.get("instance", {}).get("state") == "open":
+                return {"status": "connected", "instance": data.get("instance")}
+
+            # --- CORREÇÃO: Lidar com a resposta da API que pode não conter o base64 imediatamente ---
+            # A API pode retornar o pairingCode sem o base64. Se isso acontecer, precisamos buscar o QR Code.
+            qr_code_base64 = data.get("qrcode", {}).get("base64")
+            
+            if not qr_code_base64:
+                logger.info(f"Base64 do QR Code não veio na criação. Tentando obter via /connect para '{instance_name}'...")
+                await asyncio.sleep(3) # Pausa para a instância inicializar
+                connect_response = await self._request("GET", "instance/connect", instance_name)
+                connect_response.raise_for_status()
+                connect_data = connect_response.json()
+                qr_code_base64 = connect_data.get("base64")
+
+            if qr_code_base64:
+                 return {
+                     "status": "qrcode", 
+                     "instance": {
+                         "id": data.get("instance", {}).get("instanceId"),
+                         "instanceName": data.get("instance", {}).get("instanceName"),
+                         "qrcode": qr_code_base64
                      }
+                 }
 
-                return {"status": "error", "detail": "Não foi possível gerar o QR Code após criar a instância."}
+            return {"status": "error", "detail": "Não foi possível gerar o QR Code após criar a instância."}
 
         except Exception as e:
             logger.error(f"Erro no fluxo de conexão forçada: {e}")
             return {"status": "error", "detail": str(e)}
 
     async def disconnect_instance(self, instance_name: str) -> dict:
+        # A instância recriada ganha outro id no banco da Evolution
+        self._instance_ids.pop(instance_name, None)
         try:
-            async with httpx.AsyncClient() as client:
-                # Usamos delete para uma limpeza completa
-                response = await client.delete(f"{self.api_url}/instance/delete/{instance_name}", headers=self.headers)
-                # Mesmo que dê 404 (não encontrada), o objetivo foi alcançado.
-                if response.status_code in [200, 204, 404]:
-                    return {"status": "disconnected"}
-                response.raise_for_status()
-                return {"status": "disconnected"} # Sucesso
+            # Usamos delete para uma limpeza completa
+            response = await self._request("DELETE", "instance/delete", instance_name)
+            # Mesmo que dê 404 (não encontrada), o objetivo foi alcançado.
+            if response.status_code in [200, 204, 404]:
+                return {"status": "disconnected"}
+            response.raise_for_status()
+            return {"status": "disconnected"} # Sucesso
         except Exception as e:
             logger.error(f"Erro ao desconectar/deletar instância '{instance_name}': {e}")
             return {"status": "error", "detail": str(e)}
@@ -186,17 +434,17 @@ class WhatsAppService:
             normalized_number = self._normalize_number(number)
             
         # Rota correta da Evolution API para enviar texto
-        url = f"{self.api_url}/message/sendText/{instance_name}"
         payload = {
             "number": normalized_number, # Número para receber a mensagem
             "text": text                 # O texto da mensagem
         }
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=self.headers, json=payload, timeout=30.0)
-                response.raise_for_status()
-                logger.info(f"Mensagem enviada com sucesso para {normalized_number}.")
-                return response.json()
+            response = await self._request("POST", "message/sendText", instance_name, json=payload)
+            response.raise_for_status()
+            logger.info(f"Mensagem enviada com sucesso para {normalized_number}.")
+            data = response.json()
+            await self.record_chat_message(instance_name, data)
+            return data
         except Exception as e:
             logger.error(f"Falha CRÍTICA ao enviar mensagem para {normalized_number}. Erro: {e}")
             raise MessageSendError(f"Falha no envio: {e}") from e
@@ -207,9 +455,7 @@ class WhatsAppService:
         else:
             normalized_number = self._normalize_number(number)
             
-        # Rota da Evolution API para enviar mídia
-        url = f"{self.api_url}/message/sendMedia/{instance_name}"
-        
+        # Rota da Evolution API para enviar mídia: message/sendMedia
         payload = {
             "number": normalized_number,
             "media": media, # Base64
@@ -220,11 +466,12 @@ class WhatsAppService:
             "delay": delay
         }
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=self.headers, json=payload, timeout=120.0)
-                response.raise_for_status()
-                logger.info(f"Mídia enviada com sucesso para {normalized_number}.")
-                return response.json()
+            response = await self._request("POST", "message/sendMedia", instance_name, json=payload)
+            response.raise_for_status()
+            logger.info(f"Mídia enviada com sucesso para {normalized_number}.")
+            data = response.json()
+            await self.record_chat_message(instance_name, data)
+            return data
         except Exception as e:
             logger.error(f"Falha ao enviar mídia para {normalized_number}. Erro: {e}")
             raise MessageSendError(f"Falha no envio de mídia: {e}") from e
@@ -235,18 +482,18 @@ class WhatsAppService:
         else:
             normalized_number = self._normalize_number(number)
             
-        url = f"{self.api_url}/message/sendWhatsAppAudio/{instance_name}"
         payload = {
             "number": normalized_number,
             "audio": audio_base64,
             "delay": delay
         }
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=self.headers, json=payload, timeout=60.0)
-                response.raise_for_status()
-                logger.info(f"Áudio enviado com sucesso para {normalized_number}.")
-                return response.json()
+            response = await self._request("POST", "message/sendWhatsAppAudio", instance_name, json=payload)
+            response.raise_for_status()
+            logger.info(f"Áudio enviado com sucesso para {normalized_number}.")
+            data = response.json()
+            await self.record_chat_message(instance_name, data)
+            return data
         except Exception as e:
             logger.error(f"Falha ao enviar áudio para {normalized_number}. Erro: {e}")
             raise MessageSendError(f"Falha no envio de áudio: {e}") from e
@@ -284,8 +531,7 @@ class WhatsAppService:
             logger.warning(f"Não foi possível encontrar 'mimetype' no objeto de mídia: {media_info}")
             return None
 
-        # 2. Montar o payload para a API
-        url = f"{self.api_url}/chat/getBase64FromMediaMessage/{instance_name}"
+        # 2. Montar o payload para a API (chat/getBase64FromMediaMessage)
         payload = {
             "message": {
                 "key": {
@@ -297,21 +543,20 @@ class WhatsAppService:
 
         # 3. Fazer a requisição para obter o base64
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=self.headers, json=payload, timeout=60.0)
-                response.raise_for_status()
-                
-                response_data = response.json()
-                media_base64 = response_data.get("base64")
-                api_mime_type = response_data.get("mimetype") or mime_type
+            response = await self._request("POST", "chat/getBase64FromMediaMessage", instance_name, json=payload)
+            response.raise_for_status()
+            
+            response_data = response.json()
+            media_base64 = response_data.get("base64")
+            api_mime_type = response_data.get("mimetype") or mime_type
 
-                if not media_base64:
-                    logger.error(f"A API retornou sucesso mas não incluiu o 'base64' da mídia para a mensagem {message_id}.")
-                    return None
-                
-                # 4. Retornar os dados no formato esperado pelo GeminiService
-                # O GeminiService já sabe como lidar com base64 string.
-                return {"mime_type": api_mime_type, "data": media_base64}
+            if not media_base64:
+                logger.error(f"A API retornou sucesso mas não incluiu o 'base64' da mídia para a mensagem {message_id}.")
+                return None
+            
+            # 4. Retornar os dados no formato esperado pelo GeminiService
+            # O GeminiService já sabe como lidar com base64 string.
+            return {"mime_type": api_mime_type, "data": media_base64}
 
         except httpx.HTTPStatusError as e:
             logger.error(f"Falha de status HTTP ao buscar mídia em base64 para msg {message_id}: {e.response.status_code} - {e.response.text}", exc_info=True)
@@ -324,181 +569,96 @@ class WhatsAppService:
         """
         Busca o base64 da mídia apenas pelo ID da mensagem.
         """
-        url = f"{self.api_url}/chat/getBase64FromMediaMessage/{instance_name}"
         payload = {
             "message": { "key": { "id": message_id } },
             "convertToMp4": True
         }
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=self.headers, json=payload, timeout=60.0)
-                response.raise_for_status()
-                data = response.json()
-                return {
-                    "base64": data.get("base64"),
-                    "mimetype": data.get("mimetype")
-                }
+            response = await self._request("POST", "chat/getBase64FromMediaMessage", instance_name, json=payload)
+            response.raise_for_status()
+            data = response.json()
+            return {
+                "base64": data.get("base64"),
+                "mimetype": data.get("mimetype")
+            }
         except Exception as e:
             logger.error(f"Falha ao buscar mídia por ID {message_id}: {e}")
             return None
 
-    async def fetch_chats(self, evolution_instance_id: str, limit: int = 100, db: Optional[AsyncSession] = None, user_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    async def record_chat_message(self, instance_name: str, message_data: Dict[str, Any]):
         """
-        Busca a lista de conversas únicas (última mensagem de cada JID) 
-        diretamente no banco de dados da Evolution API.
-
-        Esta função realiza uma consulta otimizada no banco de dados da Evolution API para recuperar
-        as conversas mais recentes de uma instância específica. Se uma sessão de banco de dados (db)
-        e um ID de usuário (user_id) forem fornecidos, a função também tentará correlacionar os JIDs
-        encontrados com os contatos de prospecção existentes no banco de dados local do ProspectAI,
-        enriquecendo os dados com informações de campanha e situação atual.
-
-        Args:
-            evolution_instance_id (str): O UUID da instância dentro da Evolution API.
-            limit (int, optional): O número máximo de conversas a serem retornadas. Padrão é 100.
-            db (AsyncSession, optional): Sessão assíncrona do SQLAlchemy para consulta local.
-            user_id (int, optional): ID do usuário proprietário das prospecções para correlação.
+        Atualiza a conversa da mensagem (webhook ou resposta de envio) na lista de conversas (chat_summaries).
+        Os envios pela API são registrados pela resposta, já que o webhook só assina MESSAGES_UPSERT.
+        """
+        summary = chat_summary_from_message(message_data or {})
+        if not summary:
+            return
+        from app.crud import crud_chat, crud_jid
+        jids = list(dict.fromkeys([summary["remote_jid"], *crud_jid.jids_from_message_key(_json_obj(message_data.get("key")))]))
+        try:
+            await crud_chat.record_chat_message(instance_name, summary, jids)
+        except Exception as e:
+            logger.warning(f"Falha ao atualizar a conversa {summary['remote_jid']} da instância '{instance_name}': {e}")
 
-        Returns:
-            List[Dict[str, Any]]: Uma lista de dicionários, onde cada dicionário representa uma conversa
-            contendo campos como remoteJid, name, lastMessage, timestamp, status, e campos de correlação
-            (situacao, campanha, prospect_contact_id) se aplicável.
+    async def rebuild_chat_summaries(self, db: AsyncSession, instance: models.WhatsappInstance, mark_unread: bool = False) -> int:
+        """
+        Reconstrói a lista de conversas da instância a partir do banco da Evolution (última mensagem de cada JID).
+        Usada na primeira abertura da lista e na reconexão da instância, para cobrir mensagens recebidas sem webhook.
+        Com mark_unread, as conversas que avançaram com uma mensagem recebida ficam como não lidas.
+        Só uma reconstrução concluída marca a instância como montada (chat_summaries_built_at).
         """
-        # 1. Verifica se a URL do banco de dados da Evolution está configurada nas variáveis de ambiente
         if not self.db_url:
             logger.error("EVOLUTION_DATABASE_URL não configurada.")
-            return []
+            return 0
 
+        from app.crud import crud_chat, crud_jid
         try:
-            # 2. Prepara a URL de conexão para o driver asyncpg (remove o prefixo do SQLAlchemy se necessário)
-            db_url = self.db_url.replace("postgresql+asyncpg://", "postgresql://")
-            conn = await asyncpg.connect(db_url)
-            try:
-                # 3. Define a query SQL otimizada para buscar a última mensagem de cada chat
-                # Otimização: Busca as mensagens mais recentes primeiro usando DISTINCT ON e depois associa aos contatos.
-                # Isso evita o LATERAL join que é extremamente pesado em bases grandes.
-                query = """
-                    WITH LatestMessages AS (
-                        -- Seleciona apenas a mensagem mais recente de cada chat (JID)
-                        -- O DISTINCT ON garante uma única linha por identificador de chat
-                        SELECT DISTINCT ON (COALESCE("key"->>'remoteJidAlt', "key"->>'remoteJid'))
-                            -- Prioriza remoteJidAlt (LID) sobre remoteJid para evitar duplicidade de chats vinculados
-                            COALESCE("key"->>'remoteJidAlt', "key"->>'remoteJid') as "remoteJid",
-                            "message",
-                            "key",
-                            "status",
-                            "messageTimestamp",
-                            "instanceId",
-                            "pushName"
-                        FROM "Message"
-                        WHERE "instanceId" = $1
-                        -- Ordenação necessária para o DISTINCT ON: agrupa por JID e pega o timestamp mais recente (DESC)
-                        ORDER BY COALESCE("key"->>'remoteJidAlt', "key"->>'remoteJid'), "messageTimestamp" DESC
-                    )
-                    SELECT 
-                        lm."remoteJid",
-                        lm."pushName" as last_message_sender,
-                        c."pushName" as display_name,
-                        c."profilePicUrl",
-                        c."updatedAt",
-                        lm.message,
-                        lm.key,
-                        lm.status,
-                        lm."messageTimestamp"
-                    FROM LatestMessages lm
-                    -- Enriquece os dados da mensagem com informações do contato (nome, foto)
-                    LEFT JOIN "Contact" c ON c."remoteJid" = lm."remoteJid" AND c."instanceId" = lm."instanceId"
-                    -- Filtra apenas chats válidos: individuais (@s.whatsapp.net), grupos (@g.us) ou identidades vinculadas (@lid)
-                    WHERE (lm."remoteJid" LIKE '%@s.whatsapp.net' OR lm."remoteJid" LIKE '%@g.us' OR lm."remoteJid" LIKE '%@lid')
-                    -- Ordena a lista final para que os chats mais recentes apareçam primeiro (estilo Inbox)
-                    ORDER BY lm."messageTimestamp" DESC NULLS LAST
-                    LIMIT $2
-                """
-                # 4. Executa a query no banco de dados da Evolution
-                rows = await conn.fetch(query, evolution_instance_id, limit)
-                
-                # 5. Processa as linhas retornadas para o formato de dicionário esperado pelo frontend
-                chats = []
-                for row in rows:
-                    msg_obj = json.loads(row["message"]) if isinstance(row["message"], str) else row["message"]
-                    key_obj = json.loads(row["key"]) if isinstance(row["key"], str) else row["key"]
-                    remote_jid = row["remoteJid"]
-                    
-                    # Extrai o conteúdo textual ou um marcador de mídia para exibição na lista
-                    content = ""
-                    if msg_obj:
-                        content = msg_obj.get("conversation") or msg_obj.get("extendedTextMessage", {}).get("text", "")
-                        if not content:
-                            if "imageMessage" in msg_obj: content = "[Imagem]"
-                            elif "videoMessage" in msg_obj: content = "[Vídeo]"
-                            elif "audioMessage" in msg_obj: content = "[Áudio]"
-                            elif "documentMessage" in msg_obj: content = "[Documento]"
-                            elif "stickerMessage" in msg_obj: content = "[Figurinha]"
-                            else: content = "[Mídia]"
-
-                    chats.append({
-                        "id": remote_jid,
-                        "remoteJid": remote_jid,
-                        "name": row["display_name"] or remote_jid.split("@")[0],
-                        "profilePicUrl": row["profilePicUrl"],
-                        "isGroup": "@g.us" in remote_jid,
-                        "lastMessage": content,
-                        "timestamp": row["messageTimestamp"] or int(row["updatedAt"].timestamp()),
-                        "status": row["status"],
-                        "fromMe": key_obj.get("fromMe", False) if key_obj else False,
-                        "lastMessageSender": row["last_message_sender"]
-                    })
-
-                # 6. Correlaciona com o banco do ProspectAI se db e user_id forem fornecidos.
-                # Isso permite exibir o status da campanha e a situação do lead diretamente na lista de chats.
-                if db and user_id:
-                    # Busca em TODAS as prospecções do usuário para aumentar a chance de match
-                    stmt = (
-                        select(models.ProspectContact, models.Prospect.nome_prospeccao, models.Contact.whatsapp)
-                        .join(models.Prospect, models.ProspectContact.prospect_id == models.Prospect.id)
-                        .join(models.Contact, models.ProspectContact.contact_id == models.Contact.id)
-                        .where(models.Prospect.user_id == user_id)
-                        .order_by(models.ProspectContact.updated_at.desc())
-                    )
-                    result = await db.execute(stmt)
-                    prospect_contacts = result.all()
-
-                    # Cria um mapa de JID para dados de prospecção para busca rápida (O(1))
-                    jid_map = {}
-                    for pc, campaign_name, whatsapp in prospect_contacts:
-                        correlation_data = {
-                            "situacao": pc.situacao,
-                            "campanha": campaign_name,
-                            "prospect_contact_id": pc.id,
-                            "observacoes": pc.observacoes
-                        }
-                        # 1. Mapeia pelo número de telefone (formato JID padrão)
-                        normalized = self._normalize_number(whatsapp)
-                        standard_jid = f"{normalized}@s.whatsapp.net"
-                        if standard_jid not in jid_map:
-                            jid_map[standard_jid] = correlation_data
-                        
-                        # 2. Mapeia pelos JIDs salvos em jid_options (incluindo LIDs e variações)
-                        if pc.jid_options:
-                            jids = [j.strip() for j in pc.jid_options.split(',') if j.strip()]
-                            for jid in jids:
-                                if jid not in jid_map: jid_map[jid] = correlation_data
-
-                    # Aplica a correlação nos chats encontrados
-                    for chat in chats:
-                        match = jid_map.get(chat["remoteJid"])
-                        chat["situacao"] = match["situacao"] if match else None
-                        chat["campanha"] = match["campanha"] if match else None
-                        chat["prospect_contact_id"] = match["prospect_contact_id"] if match else None
-                        chat["observacoes"] = match["observacoes"] if match else None
-
-                return chats
-            finally:
-                # 7. Garante o fechamento da conexão com o banco de dados da Evolution
-                await conn.close()
+            async with self._evolution_db() as conn:
+                rows = await conn.fetch(CHAT_SUMMARIES_REBUILD_QUERY, instance.instance_id)
         except Exception as e:
             logger.error(f"Erro ao buscar chats no banco de dados da Evolution: {e}", exc_info=True)
-            return []
+            return 0
+
+        summaries = []
+        for row in rows:
+            message_data = {
+                "key": row["key"],
+                "message": row["message"],
+                "messageTimestamp": row["messageTimestamp"] or (int(row["updatedAt"].timestamp()) if row["updatedAt"] else None),
+                "pushName": row["last_message_sender"],
+                "status": row["status"],
+            }
+            summary = chat_summary_from_message(message_data)
+            if not summary:
+                continue
+            summary.update(
+                remote_jid=row["remoteJid"],
+                name=row["display_name"],
+                profile_pic_url=row["profilePicUrl"],
+                unread=summary["unread"] and mark_unread,
+            )
+            summaries.append(summary)
+
+        await crud_chat.upsert_chat_summaries(db, instance.id, summaries)
+        await crud_chat.mark_chat_summaries_built(db, instance.id)
+        # A correlação com as prospecções é feita pelo mapeamento de JIDs; contatos sem mapeamento entram aqui
+        await crud_jid.backfill_user_contact_jids(db, instance.user_id, self._normalize_number)
+        logger.info(f"Lista de conversas da instância '{instance.instance_name}' reconstruída: {len(summaries)} conversas.")
+        return len(summaries)
+
+    async def fetch_chats(self, db: AsyncSession, instance: models.WhatsappInstance, user_id: int, limit: int = 100, before_ts: Optional[int] = None, before_jid: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Lista as conversas da instância (última mensagem de cada JID), mais recentes primeiro, a partir da tabela
+        chat_summaries, com a situação e a campanha do contato de prospecção correlacionado.
+        A página seguinte é pedida com o timestamp e o remoteJid da última conversa recebida (before_ts/before_jid).
+        Enquanto a instância não tiver sido montada a partir do banco da Evolution, a tabela só tem as conversas
+        tocadas por webhooks e envios; a montagem é feita na primeira abertura da lista.
+        """
+        from app.crud import crud_chat
+
+        if before_ts is None and instance.chat_summaries_built_at is None:
+            await self.rebuild_chat_summaries(db, instance)
+        return await crud_chat.get_chat_summaries(db, instance.id, user_id, limit=limit, before_ts=before_ts, before_jid=before_jid)
 
     def format_evolution_message(self, raw_msg: Dict[str, Any]) -> Dict[str, Any]:
         """Converte o formato da Evolution para o formato interno do chat."""
@@ -537,12 +697,15 @@ class WhatsAppService:
         result.update(extra_data)
         return result
 
-    async def fetch_chat_history(self, instance_name: str, number: str, count: int = 999, mode: str = None, jids: List[str] = None, evolution_instance_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    async def fetch_chat_history(self, instance_name: str, number: str, count: int = 999, mode: str = None, jids: List[str] = None, evolution_instance_id: Optional[str] = None, since_timestamp: Optional[int] = None, expand_jids: bool = True) -> List[Dict[str, Any]]:
         """
         Busca o histórico de mensagens diretamente no banco de dados da Evolution API.
         Se 'jids' for fornecido, busca por esses JIDs exatos.
         Caso contrário, usa 'number' para uma busca aproximada (LIKE).
+        Com 'since_timestamp', traz apenas as mensagens com messageTimestamp >= a ele (sincronização incremental).
+        Com expand_jids=False, os JIDs já resolvidos (contact_jids) são usados sem consultar o IsOnWhatsapp.
         """
+        since_timestamp = since_timestamp or 0
         if not self.db_url:
             logger.error("EVOLUTION_DATABASE_URL não configurada. Não é possível buscar histórico via DB.")
             return []
@@ -551,16 +714,12 @@ class WhatsAppService:
         logger.info(f"Fetch History: Instance='{instance_name}', Number='{number}', JIDs='{jids}'")
 
         try:
-            # Remove o prefixo '+asyncpg' se presente, pois o driver asyncpg puro não o reconhece
-            db_url = self.db_url.replace("postgresql+asyncpg://", "postgresql://")
-            
-            conn = await asyncpg.connect(db_url)
-            try:
+            async with self._evolution_db() as conn:
                 # 1. Verifica se a instância existe e pega o ID (Evita queries pesadas se o nome estiver errado)
                 if evolution_instance_id:
                     instance_id = evolution_instance_id
                 else:
-                    instance_id = await conn.fetchval('SELECT id FROM "Instance" WHERE name = $1', instance_name)
+                    instance_id = await self._get_instance_id(conn, instance_name)
                 
                 if not instance_id:
                     logger.warning(f"Fetch History: Instância '{instance_name}' NÃO ENCONTRADA no banco da Evolution.")
@@ -580,31 +739,19 @@ class WhatsAppService:
                     if contact_jid:
                         jids = [contact_jid]
 
-                if jids:
+                if jids and not expand_jids:
+                    all_target_jids = list(jids)
+                elif jids:
+                    # Busca as correlações de todos os JIDs na tabela IsOnWhatsapp numa única consulta
+                    options_rows = await conn.fetch(IS_ON_WHATSAPP_BULK_QUERY, list(jids))
+                    options_by_jid = {row["remoteJid"]: _parse_jid_options(row["jidOptions"]) for row in options_rows}
                     for jid in jids:
-                        # Busca correlações na tabela IsOnWhatsapp
-                        jid_options_str = await conn.fetchval('SELECT "jidOptions" FROM "IsOnWhatsapp" WHERE "remoteJid" = $1', jid)
-                        if jid_options_str:
-                            options = [j.strip() for j in jid_options_str.split(',') if j.strip()]
-                            all_target_jids.extend(options)
-                        else:
-                            all_target_jids.append(jid)
+                        all_target_jids.extend(options_by_jid.get(jid) or [jid])
                     
                     all_target_jids = list(set(all_target_jids))
 
                 if all_target_jids:
-                    query = """
-                        SELECT "key", "message", "messageTimestamp", "pushName", "status"
-                        FROM "Message"
-                        WHERE "instanceId" = $1
-                          AND (
-                            "key"->>'remoteJid' = ANY($2::text[])
-                            OR "key"->>'remoteJidAlt' = ANY($2::text[])
-                          )
-                        ORDER BY "messageTimestamp" DESC
-                        LIMIT $3
-                    """
-                    rows = await conn.fetch(query, instance_id, all_target_jids, count)
+                    rows = await conn.fetch(HISTORY_BY_JIDS_QUERY, instance_id, all_target_jids, count, since_timestamp)
                 else:
                     # 1. Limpeza básica
                     clean_number = "".join(filter(str.isdigit, str(number)))
@@ -636,19 +783,23 @@ class WhatsAppService:
                         else:
                             search_term = raw_local
 
-                    query = """
-                        SELECT "key", "message", "messageTimestamp", "pushName", "status"
-                        FROM "Message"
-                        WHERE "instanceId" = $1
-                          AND (
-                            "key"->>'remoteJid' LIKE $2
-                            OR "key"->>'remoteJidAlt' LIKE $2
-                          )
-                        ORDER BY "messageTimestamp" DESC
-                        LIMIT $3
-                    """
-                    like_pattern = f"%{search_term}%"
-                    rows = await conn.fetch(query, instance_id, like_pattern, count)
+                    if len(search_term) == PHONE_SUFFIX_LENGTH:
+                        # Compara os últimos dígitos do número do JID (invertidos), coberta pelos índices de sufixo
+                        rows = await conn.fetch(HISTORY_BY_PHONE_SUFFIX_QUERY, instance_id, search_term[::-1], count, since_timestamp)
+                    else:
+                        query = """
+                            SELECT "key", "message", "messageTimestamp", "pushName", "status"
+                            FROM "Message"
+                            WHERE "instanceId" = $1
+                              AND (
+                                "key"->>'remoteJid' LIKE $2
+                                OR "key"->>'remoteJidAlt' LIKE $2
+                              )
+                              AND "messageTimestamp" >= $4
+                            ORDER BY "messageTimestamp" DESC
+                            LIMIT $3
+                        """
+                        rows = await conn.fetch(query, instance_id, f"%{search_term}%", count, since_timestamp)
                 
                 messages = []
                 for row in rows:
@@ -664,91 +815,71 @@ class WhatsAppService:
                 if not messages and mode and mode != 'initial':
                     raise ValueError(f"Histórico vazio para contato {number} em modo '{mode}'.")
 
-                search_desc = f"JIDs: {jids}" if jids else f"Termo: {like_pattern}"
+                search_desc = f"JIDs: {jids}" if jids else f"Termo: {search_term}"
                 logger.info(f"Histórico carregado via DB ({search_desc}). Total: {len(messages)}.")
                 return messages
-            finally:
-                await conn.close()
         except ValueError:
             raise
         except Exception as e:
             logger.error(f"Erro ao buscar histórico no banco de dados da Evolution: {e}", exc_info=True)
             return []
 
-    async def find_lid_by_message_content(self, instance_name: str, content: str) -> Optional[str]:
+    async def find_lid_by_message_contents(self, instance_name: str, contents: List[str]) -> Optional[str]:
         """
-        Busca uma mensagem enviada pela IA no banco da Evolution para tentar descobrir o LID.
-        Retorna o remoteJid se for um LID e se a mensagem for única.
+        Busca as mensagens enviadas pela IA no banco da Evolution para tentar descobrir o LID (uma única consulta,
+        pelo md5 do texto). 'contents' vem do mais recente para o mais antigo; retorna o LID do primeiro texto
+        encontrado em uma única conversa.
         """
-        if not self.db_url:
+        if not self.db_url or not contents:
             return None
 
+        hashes = [hashlib.md5(content.encode("utf-8")).hexdigest() for content in contents]
         try:
-            # Remove o prefixo '+asyncpg' se presente, pois o driver asyncpg puro não o reconhece
-            db_url = self.db_url.replace("postgresql+asyncpg://", "postgresql://")
-            
-            conn = await asyncpg.connect(db_url)
-            try:
-                # Busca mensagens enviadas pela instância (fromMe=true) com o conteúdo exato
-                # Retorna remoteJid
-                query = """
-                    SELECT "key"->>'remoteJid' as remote_jid
-                    FROM "Message"
-                    WHERE "instanceId" = (SELECT id FROM "Instance" WHERE name = $1)
-                      AND "key"->>'fromMe' = 'true'
-                      AND (
-                          "message"->>'conversation' = $2
-                          OR "message"->'extendedTextMessage'->>'text' = $2
-                      )
-                    LIMIT 2
-                """
-                rows = await conn.fetch(query, instance_name, content)
-                
-                # Se retornar mais de 1, é ambíguo, pula.
-                if len(rows) != 1:
+            async with self._evolution_db() as conn:
+                instance_id = await self._get_instance_id(conn, instance_name)
+                if not instance_id:
                     return None
-                
-                remote_jid = rows[0]['remote_jid']
-                if remote_jid and '@lid' in remote_jid:
-                    return remote_jid
-                
-                return None
-            finally:
-                await conn.close()
+                rows = await conn.fetch(SENT_TEXT_LOOKUP_QUERY, instance_id, list(dict.fromkeys(hashes)))
         except Exception as e:
             logger.error(f"Erro ao buscar LID por conteúdo: {e}")
             return None
 
+        chats_by_hash = {row["content_md5"]: row for row in rows}
+        for content_md5 in hashes:
+            row = chats_by_hash.get(content_md5)
+            # Texto enviado para mais de uma conversa é ambíguo, pula
+            if not row or row["chats"] != 1:
+                continue
+            if row["remote_jid"] and "@lid" in row["remote_jid"]:
+                return row["remote_jid"]
+        return None
+
     async def find_contacts(self, instance_name: str) -> List[Dict[str, Any]]:
         """Busca contatos na Evolution API."""
-        url = f"{self.api_url}/chat/findContacts/{instance_name}"
         payload = {"where": {}}
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=self.headers, json=payload, timeout=30.0)
-                response.raise_for_status()
-                data = response.json()
-                return data if isinstance(data, list) else []
+            response = await self._request("POST", "chat/findContacts", instance_name, json=payload)
+            response.raise_for_status()
+            data = response.json()
+            return data if isinstance(data, list) else []
         except Exception as e:
             logger.error(f"Erro ao buscar contatos: {e}")
             return []
 
     async def fetch_all_groups(self, instance_name: str) -> List[Dict[str, Any]]:
         """Busca grupos na Evolution API."""
-        url = f"{self.api_url}/group/fetchAllGroups/{instance_name}?getParticipants=false"
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, headers=self.headers, timeout=30.0)
-                response.raise_for_status()
-                return response.json()
+            response = await self._request(
+                "GET", "group/fetchAllGroups", instance_name, params={"getParticipants": "false"}
+            )
+            response.raise_for_status()
+            return response.json()
         except Exception as e:
             logger.error(f"Erro ao buscar grupos: {e}")
             return []
 
     async def delete_message_for_everyone(self, instance_name: str, remote_jid: str, message_id: str):
         """Deleta uma mensagem para todos (Revoke)."""
-        url = f"{self.api_url}/chat/deleteMessageForEveryone/{instance_name}"
-        
         # Garante que o remoteJid esteja no formato correto se não for um grupo
         if "@" not in remote_jid:
             normalized = self._normalize_number(remote_jid)
@@ -760,9 +891,8 @@ class WhatsAppService:
             "fromMe": True
         }
         try:
-            async with httpx.AsyncClient() as client:
-                # Usa request("DELETE") para garantir o envio do body, já que client.delete pode ignorar
-                await client.request("DELETE", url, headers=self.headers, json=payload, timeout=10.0)
+            # Usa request("DELETE") para garantir o envio do body, já que client.delete pode ignorar
+            await self._request("DELETE", "chat/deleteMessageForEveryone", instance_name, json=payload)
         except Exception as e:
             logger.error(f"Falha ao deletar mensagem {message_id} em {remote_jid}: {e}")
 
@@ -773,8 +903,6 @@ class WhatsAppService:
         if not message_ids:
             return None
 
-        url = f"{self.api_url}/chat/markMessageAsRead/{instance_name}"
-        
         # Se não for um grupo e não tiver @, normaliza para o formato do WhatsApp
         if "@" not in remote_jid:
             normalized = self._normalize_number(remote_jid)
@@ -792,14 +920,62 @@ class WhatsAppService:
         payload = {"readMessages": read_messages}
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=self.headers, json=payload, timeout=10.0)
-                response.raise_for_status()
-                return response.json()
+            response = await self._request("POST", "chat/markMessageAsRead", instance_name, json=payload)
+            response.raise_for_status()
+            return response.json()
         except Exception as e:
             logger.error(f"Falha ao marcar mensagens como lidas para {remote_jid}: {e}")
             return None
 
+    async def fetch_jid_options_bulk(self, jids: List[str]) -> Optional[Dict[str, List[str]]]:
+        """
+        jidOptions de vários JIDs do IsOnWhatsapp numa única consulta: {jid: [jids relacionados]}.
+        Retorna None se o banco da Evolution não estiver disponível.
+        """
+        if not self.db_url or not jids:
+            return None
+        try:
+            async with self._evolution_db() as conn:
+                rows = await conn.fetch(IS_ON_WHATSAPP_BULK_QUERY, list(jids))
+            return {row["remoteJid"]: _parse_jid_options(row["jidOptions"]) for row in rows}
+        except Exception as e:
+            logger.error(f"Erro ao buscar jidOptions em lote no DB da Evolution: {e}")
+            return None
+
+    async def resolve_contact_jids(self, db: AsyncSession, contact_id: int, phone_number: Optional[str] = None, seed_jids: Optional[List[str]] = None) -> List[str]:
+        """
+        JIDs do contato pela tabela local contact_jids (uma consulta indexada), com o JID do número primeiro.
+        Se o contato não tiver mapeamento, ele estiver desatualizado ou 'seed_jids' trouxer JIDs novos, os JIDs
+        conhecidos são ampliados com o IsOnWhatsapp numa única consulta e o mapeamento é salvo.
+        """
+        from app.crud import crud_jid
+
+        rows = await crud_jid.get_contact_jids(db, contact_id)
+        known = [row.jid for row in rows]
+        seeds = [jid for jid in (seed_jids or []) if jid]
+        stale_before = datetime.now(timezone.utc) - timedelta(hours=settings.CONTACT_JIDS_REFRESH_HOURS)
+        if rows and set(seeds) <= set(known) and all(row.refreshed_at >= stale_before for row in rows):
+            return known
+
+        # O JID do número importado sem conferência só vale se existir no IsOnWhatsapp (pode divergir no 9º dígito)
+        unverified = {row.jid for row in rows if row.kind == "phone" and row.refreshed_at <= crud_jid.NEVER_REFRESHED}
+        candidates = list(dict.fromkeys(known + seeds))
+        if not candidates:
+            return []
+        options = await self.fetch_jid_options_bulk(candidates)
+        if options is None:
+            # Evolution indisponível: usa o que já se sabe, sem marcar o mapeamento como conferido
+            return [jid for jid in candidates if jid not in unverified]
+
+        jids = [jid for jid in candidates if jid not in unverified or jid in options]
+        for related in options.values():
+            jids.extend(related)
+        phone_jid = f"{self._normalize_number(phone_number)}@s.whatsapp.net" if phone_number else None
+        await crud_jid.save_contact_jids(db, contact_id, jids, phone_jid, remove=list(unverified - set(jids)))
+        if not jids:
+            return []
+        return [row.jid for row in await crud_jid.get_contact_jids(db, contact_id)]
+
     async def get_jid_options_from_db(self, instance_name: str, remote_jid: str) -> Optional[List[Dict[str, Any]]]:
         """
         Busca as opções de JID (jidOptions) na tabela IsOnWhatsapp do banco da Evolution.
@@ -809,9 +985,7 @@ class WhatsAppService:
             return None
 
         try:
-            db_url = self.db_url.replace("postgresql+asyncpg://", "postgresql://")
-            conn = await asyncpg.connect(db_url)
-            try:
+            async with self._evolution_db() as conn:
                 query = 'SELECT "jidOptions" FROM "IsOnWhatsapp" WHERE "remoteJid" = $1'
                 jid_options_json = await conn.fetchval(query, remote_jid)
 
@@ -826,8 +1000,6 @@ class WhatsAppService:
                             return None
                     return jid_options_json
                 return None
-            finally:
-                await conn.close()
         except Exception as e:
             logger.error(f"Erro ao buscar jidOptions no DB da Evolution: {e}")
             return None
@@ -841,9 +1013,7 @@ class WhatsAppService:
             return [remote_jid]
 
         try:
-            db_url = self.db_url.replace("postgresql+asyncpg://", "postgresql://")
-            conn = await asyncpg.connect(db_url)
-            try:
+            async with self._evolution_db() as conn:
                 # Busca na tabela IsOnWhatsapp
                 query = 'SELECT "jidOptions" FROM "IsOnWhatsapp" WHERE "remoteJid" = $1'
                 jid_options_str = await conn.fetchval(query, remote_jid)
@@ -856,25 +1026,20 @@ class WhatsAppService:
                     jids.update(parts)
                 
                 return list(jids)
-            finally:
-                await conn.close()
         except Exception as e:
             logger.error(f"Erro ao buscar JIDs relacionados para {remote_jid}: {e}")
             return [remote_jid]
 
     async def check_whatsapp_numbers(self, instance_name: str, numbers: List[str]) -> Optional[List[Dict[str, Any]]]:
         results = []
-        # Rota correta da Evolution API para verificar números
-        url = f"{self.api_url}/chat/whatsappNumbers/{instance_name}"
         payload = {
             "numbers": [self._normalize_number(n) for n in numbers]
         }
         try:
-            async with httpx.AsyncClient() as client:
-                # A rota da Evolution usa POST para essa verificação
-                response = await client.post(url, headers=self.headers, json=payload, timeout=30)
-                response.raise_for_status()
-                results = response.json()
+            # A rota da Evolution usa POST para essa verificação
+            response = await self._request("POST", "chat/whatsappNumbers", instance_name, json=payload)
+            response.raise_for_status()
+            results = response.json()
             return results
         except Exception as e:
             logger.error(f"Falha ao verificar números no WhatsApp: {e}")
@@ -885,8 +1050,6 @@ class WhatsAppService:
         Envia o status de presença (ex: 'composing' para 'Digitando...') para um número.
         """
         normalized_number = self._normalize_number(number)
-        url = f"{self.api_url}/chat/sendPresence/{instance_name}"
-        
         # Payload para Evolution API v2
         payload = {
             "number": normalized_number,
@@ -895,12 +1058,11 @@ class WhatsAppService:
         }
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=self.headers, json=payload, timeout=5.0)
-                # Ignora erro 404 (Group not found / Number not found) conforme solicitado
-                if response.status_code == 404:
-                    return
-                response.raise_for_status()
+            response = await self._request("POST", "chat/sendPresence", instance_name, json=payload)
+            # Ignora erro 404 (Group not found / Number not found) conforme solicitado
+            if response.status_code == 404:
+                return
+            response.raise_for_status()
         except Exception as e:
             logger.warning(f"Falha ao enviar status '{presence}' para {normalized_number}: {e}")
 
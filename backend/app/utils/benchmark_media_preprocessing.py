@@ -0,0 +1,150 @@
+# --- Benchmark do Pré-processamento de Mídia (ffmpeg) ---
+#
+# Compara, para cada arquivo, a mídia original com a versão pré-processada
+# que é enviada ao Gemini: tamanho, duração/dimensões, tokens estimados e
+# tempo de pré-processamento. Opcionalmente mede a latência real da
+# transcrição/análise no Gemini (consome tokens da primeira chave da API).
+#
+# Como usar (na pasta 'backend', com o ffmpeg instalado):
+# 1. python app/utils/benchmark_media_preprocessing.py audio.ogg foto.jpg
+# 2. Sem arquivos, gera amostras sintéticas (áudio de 60s com pausas e imagem 4000x3000).
+# 3. Adicione --gemini para medir também os tokens e a latência reais do Gemini.
+
+import asyncio
+import json
+import math
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from dotenv import load_dotenv
+
+# --- Adiciona o diretório raiz do projeto ao sys.path ---
+# Isso garante que o script possa encontrar o pacote 'app'
+project_root = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(project_root))
+
+# Carrega as variáveis de ambiente do arquivo .env na pasta raiz ('backend')
+env_path = project_root / '.env'
+load_dotenv(dotenv_path=env_path)
+# --- Fim da correção de path ---
+
+from app.core.config import settings
+from app.services.media_preprocessor import get_media_preprocessor
+
+# Tokens do Gemini: áudio ~32 tokens/s; imagens em blocos de 258 tokens (até 384px em ambos os lados é um bloco só)
+AUDIO_TOKENS_PER_SECOND = 32
+IMAGE_TILE_TOKENS = 258
+
+MIME_BY_SUFFIX = {
+    ".ogg": "audio/ogg", ".opus": "audio/ogg", ".mp3": "audio/mpeg", ".m4a": "audio/mp4", ".wav": "audio/wav",
+    ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp",
+}
+
+
+def probe(data: bytes) -> dict:
+    """Duração (s) e dimensões da mídia via ffprobe."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration:stream=width,height", "-of", "json", "-i", "pipe:0"],
+        input=data, capture_output=True, check=False
+    )
+    try:
+        info = json.loads(result.stdout or b"{}")
+    except json.JSONDecodeError:
+        return {}
+    stream = next((s for s in info.get("streams", []) if s.get("width")), {})
+    duration = info.get("format", {}).get("duration")
+    return {
+        "duration": float(duration) if duration not in (None, "N/A") else None,
+        "width": stream.get("width"),
+        "height": stream.get("height"),
+    }
+
+
+def estimate_media_tokens(mime_type: str, info: dict) -> int:
+    if mime_type.startswith("audio/") and info.get("duration"):
+        return math.ceil(info["duration"] * AUDIO_TOKENS_PER_SECOND)
+    width, height = info.get("width"), info.get("height")
+    if not width or not height:
+        return 0
+    if width <= 384 and height <= 384:
+        return IMAGE_TILE_TOKENS
+    unit = max(int(min(width, height) / 1.5), 256)
+    return math.ceil(width / unit) * math.ceil(height / unit) * IMAGE_TILE_TOKENS
+
+
+def generate_samples(directory: Path) -> list:
+    """Gera um áudio estéreo 48 kHz com pausas longas e uma imagem grande, como as que chegam do WhatsApp."""
+    audio = directory / "amostra_audio.ogg"
+    image = directory / "amostra_imagem.jpg"
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", "sine=frequency=440:duration=60:sample_rate=48000",
+        "-af", "volume='if(lt(mod(t,10),6),1,0)':eval=frame", "-ac", "2",
+        "-c:a", "libopus", "-b:a", "64k", str(audio)
+    ], check=True)
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", "testsrc2=size=4000x3000", "-frames:v", "1", "-q:v", "2", str(image)
+    ], check=True)
+    return [audio, image]
+
+
+async def gemini_measure(data: bytes, mime_type: str) -> tuple:
+    """Tokens de entrada (count_tokens) e latência de uma transcrição/análise real."""
+    from google import genai
+    from google.genai import types
+
+    client = genai.Client(api_key=settings.GOOGLE_API_KEYS.split(",")[0].strip())
+    part = types.Part.from_bytes(data=data, mime_type=mime_type)
+    prompt = "Transcreva o áudio." if mime_type.startswith("audio/") else "Descreva a imagem em uma frase."
+    count = await client.aio.models.count_tokens(model="gemini-2.5-flash", contents=[prompt, part])
+    start = time.perf_counter()
+    await client.aio.models.generate_content(model="gemini-2.5-flash", contents=[prompt, part])
+    return count.total_tokens, (time.perf_counter() - start) * 1000
+
+
+async def run_benchmark(paths: list, with_gemini: bool):
+    # Obs.: o tempo do primeiro arquivo inclui a inicialização do pool de processos
+    preprocessor = get_media_preprocessor()
+
+    for path in paths:
+        data = path.read_bytes()
+        mime_type = MIME_BY_SUFFIX.get(path.suffix.lower(), "application/octet-stream")
+
+        start = time.perf_counter()
+        processed, new_mime = await preprocessor.preprocess(data, mime_type)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        before, after = probe(data), probe(processed)
+        print("\n" + "=" * 60)
+        print(f"📄 {path.name} ({mime_type} -> {new_mime})")
+        print(f"   Tamanho:  {len(data) / 1024:,.1f} KB -> {len(processed) / 1024:,.1f} KB ({100 * len(processed) / max(len(data), 1):.0f}%)")
+        if mime_type.startswith("audio/"):
+            print(f"   Duração:  {before.get('duration') or 0:.1f}s -> {after.get('duration') or 0:.1f}s")
+        else:
+            print(f"   Dimensão: {before.get('width')}x{before.get('height')} -> {after.get('width')}x{after.get('height')}")
+        print(f"   Tokens estimados: {estimate_media_tokens(mime_type, before)} -> {estimate_media_tokens(new_mime, after)}")
+        print(f"   Pré-processamento: {elapsed_ms:,.0f} ms")
+
+        if with_gemini:
+            tokens_before, latency_before = await gemini_measure(data, mime_type)
+            tokens_after, latency_after = await gemini_measure(processed, new_mime)
+            print(f"   Gemini (tokens): {tokens_before} -> {tokens_after}")
+            print(f"   Gemini (latência): {latency_before:,.0f} ms -> {latency_after:,.0f} ms (+{elapsed_ms:,.0f} ms de pré-processamento)")
+
+    preprocessor.shutdown()
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    with_gemini = "--gemini" in sys.argv
+
+    if not settings.MEDIA_PREPROCESS_ENABLED:
+        print("\n❌ MEDIA_PREPROCESS_ENABLED está desligado.")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [Path(a) for a in args] or generate_samples(Path(tmp))
+        asyncio.run(run_benchmark(files, with_gemini))
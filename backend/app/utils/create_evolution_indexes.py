@@ -0,0 +1,59 @@
+# --- Criação dos Índices do ProspectAI no Banco da Evolution ---
+#
+# As leituras de histórico filtram a tabela "Message" por key->>'remoteJid' /
+# key->>'remoteJidAlt' (ou pelo final do número) e ordenam por
+# "messageTimestamp", e a descoberta do LID procura as mensagens enviadas pelo
+# md5 do texto. A Evolution não cria índices para isso, então cada
+# sincronização varre todo o histórico da instância. Este script (opcional)
+# cria os índices de expressão usados por essas consultas, sem bloquear as
+# escritas da Evolution (CREATE INDEX CONCURRENTLY).
+#
+# Como usar (na pasta 'backend', com EVOLUTION_DATABASE_URL no .env):
+# 1. python app/utils/create_evolution_indexes.py            -> cria os que faltam e verifica
+# 2. python app/utils/create_evolution_indexes.py --verify   -> apenas verifica
+# Obs.: em tabelas grandes a criação pode levar vários minutos.
+
+import asyncio
+import sys
+from pathlib import Path
+from dotenv import load_dotenv
+
+# --- Adiciona o diretório raiz do projeto ao sys.path ---
+# Isso garante que o script possa encontrar o pacote 'app'
+project_root = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(project_root))
+
+# Carrega as variáveis de ambiente do arquivo .env na pasta raiz ('backend')
+env_path = project_root / '.env'
+load_dotenv(dotenv_path=env_path)
+# --- Fim da correção de path ---
+
+import asyncpg
+
+from app.core.config import settings
+from app.services.evolution_indexes import ensure_evolution_indexes, verify_evolution_indexes
+
+
+async def run(verify_only: bool) -> bool:
+    db_url = settings.EVOLUTION_DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://")
+    conn = await asyncpg.connect(db_url)
+    try:
+        if not verify_only:
+            created = await ensure_evolution_indexes(conn)
+            print(f"\n✅ Índices criados: {', '.join(created) if created else 'nenhum (já existiam)'}")
+
+        status = await verify_evolution_indexes(conn)
+    finally:
+        await conn.close()
+
+    print("\n" + "=" * 50)
+    for name, state in status.items():
+        icon = "✅" if state == "ok" else "❌"
+        print(f"{icon} {name}: {state}")
+    print("=" * 50 + "\n")
+    return all(state == "ok" for state in status.values())
+
+
+if __name__ == "__main__":
+    ok = asyncio.run(run(verify_only="--verify" in sys.argv))
+    sys.exit(0 if ok else 1)
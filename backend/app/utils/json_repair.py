@@ -0,0 +1,176 @@
+import re
+import json
+from typing import Any, List, Optional
+
+_CODE_FENCE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+_INVALID_ESCAPE = re.compile(r'\\(?![/"\\bfnrtu])')
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+
+def _strip_wrapping(text: str) -> str:
+    """Remove blocos de código (```json) e qualquer texto antes do primeiro '{' ou '['."""
+    text = _CODE_FENCE.sub("", text.strip())
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    return text[min(starts):] if starts else text
+
+
+def _escape_raw_controls(text: str) -> str:
+    """
+    Percorre o JSON escapando quebras de linha e tabulações cruas dentro de strings.
+    Uma resposta truncada (string, objeto ou lista sem fechamento) não é completada:
+    levanta json.JSONDecodeError para que a resposta seja gerada de novo.
+    """
+    out = []
+    depth = 0
+    in_string = False
+    escaped = False
+
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            elif ch in _CONTROL_ESCAPES:
+                out.append(_CONTROL_ESCAPES[ch])
+                continue
+            out.append(ch)
+            continue
+
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+        out.append(ch)
+
+    if in_string or depth > 0:
+        raise json.JSONDecodeError("JSON truncado", text, len(text))
+    return "".join(out)
+
+
+def _try_load(text: str) -> Optional[Any]:
+    for candidate in (text, _INVALID_ESCAPE.sub(r"\\\\", text)):
+        candidate = _TRAILING_COMMA.sub(r"\1", candidate)
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def repair_json(text: str) -> Any:
+    """
+    Parser tolerante para respostas JSON de LLMs, limitado a correções cosméticas: blocos de código,
+    vírgulas sobrando, quebras de linha não escapadas e backslashes soltos. Respostas truncadas não são
+    completadas. Levanta json.JSONDecodeError se não for possível recuperar.
+    """
+    text = _strip_wrapping(text)
+
+    result = _try_load(text)
+    if result is not None:
+        return result
+
+    result = _try_load(_escape_raw_controls(text))
+    if result is not None:
+        return result
+
+    raise json.JSONDecodeError("JSON irrecuperável", text, 0)
+
+
+_STRING_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonStringFieldStream:
+    """
+    Extrai incrementalmente o valor de um campo string de um JSON que chega em pedaços (streaming).
+    Cada chamada a feed() retorna apenas o trecho novo (já decodificado) do valor do campo.
+    """
+    def __init__(self, field: str):
+        self._key_pattern = re.compile(re.escape(f'"{field}"') + r'\s*:\s*"')
+        self._buffer = ""
+        self._pos: Optional[int] = None
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        self._buffer += chunk
+        if self.done:
+            return ""
+        if self._pos is None:
+            match = self._key_pattern.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        buf = self._buffer
+        out = []
+        i = self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                i += 1
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+
+            # Sequência de escape incompleta: espera o próximo pedaço
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc != "u":
+                out.append(_STRING_ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if i + 6 > len(buf):
+                break
+            try:
+                code = int(buf[i + 2:i + 6], 16)
+            except ValueError:
+                i += 6
+                continue
+            if 0xD800 <= code < 0xDC00:
+                # Par substituto (ex.: emojis escapados): precisa do segundo \uXXXX
+                if i + 12 > len(buf):
+                    break
+                try:
+                    low = int(buf[i + 8:i + 12], 16)
+                    out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                except ValueError:
+                    pass
+                i += 12
+                continue
+            out.append(chr(code))
+            i += 6
+
+        self._pos = i
+        return "".join(out)
+
+
+class MessageLineSplitter:
+    """Acumula o texto da mensagem em streaming e devolve as linhas (partes de envio) já completas."""
+    def __init__(self):
+        self._buffer = ""
+
+    def _normalize(self) -> str:
+        # Mesma normalização do envio: a IA às vezes escapa as quebras de linha ("\\n")
+        return self._buffer.replace("\\n", "\n")
+
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+        normalized = self._normalize()
+        if "\n" not in normalized:
+            return []
+        complete, self._buffer = normalized.rsplit("\n", 1)
+        return [line.strip() for line in complete.split("\n") if line.strip()]
+
+    def flush(self) -> List[str]:
+        remaining = self._normalize().strip()
+        self._buffer = ""
+        return [remaining] if remaining else []